@@ -6,9 +6,15 @@ urlpatterns = [
     path('menu/', views.menu_items, name='menu-items'),
     path('menu/create/', views.create_menu_item, name='crete-menu-item'),
     path('menu/edit/', views.edit_menu_item, name='edit-menu-item'),
+    path('menu/price_simulation/', views.menu_price_simulation, name='menu-price-simulation'),
+    path('costs/allocation/', views.cost_allocation, name='cost-allocation'),
     path('inventory/', views.inventory_items, name='inventory-items'),
     path('inventory/create/', views.create_inventory_item, name='crete-inventory-item'),
     path('inventory/edit/', views.edit_inventory_item, name='edit-inventory-item'),
+    path('inventory/alerts', views.inventory_alerts, name='inventory-alerts'),
+    path('inventory/forecast', views.inventory_forecast, name='inventory-forecast'),
+    path('inventory/as_of', views.inventory_as_of, name='inventory-as-of'),
+    path('inventory/stocktake', views.inventory_stocktake, name='inventory-stocktake'),
     path('recipe/add/', views.add_new_recipe, name='add-recipe-record'),
     path('recipe/edit/', views.update_remove_recipe, name='update-remove-recipe'),
     path('suppliers/', views.get_suppliers, name='get-suppliers-info'),
@@ -26,6 +32,9 @@ urlpatterns = [
     path('hr/shift/create/routine', views.create_routine_shift, name='create-shifts-new'),
     path('hr/target_salary', views.get_target_salary, name='get-target-salary'),
     path('hr/target_salary/add', views.create_edit_target_salary, name='crete-target-salary'),
+    path('hr/payroll/run', views.run_payroll, name='run-payroll'),
+    path('hr/staffing/plan', views.plan_staffing, name='plan-staffing'),
+    path('hr/work_record/import', views.import_time_clock, name='import-time-clock'),
     path('bills/', views.get_bills, name='get-the-bills'),
     path('bills/add_update', views.add_edit_bill, name='add-update-bill'),
     path('bills_estimated/', views.get_estimated_bills, name='get-estimated-bills'),
@@ -36,6 +45,7 @@ urlpatterns = [
     path('equipment/add_update', views.add_edit_equipment, name='add-equipment'),
     path('equipment/', views.fetch_equipment, name='get-equipment'),
     path('sale/add', views.add_new_sale, name='add-sale'),
+    path('sale/batch', views.ingest_pos_batch, name='ingest-pos-batch'),
     path('payment/add', views.add_invoice_payment, name='add-payment'),
     path('invoices/', views.get_invoices_info, name='get-invoice-info'),
 
@@ -1,3 +1,6 @@
+import codecs
+import csv
+import io
 from csv import excel
 from http.client import responses
 from typing import Optional
@@ -5,6 +8,7 @@ from datetime import time
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
+from django.core.cache import cache
 from models.dbhandler import DBHandler
 from cafe_manager import CafeManager
 from models.cafe_managment_models import *
@@ -12,8 +16,12 @@ from models.cafe_managment_models import *
 
 
 
-db_handler = DBHandler()
+db_handler = DBHandler(archive_dir="archive")
 cafe_manager = CafeManager(db_handler)
+
+# alerts are recomputed for the whole inventory, dashboards polling it hit the cache
+ALERTS_CACHE_SECONDS = 60
+DEFAULT_CYCLE_DAYS = 7
 # Create your views here.
 
 def parse_date_string(date_str: str):
@@ -33,6 +41,11 @@ def parse_date_string(date_str: str):
                 return datetime.strptime(date_str, fmt)
             except ValueError:
                 continue
+        try:
+            # full timestamps, e.g. sent by the pos write buffer
+            return datetime.fromisoformat(date_str)
+        except ValueError:
+            pass
 
         raise ValueError(f"Unsupported date format: {date_str}")
     except (ValueError, TypeError) as e:
@@ -144,6 +157,122 @@ def edit_menu_item(request):
         return Response({'success': False, 'error': str(e)}, status=500)
 
 
+@api_view(['POST'])
+def menu_price_simulation(request):
+    """
+    What-if menu prices, nothing is saved.
+    body: lists of profit_margins, sales_forecasts, rent_factors, labor_factors and optional menu_ids
+    """
+    grid = {}
+    try:
+        for key, convert in (('profit_margins', float), ('sales_forecasts', int), ('rent_factors', float),
+                             ('labor_factors', float), ('menu_ids', int)):
+            values = request.data.get(key)
+            if values in (None, '', []):
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            grid[key] = [convert(value) for value in values]
+    except (ValueError, TypeError) as e:
+        return Response({'success': False, 'error': f'Invalid grid value: {e}'}, status=400)
+    try:
+        rows = cafe_manager.simulate_menu_prices(**grid)
+        return Response({'success': True, 'rows': rows})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['GET'])
+def cost_allocation(request):
+    """Indirect costs per period. query params: from_date, to_date (exclusive), period (day/week/month/year)"""
+    try:
+        from_date = parse_date_string(request.query_params.get('from_date'))
+        to_date = parse_date_string(request.query_params.get('to_date'))
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    period = request.query_params.get('period') or 'month'
+    if from_date is None or to_date is None or to_date <= from_date:
+        return Response({'success': False, 'error': 'from_date before to_date is required'}, status=400)
+    if period not in ('day', 'week', 'month', 'year'):
+        return Response({'success': False, 'error': 'Invalid period'}, status=400)
+    try:
+        rows = cafe_manager.get_cost_allocation(from_date, to_date, period=period)
+        return Response({'success': True, 'rows': rows})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['POST'])
+def run_payroll(request):
+    """Monthly payroll run. body: year, month"""
+    try:
+        year = int(request.data.get('year'))
+        month = int(request.data.get('month'))
+    except (ValueError, TypeError):
+        return Response({'success': False, 'error': 'year and month are required'}, status=400)
+    if not 1 <= month <= 12:
+        return Response({'success': False, 'error': 'Invalid month'}, status=400)
+    try:
+        payments = cafe_manager.run_monthly_payroll(year, month)
+        if payments is None:
+            return Response({'success': False, 'error': 'Could not run payroll'}, status=500)
+        return Response({'success': True, 'payments': payments})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['POST'])
+def plan_staffing(request):
+    """
+    Estimated labor of the shifts in a window from forecasted demand.
+    body: from_date, to_date (exclusive), optional capacities {position: items per hour}, min_staff
+    """
+    try:
+        from_date = parse_date_string(request.data.get('from_date'))
+        to_date = parse_date_string(request.data.get('to_date'))
+        min_staff = int(request.data.get('min_staff', 1))
+        capacities = request.data.get('capacities')
+        if capacities is not None:
+            capacities = {str(name): float(capacity) for name, capacity in dict(capacities).items()}
+    except (ValueError, TypeError) as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    if from_date is None or to_date is None or to_date <= from_date:
+        return Response({'success': False, 'error': 'from_date before to_date is required'}, status=400)
+    try:
+        plan = cafe_manager.plan_staffing(from_date, to_date, capacities=capacities, min_staff=min_staff)
+        if plan is None:
+            return Response({'success': False, 'error': 'Could not save the staffing plan'}, status=500)
+        return Response({'success': True, 'shifts': plan})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['POST'])
+def import_time_clock(request):
+    """
+    Badge reader export as work records. Either a csv upload 'file' or text field 'csv',
+    columns personal_id, time and optional direction (in/out). source names the export (default the file name),
+    sending the same source again continues after its checkpoint.
+    """
+    sheet = request.FILES.get('file') if hasattr(request, 'FILES') else None
+    source = request.data.get('source') or (sheet.name if sheet is not None else None)
+    if not source:
+        return Response({'success': False, 'error': 'source is required'}, status=400)
+    if sheet is not None:
+        lines = codecs.iterdecode(sheet, 'utf-8-sig')
+    elif request.data.get('csv'):
+        lines = io.StringIO(request.data['csv'])
+    else:
+        return Response({'success': False, 'error': 'time clock csv is empty'}, status=400)
+    try:
+        summary = cafe_manager.import_time_clock(source, lines)
+        if summary is None:
+            return Response({'success': False, 'error': 'Could not save the work records'}, status=500)
+        return Response({'success': True, **summary})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
 @api_view(['GET'])
 def inventory_items(request):
     try:
@@ -153,6 +282,98 @@ def inventory_items(request):
         return Response({'success': False, 'error': str(e)}, status=500)
 
 
+@api_view(['GET'])
+def inventory_alerts(request):
+    """
+    Reorder alerts with suggested order quantities.
+    query params: all=1 (every item, not only alerts), cycle_days, refresh=1 (skip cache)
+    """
+    try:
+        only_alerts = request.query_params.get('all') not in ('1', 'true')
+        cycle_days = float(request.query_params.get('cycle_days') or DEFAULT_CYCLE_DAYS)
+    except (ValueError, TypeError):
+        return Response({'success': False, 'error': 'Invalid cycle_days value'}, status=400)
+
+    cache_key = f"inventory-alerts:{int(only_alerts)}:{cycle_days}"
+    try:
+        items = None if request.query_params.get('refresh') in ('1', 'true') else cache.get(cache_key)
+        if items is None:
+            items = cafe_manager.get_inventory_alerts(only_alerts=only_alerts, cycle_days=cycle_days)
+            cache.set(cache_key, items, ALERTS_CACHE_SECONDS)
+        return Response({'success': True, 'items': items})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['GET'])
+def inventory_forecast(request):
+    """Stock projection of all items. query param: days (default 14)"""
+    try:
+        days = int(request.query_params.get('days') or 14)
+    except (ValueError, TypeError):
+        return Response({'success': False, 'error': 'Invalid days value'}, status=400)
+    if days <= 0:
+        return Response({'success': False, 'error': 'days must be positive'}, status=400)
+    try:
+        items = cafe_manager.get_inventory_forecast(days=days)
+        return Response({'success': True, 'items': items})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['GET'])
+def inventory_as_of(request):
+    """End of day stock of all items. query param: date"""
+    try:
+        day = parse_date_string(request.query_params.get('date'))
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    if day is None:
+        return Response({'success': False, 'error': 'date is required'}, status=400)
+    try:
+        items = cafe_manager.get_inventory_as_of(day)
+        return Response({'success': True, 'items': items})
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+
+
+@api_view(['POST'])
+def inventory_stocktake(request):
+    """
+    Bulk manual count. Either a CSV sheet (file upload 'file' or text field 'csv')
+    with columns inventory_id or name, and amount; or JSON {'items': [{'inventory_id'|'name', 'amount'}]}.
+    Also: reporter (required), date, reason.
+    """
+    data = request.data
+    reporter = data.get('reporter')
+    if not reporter:
+        return Response({'success': False, 'error': 'reporter is required'}, status=400)
+    try:
+        date = parse_date_string(data.get('date') or None)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+
+    sheet = request.FILES.get('file') if hasattr(request, 'FILES') else None
+    if sheet is not None:
+        rows = list(csv.DictReader(io.StringIO(sheet.read().decode('utf-8-sig'))))
+    elif data.get('csv'):
+        rows = list(csv.DictReader(io.StringIO(data['csv'])))
+    else:
+        rows = data.get('items') or []
+    if not rows:
+        return Response({'success': False, 'error': 'stocktake sheet is empty'}, status=400)
+
+    try:
+        report = cafe_manager.import_stocktake(rows, reporter=reporter, date=date, reason=data.get('reason'))
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+    if report is None:
+        return Response({'success': False, 'error': 'Could not save the stocktake'}, status=500)
+    return Response({'success': True, 'report': report})
+
+
 @api_view(['POST'])
 def create_inventory_item(request):
     data = request.data
@@ -442,18 +663,36 @@ def checked_shipment_info(request):
 
 @api_view(['GET'])
 def get_personal_info(request):
+    """
+    Staff summary, query params: active=all, page, page_size.
+    With personal_id and history (work_records, payments or shifts) one page of that history.
+    """
+    params = request.query_params
+    try:
+        page = int(params.get('page') or 1)
+        page_size = int(params.get('page_size') or 50)
+    except (ValueError, TypeError):
+        return Response({'success': False, 'error': 'Invalid page value'}, status=400)
+    if page < 1 or not 1 <= page_size <= 500:
+        return Response({'success': False, 'error': 'Invalid page value'}, status=400)
     try:
+        if params.get('history'):
+            try:
+                personal_id = int(params.get('personal_id'))
+            except (ValueError, TypeError):
+                return Response({'success': False, 'error': 'personal_id is required'}, status=400)
+            data = cafe_manager.serialization_personal_history(personal_id, params['history'],
+                                                               page=page, page_size=page_size)
+            if data is None:
+                return Response({'success': False, 'error': 'Invalid history'}, status=400)
+            return Response({'success': True, **data}, status=200)
+
         f = None
-        params = request.query_params
         if 'active' in params and params['active'] == "all":
             f = "all"
 
-        data = cafe_manager.serialization_personal(f = f)
-        if data:
-            return Response({'success': True, 'personal': data}, status=200)
-
-        else:
-            return Response({'success': False, 'error': 'Could not get personal info'}, status=500)
+        data = cafe_manager.serialization_personal(f=f, page=page, page_size=page_size)
+        return Response({'success': True, 'personal': data, 'page': page, 'page_size': page_size}, status=200)
 
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=500)
@@ -533,12 +772,17 @@ def edit_personal_info(request):
 
 @api_view(['GET'])
 def get_shift_planning(request):
+    """Shift plan with labor costs. query params: period (week/month), date (any day in it, default today)"""
+    period = request.query_params.get('period') or 'week'
     try:
-        data = cafe_manager.serialization_shifts_plan()
-        if data:
-            return Response(data['success': True, 'personal': data], status=200)
-        else:
-            return Response({'success': False, 'error': 'Could not get shift planning info'}, status=500)
+        date = parse_date_string(request.query_params.get('date'))
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    if period not in ('week', 'month'):
+        return Response({'success': False, 'error': 'Invalid period'}, status=400)
+    try:
+        data = cafe_manager.serialization_shifts_plan(period=period, date=date)
+        return Response({'success': True, **data}, status=200)
 
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=500)
@@ -650,12 +894,14 @@ def create_edit_target_salary(request):
 
 @api_view(['GET'])
 def get_target_salary(request):
+    """Salary terms per position. query param: date, the terms in force that day are marked (default today)"""
     try:
-        data = cafe_manager.get_target_salary()
-        if data:
-            return Response({'success': True, 'target_salary_info': data}, status=200)
-        else:
-            return Response({'success': False, 'error': 'Could not get target salary info'}, status=500)
+        date = parse_date_string(request.query_params.get('date'))
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=400)
+    try:
+        data = cafe_manager.get_target_salary(date=date)
+        return Response({'success': True, 'target_salary_info': data}, status=200)
 
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=500)
@@ -791,6 +1037,8 @@ def add_new_sale(request):
             datetime_fields={"date"},
             int_fields={ "quantity", "menu_id", "invoice_id"},
             )
+        if request.headers.get('Idempotency-Key'):
+            kwargs['request_key'] = request.headers['Idempotency-Key']
         added = cafe_manager.add_new_sale(**kwargs)
         if added:
             return Response({'success': True})
@@ -809,12 +1057,60 @@ def add_invoice_payment(request):
             int_fields={"invoice_id"},
             bool_fields={"remain_as_tip"}
             )
+        if request.headers.get('Idempotency-Key'):
+            kwargs['request_key'] = request.headers['Idempotency-Key']
         added = cafe_manager.add_new_invoice_pay(**kwargs)
         if added:
             return Response({'success': True})
         else:
             return Response({'success': False, 'error': 'Could not add new payment'}, status=500)
 
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=500)
+@api_view(["POST"])
+def ingest_pos_batch(request):
+    try:
+        entries = request.data.get('entries')
+        if not isinstance(entries, list):
+            return Response({'success': False, 'error': 'entries list is required'}, status=400)
+
+        # a malformed entry gets its own error result, the rest of the batch still goes in
+        results = [None] * len(entries)
+        cleaned_entries, positions = [], []
+        for position, entry in enumerate(entries):
+            if not isinstance(entry, dict) or not isinstance(entry.get('payload') or {}, dict):
+                results[position] = {'request_key': None, 'kind': None, 'status': 'error',
+                                     'error': 'entry must be an object with a payload object'}
+                continue
+            try:
+                if entry.get('kind') == 'sale':
+                    payload = clear_kwargs(
+                        data=entry.get('payload') or {},
+                        float_fields={"price", "discount"},
+                        datetime_fields={"date"},
+                        int_fields={"quantity", "menu_id", "invoice_id"},
+                    )
+                else:
+                    payload = clear_kwargs(
+                        data=entry.get('payload') or {},
+                        float_fields={"paid", "tip"},
+                        datetime_fields={"date"},
+                        int_fields={"invoice_id"},
+                        bool_fields={"remain_as_tip"},
+                    )
+            except (ValueError, TypeError) as e:
+                results[position] = {'request_key': entry.get('request_key'), 'kind': entry.get('kind'),
+                                     'status': 'error', 'error': str(e)}
+                continue
+            cleaned_entries.append({'request_key': entry.get('request_key'),
+                                    'kind': entry.get('kind'),
+                                    'payload': payload})
+            positions.append(position)
+
+        for position, result in zip(positions, cafe_manager.ingest_pos_batch(cleaned_entries)):
+            results[position] = result
+        return Response({'success': True, 'results': results})
+
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=500)
 @api_view(["GET"])
@@ -11,12 +11,15 @@ from services.hr_service import HRService
 from services.inventory_service import InventoryService
 from services.menu_pricing_service import MenuPriceService
 from services.menu_service import MenuService
+from services.pricing_simulator import PricingSimulator
 from services.sales_service import SalesService
+from services.staffing_optimizer import StaffingOptimizer
 from services.supplier_service import SupplierService
+from services.time_clock import TimeClockImporter
 from services.usage_record_service import OtherUsageService
 from typing import Optional,Union
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from models.cafe_managment_models import *
 
@@ -36,8 +39,11 @@ class CafeManager:
         self.hr = HRService(db_handler=self.db)
         self.inventory = InventoryService(db_handler=self.db)
         self.menu_pricing = MenuPriceService(db_handler=self.db)
+        self.pricing_simulator = PricingSimulator(self.menu_pricing)
         self.menu = MenuService(dbhandler=self.db)
         self.sales = SalesService(db_handler=self.db)
+        self.staffing = StaffingOptimizer(db_handler=self.db)
+        self.time_clock = TimeClockImporter(db_handler=self.db)
         self.supplier = SupplierService(db_handler=self.db)
         self.usage = OtherUsageService(db_handler=self.db)
 
@@ -50,12 +56,12 @@ class CafeManager:
         # This method uses both MenuService and InventoryService
         available_items = []
         serving_menu = self.menu.get_menu_all_available_items()
+        producible = self.inventory.max_producible()
 
         for item in serving_menu:
-            available, missing_items, number_available = self.inventory.check_stock_for_menu(item)
             columns = item.__table__.columns.keys()
             clean_data = {column: getattr(item, column) for column in columns}
-            clean_data['number_available'] = number_available
+            clean_data['number_available'] = producible.get(item.id, 0)
             if item.recipe:
                 clean_data['recipes'] = [
                     {
@@ -149,6 +155,15 @@ class CafeManager:
         return True
 
 
+    def simulate_menu_prices(self, **kwargs) -> list[dict]:
+        """What-if suggested prices for grids of margins, forecasts, rent and labor factors, nothing is saved."""
+        return self.pricing_simulator.simulate(**kwargs)
+
+    def get_cost_allocation(self, from_date: datetime, to_date: datetime, period: str = 'month') -> list[dict]:
+        """Rent, bills and equipment costs prorated into day/week/month/year rows."""
+        allocation = self.menu_pricing.costs.allocate(from_date, to_date, period=period)
+        return allocation.rows() if allocation else []
+
     def get_and_format_inventory(self):
         raw_items = self.inventory.db.get_inventory()
         formatted_items = []
@@ -160,16 +175,65 @@ class CafeManager:
 
         return formatted_items
 
+    def import_stocktake(self, rows: list[dict], reporter: str, date: Optional[datetime] = None,
+                         reason: Optional[str] = None) -> Optional[list[dict]]:
+        """
+        Stocktake sheet rows (inventory_id or name, amount) -> variance report.
+        Raises ValueError naming the bad rows, nothing is written then.
+        """
+        by_name = {item.name: item.id for item in self.inventory.db.get_inventory()}
+        counts = {}
+        errors = []
+        for line, row in enumerate(rows, start=1):
+            inventory_id = row.get('inventory_id')
+            if inventory_id in (None, ''):
+                inventory_id = by_name.get(str(row.get('name') or '').strip().lower())
+            try:
+                inventory_id = int(inventory_id)
+                amount = float(row.get('amount'))
+            except (ValueError, TypeError):
+                errors.append(f"row {line}: unknown item or invalid amount")
+                continue
+            if amount < 0:
+                errors.append(f"row {line}: amount cant be negative")
+            elif inventory_id in counts:
+                errors.append(f"row {line}: item {inventory_id} counted twice")
+            else:
+                counts[inventory_id] = amount
+        if errors:
+            raise ValueError("; ".join(errors))
+        return self.inventory.stocktake(counts, reporter=reporter, date=date, reason=reason)
+
+    def get_inventory_alerts(self, only_alerts: bool = True, cycle_days: float = 7) -> list[dict]:
+        """Items that need reordering with reorder point and suggested order amount."""
+        return self.inventory.reorder_report(only_alerts=only_alerts, cycle_days=cycle_days)
+
+
+    def get_inventory_forecast(self, days: int = 14) -> list[dict]:
+        """Projected stock and stock-out date of every item over the next days."""
+        return self.inventory.forecast_all_inventory(days=days)
+
+
+    def get_inventory_as_of(self, day: datetime) -> list[dict]:
+        """Stock of every item at the end of the given day."""
+        stocks = self.inventory.stock_as_of(datetime.combine(day.date() + timedelta(days=1), datetime.min.time()))
+        return [{'inventory_id': item.id, 'name': item.name, 'unit': item.unit, 'stock': stocks.get(item.id, 0)}
+                for item in self.inventory.db.get_inventory()]
+
 
     def create_new_recipe(self, **kwargs):
-        if self.menu.add_recipe_of_menu_item(**kwargs):
+        added = self.menu.add_recipe_of_menu_item(**kwargs)
+        self.inventory.recipes.invalidate()
+        if added:
             if self.menu_pricing.calculate_update_direct_cost(menu_ids=[kwargs['menu_id']], category='Recipe Change'):
                 return True
 
         return False
 
     def update_remove_recipe(self, **kwargs):
-        if self.menu.change_recipe_of_menu_item(**kwargs):
+        changed = self.menu.change_recipe_of_menu_item(**kwargs)
+        self.inventory.recipes.invalidate()
+        if changed:
             if 'amount' in kwargs and kwargs['amount']:
                 if self.menu_pricing.calculate_update_direct_cost(menu_ids=[kwargs['menu_id']], category='Recipe Change'):
                     return True
@@ -323,6 +387,9 @@ class CafeManager:
             quantity = kwargs['approved'] * order_detail.box_amount
 
             if kwargs['approved'] > 0:
+                # stock and the delivery's lot are written in one transaction
+                unit_cost = order_detail.box_price / order_detail.box_amount \
+                    if order_detail.box_price is not None and order_detail.box_amount else None
                 if not self.inventory.restock_by_inventory_item(
                     inventory_item_id=order_detail.inventory_id,
                      quantity=quantity,
@@ -330,12 +397,16 @@ class CafeManager:
                     date=date,
                     description=f"Mr {order_detail.approver} approved {kwargs['approved']} boxes to be usable",
                     foreign_id = order_detail.id,
+                    unit_cost=unit_cost,
+                    order_detail_id=order_detail.id,
                 ):
                     return None
             elif kwargs['approved'] < 0:
+                # the boxes are taken back out of this delivery's lot, not the oldest one
                 if not self.inventory.deduct_stock_by_inventory_item(
                     inventory_item_id=order_detail.inventory_id,
-                    quantity=quantity,
+                    quantity=-quantity,
+                    order_detail_id=order_detail.id,
                     category="deduct",
                     date=date,
                     description=f"Mr {order_detail.approver} removed approved {kwargs['approved']} boxes from usable",
@@ -344,20 +415,26 @@ class CafeManager:
                     return None
         return order_detail
     #todo check if this later may cause overload for front end
-    def serialization_personal(self, f=None):
+    def serialization_personal(self, f=None, page: int = 1, page_size: int = 50, upcoming_days: int = 7):
+        """
+        One page of staff with this month's hours, last payment and upcoming shifts.
+        Full work, payment and shift histories come from serialization_personal_history.
+        """
+        now = datetime.now()
+        # shifts are dated at midnight, today's shifts count as upcoming all day
+        today = datetime(now.year, now.month, now.day)
+        summaries = self.hr.db.get_personal_summaries(month_start=datetime(now.year, now.month, 1),
+                                                      shifts_from=today,
+                                                      upcoming_until=today + timedelta(days=upcoming_days),
+                                                      active=None if f == "all" else True,
+                                                      row_num=page_size,
+                                                      offset=(page - 1) * page_size)
         serialization = []
-        if f == "all":
-            active= False
-        else:
-            active = True
-        personal = self.hr.db.get_personal(active=active,
-                                           with_shift_records=True,
-                                           with_payments_records=True,
-                                           with_assignments_records=True,)
-        for person in personal:
-            person_info = {
+        for person, month_hr, last_paid_to, last_payment, upcoming_shifts, next_shift in summaries:
+            serialization.append({
                 'personal_id': person.id,
                 'first_name': person.first_name,
+                'last_name': person.last_name,
                 'nationality_code': person.nationality_code,
                 'phone_number': person.phone,
                 'email': person.email,
@@ -368,29 +445,32 @@ class CafeManager:
                 'monthly_payment': person.monthly_payment,
                 "active": person.active,
                 "description": person.description,
-            }
-            persons_work_record = person.shift_record
-            work_record_info = [
-                {
-                    "record_id": record.id,
-                    "from_date": record.from_date,
-                    "to_date": record.to_date,
-                    "lunch": record.lunch,
-                    "service": record.service,
-                    "extra_payment": record.extra_payment,
-                    'description': record.description,
-
-                }
-                for
-                record
-                in
-                persons_work_record
-            ]
-
-            person_info['work_records'] = work_record_info
+                'hours_this_month': month_hr,
+                'last_payment': {'to_date': last_paid_to, 'payment': last_payment} if last_paid_to else None,
+                'upcoming_shifts': upcoming_shifts,
+                'next_shift': next_shift,
+            })
+        return serialization
 
-            person_payments_record = person.payments
-            payments_info = [{
+    def serialization_personal_history(self, personal_id: int, kind: str, page: int = 1, page_size: int = 50) -> Optional[dict]:
+        """One page (newest first) of someone's work_records, payments or shifts."""
+        offset = (page - 1) * page_size
+        # one extra row tells if there is a next page
+        if kind == 'work_records':
+            records = self.hr.db.get_workshiftrecord(personal_id=personal_id, row_num=page_size + 1, offset=offset)
+            items = [{
+                "record_id": record.id,
+                "from_date": record.from_date,
+                "to_date": record.to_date,
+                "worked_hr": record.worked_hr,
+                "lunch": record.lunch_paid,
+                "service": record.service_paid,
+                "extra_payment": record.extra_paid,
+                'description': record.description,
+            } for record in records]
+        elif kind == 'payments':
+            records = self.hr.db.get_recordemployeepayment(personal_id=personal_id, row_num=page_size + 1, offset=offset)
+            items = [{
                 'record_id': record.id,
                 'from_date': record.from_date,
                 "to_date": record.to_date,
@@ -402,26 +482,19 @@ class CafeManager:
                 'extra_hr': record.extra_hr,
                 'extra_expenses': record.extra_expenses,
                 'description': record.description,
-            }
-                             for record in
-                             person_payments_record]
-
-            person_info['payments'] = payments_info
-
-            person_assignments = person.assignments
-            assignments_info = [
-                {
-                    'date': record.shift.date,
-                    'from_hr': record.shift.from_hr,
-                    'to_hr': record.shift.to_hr,
-                }
-                for record in
-                person_assignments
-            ]
-            person_info['asignments'] = assignments_info
-
-            serialization.append(person_info)
-        return serialization
+            } for record in records]
+        elif kind == 'shifts':
+            records = self.hr.db.get_personal_shifts(personal_id, row_num=page_size + 1, offset=offset)
+            items = [{
+                'shift_id': shift.id,
+                'name': shift.name,
+                'date': shift.date,
+                'from_hr': shift.from_hr,
+                'to_hr': shift.to_hr,
+            } for shift in records]
+        else:
+            return None
+        return {'items': items[:page_size], 'page': page, 'page_size': page_size, 'has_more': len(items) > page_size}
 
     def add_new_personal(self, **kwargs):
         valid_params = [
@@ -450,59 +523,23 @@ class CafeManager:
 
 
 
-    def serialization_shifts_plan(self):
-        serialization = []
-
-        shifts = self.hr.db.get_shift()
-
-        for shift in shifts:
-            shift_ifo = {
-                'shift_date': shift.date,
-                'shift_id': shift.id,
-                'from_hr': shift.from_hr,
-                'to_hr': shift.to_hr,
-                'name': shift.name,
-                'description': shift.description,
-                'lunch': shift.lunch,
-                'service': shift.service,
-                'extra_payment': shift.extra_payment,
-            }
-
-            list_labor_info = shift.labor
-
-            shift_estimation = [ {
-                'position': labor.position.position,
-                'number': labor.number,
-                'extra_hr': labor.extra_hr,
-                'from_to_date': f"{labor.position.from_date} to {labor.position.to_date}",
-                'monthly_payment': labor.position.monthly_payment,
-                "monthly_hr": labor.position.monthly_hr,
-                'over_time_payment_hr': labor.position.extra_hr_payment,
-                'category': labor.position.category,
-            }
-                                for labor in
-                                list_labor_info]
-
-            shift_ifo['labor_estimation'] = shift_estimation
-
-
-            assignment_list = shift.assignments
-
-            assignment_info = [
-                {
-                    'name': assignment.personal.name,
-                    'last_name': assignment.personal.last_name,
-                    'position': assignment.position.position,
-
-                }
-                for assignment in assignment_list
-            ]
-
-            shift_ifo['assignment'] = assignment_info
-
-            serialization.append(shift_ifo)
-
-        return serialization
+    def serialization_shifts_plan(self, period: str = 'week', date: Optional[datetime] = None) -> Optional[dict]:
+        """Shift plan of the week (from monday) or month around date, with labor costs and staff."""
+        date = date or datetime.now()
+        day = datetime(date.year, date.month, date.day)
+        if period == 'week':
+            from_date = day - timedelta(days=day.weekday())
+            to_date = from_date + timedelta(days=7)
+        elif period == 'month':
+            from_date = day.replace(day=1)
+            to_date = datetime(from_date.year + from_date.month // 12, from_date.month % 12 + 1, 1)
+        else:
+            return None
+        shifts = self.hr.get_shift_plan(from_date, to_date)
+        return {'from_date': from_date,
+                'to_date': to_date,
+                'labor_cost': round(sum(shift['labor_cost'] for shift in shifts), 2),
+                'shifts': shifts}
 
     def create_the_shift(self, **kwargs):
         update = self.hr.create_shift(**kwargs)
@@ -541,30 +578,38 @@ class CafeManager:
             updated =  self.hr.add_target_position(**kwargs)
         self.menu_pricing.labor_change_update_on_menu_price_record()
         return updated
-    def get_target_salary(self):
-        fetched_data = self.hr.db.get_targetpositionandsalary()
-        list_data = {}
-
-
 
-        for data in fetched_data:
-            data_exist = list_data.get(data.position, None)
-            if not data_exist:
-                list_data[data.position] = []
-            new_data = {
-                'from_date': data.from_date,
-                'to_date': data.to_date if data.to_date else 'current',
-                'category': data.category,
-                'monthly_hr': data.monthly_hr,
-                'monthly_payment': data.monthly_payment,
-                'monthly_insurance': data.monthly_insurance,
-                'extar_hr_payment': data.extra_hr_payment,
-            }
-            list_data[data.position].append(new_data)
+    def get_target_salary(self, date: Optional[datetime] = None) -> dict:
+        """Salary terms grouped by position, oldest first, the ones in force on date (default today) marked."""
+        salaries = self.hr.db.get_position_salary_index()
+        date = date or datetime.now()
+        list_data = {}
+        for position in salaries.positions():
+            current = salaries.resolve(position, date)
+            list_data[position] = [{
+                'id': terms.id,
+                'from_date': terms.from_date,
+                'to_date': terms.to_date if terms.to_date else 'current',
+                'category': terms.category,
+                'monthly_hr': terms.monthly_hr,
+                'monthly_payment': terms.monthly_payment,
+                'monthly_insurance': terms.monthly_insurance,
+                'extar_hr_payment': terms.extra_hr_payment,
+                'in_force': terms == current,
+            } for terms in salaries.history(position)]
+        return list_data
 
+    def run_monthly_payroll(self, year: int, month: int) -> Optional[list[dict]]:
+        """Computes and records the pay of all active personal for the month (rerun replaces it)."""
+        return self.hr.run_payroll(year, month)
 
+    def plan_staffing(self, from_date: datetime, to_date: datetime, **kwargs) -> Optional[list[dict]]:
+        """Staff per shift from forecasted hourly demand, written as estimated labor."""
+        return self.staffing.plan(from_date, to_date, **kwargs)
 
-        return list_data
+    def import_time_clock(self, source: str, lines) -> Optional[dict]:
+        """Badge reader csv -> work records, resumed from the checkpoint of source."""
+        return self.time_clock.ingest(source, lines)
 
     def add_edit_bill(self, **kwargs):
         the_id = kwargs.get("id", None)
@@ -695,28 +740,166 @@ class CafeManager:
 
 
 
-    def add_new_sale(self, **kwargs):
+    def _settle_request_key(self, claimed_key: Optional[IdempotencyKey], success: bool, result_id=None):
+        """marks a claimed request key done, or releases it so a failed request can be retried"""
+        if claimed_key is None:
+            return
+        if success:
+            claimed_key.status = 'done'
+            claimed_key.result_id = result_id
+            self.db.edit_idempotencykey(claimed_key)
+        else:
+            self.db.delete_idempotencykey(claimed_key)
+
+    def _replayed_request_result(self, request_key: str, scope: str) -> bool:
+        """result of a retried request, the first attempt may still be running in another worker"""
+        fetched = self.db.get_idempotencykey(key=request_key, scope=scope)
+        return bool(fetched) and fetched[0].status == 'done'
+
+    def add_new_sale(self, request_key: Optional[str] = None, **kwargs):
+        if request_key and self._replayed_request_result(request_key, "sale"):
+            return True
+
         menu_id = kwargs['menu_id']
         kwargs.pop('menu_id')
         menu_item = self.menu.get_menu_item(menu_id)
-        is_satisfied, missing_items, max_available = self.inventory.check_stock_for_menu(menu_item, kwargs['quantity'])
+        if menu_item is None:
+            return False
+        # stock of the menu's ingredients is read once for the check and the changes
+        stock = self.inventory.stock_for_menu(menu_item)
+        is_satisfied, missing_items, max_available = self.inventory.check_stock_for_menu(menu_item, kwargs['quantity'],
+                                                                                         stock=stock)
+        if not is_satisfied:
+            return False
 
-        if is_satisfied:
+        # sale, stock, lots and the request key go in one transaction, a failure leaves no key behind
+        status, _ = self.sales.record_sale(menu_item,
+                                           stock_changes=self.inventory.stock_changes_for_menu(menu_item,
+                                                                                               kwargs['quantity'],
+                                                                                               stock=stock),
+                                           request_key=request_key,
+                                           valuation_method=self.inventory.valuation_method,
+                                           **kwargs)
+        return status in ('applied', 'duplicate')
+
+    def add_new_invoice_pay(self, request_key: Optional[str] = None, **kwargs):
+        claimed_key = None
+        if request_key:
+            claimed_key = self.db.add_idempotencykey(key=request_key, scope="payment")
+            if claimed_key is None:
+                return self._replayed_request_result(request_key, "payment")
 
-            the_sale = self.sales.process_sale(menu_item, **kwargs)
-            if not the_sale:
-                return False
-            self.inventory.deduct_stock_by_menu(menu_item,
-                                                kwargs['quantity'],
-                                                "sales",
-                                                foreign_id=the_sale.invoice_id,
-                                                date=kwargs['date'],)
-            return True
-        else:
-            return False
+        try:
+            paid = self.sales.add_payment(**kwargs)
+        except Exception:
+            # a key left pending would answer every retry of the payment with 'retry'
+            self._settle_request_key(claimed_key, False)
+            raise
+        self._settle_request_key(claimed_key, bool(paid), kwargs.get('invoice_id'))
+        return paid
+
+    def _invoice_id_of_request(self, request_key: str) -> Optional[int]:
+        """invoice created by an earlier (already synced) sale request"""
+        fetched = self.db.get_idempotencykey(key=request_key, scope="sale", status="done")
+        if not fetched or fetched[0].result_id is None:
+            return None
+        sales = self.db.get_sales(id=fetched[0].result_id)
+        return sales[0].invoice_id if sales else None
+
+    def ingest_pos_batch(self, entries: list[dict]) -> list[dict]:
+        """
+        Applies a batch of buffered terminal writes in order.
+
+        Each entry is {'request_key', 'kind': 'sale' | 'payment', 'payload'}. A payload
+        can point at the invoice of an earlier buffered sale with 'invoice_key'
+        (the request_key of that sale) since offline terminals don't know invoice ids.
+        Every sale is written with its stock deduction, lot costs and request key in one
+        transaction, so an entry that fails leaves nothing behind and its key free for the retry.
+        Stock is pre-checked (prep-aware, check_stock_for_cart) against a running balance of the batch.
+
+        Returns:
+            one result per entry with status applied, duplicate, conflict, retry or error
+        """
+        results = []
+        running_stock = None
+        invoice_by_key = {}
+        menus = {}
+
+        for entry in entries:
+            request_key = entry.get('request_key')
+            kind = entry.get('kind')
+            payload = dict(entry.get('payload') or {})
+            result = {'request_key': request_key, 'kind': kind}
+            results.append(result)
+
+            if kind not in ('sale', 'payment'):
+                result.update(status='error', error=f"Unknown kind: {kind}")
+                continue
+
+            claimed_key = None
+            try:
+                invoice_key = payload.pop('invoice_key', None)
+                if invoice_key:
+                    invoice_id = invoice_by_key.get(invoice_key) or self._invoice_id_of_request(invoice_key)
+                    if invoice_id is None:
+                        result.update(status='conflict', error=f"Unknown invoice_key: {invoice_key}")
+                        continue
+                    payload['invoice_id'] = invoice_id
+
+                if kind == 'sale':
+                    menu_id = payload.pop('menu_id', None)
+                    if menu_id not in menus:
+                        menus[menu_id] = self.menu.get_menu_item(menu_id)
+                    menu_item = menus[menu_id]
+                    if menu_item is None:
+                        result.update(status='conflict', error=f"Unknown menu_id: {menu_id}")
+                        continue
+
+                    if running_stock is None:
+                        running_stock = self.db.get_stock_levels()
+                    cart = {menu_item.id: payload['quantity']}
+                    is_satisfied, missing_items = self.inventory.check_stock_for_cart(cart, running_stock)
+                    if not is_satisfied:
+                        result.update(status='conflict', error="Not enough stock", missing_items=missing_items)
+                        continue
+                    stock_changes = self.inventory.stock_changes_for_menu(menu_item, payload['quantity'], running_stock)
+
+                    status, the_sale = self.sales.record_sale(menu_item,
+                                                              stock_changes=stock_changes,
+                                                              request_key=request_key,
+                                                              valuation_method=self.inventory.valuation_method,
+                                                              **payload)
+                    if status in ('applied', 'duplicate') and the_sale is not None and request_key:
+                        invoice_by_key[request_key] = the_sale.invoice_id
+                    if status == 'applied':
+                        for change in stock_changes:
+                            running_stock[change['inventory_id']] = (running_stock.get(change['inventory_id'], 0)
+                                                                     + change['change_amount'])
+                        result.update(status='applied', invoice_id=the_sale.invoice_id)
+                    elif status == 'conflict':
+                        result.update(status='conflict', error="Sale rejected, stock or invoice changed")
+                    elif status == 'error':
+                        result.update(status='error', error="Sale could not be written")
+                    else:
+                        result['status'] = status
+                else:
+                    if request_key:
+                        claimed_key = self.db.add_idempotencykey(key=request_key, scope=kind)
+                        if claimed_key is None:
+                            # first attempt may still be running in another worker
+                            result['status'] = 'duplicate' if self._replayed_request_result(request_key, kind) else 'retry'
+                            continue
+                    if not self.sales.add_payment(**payload):
+                        self._settle_request_key(claimed_key, False)
+                        result.update(status='conflict', error="Payment rejected")
+                        continue
+                    self._settle_request_key(claimed_key, True, payload.get('invoice_id'))
+                    result.update(status='applied', invoice_id=payload.get('invoice_id'))
+            except Exception as e:
+                self._settle_request_key(claimed_key, False)
+                result.update(status='error', error=str(e))
 
-    def add_new_invoice_pay(self, **kwargs):
-        return self.sales.add_payment(**kwargs)
+        return results
 
     def get_the_invoices_info(self):
         list_data = self.sales.db.get_invoice()
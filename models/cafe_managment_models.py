@@ -1,7 +1,7 @@
 from typing import Union
 
 from sqlalchemy import Column, Integer, String, Float, Date, Boolean, ForeignKey, DateTime, TIMESTAMP, \
-    Time
+    Time, Index
 from sqlalchemy.orm import declarative_base, relationship
 from eralchemy import render_er
 from datetime import datetime, timezone
@@ -22,10 +22,15 @@ class Inventory(Base):
     safety_stock = Column(Float)
     category = Column(String(255))
     price_per_unit = Column(Float)
+    # moving average cost of the units in stock, updated on every supplied lot
+    average_cost = Column(Float)
+    # optimistic locking: updates run as UPDATE ... WHERE version = ?
+    version = Column(Integer, nullable=False, default=1)
 
 
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
+    __mapper_args__ = {"version_id_col": version}
 
     supplier = relationship("Supplier", back_populates="inventory_item", lazy="joined")
     order_details = relationship("OrderDetail", back_populates="inventory_item")
@@ -48,9 +53,51 @@ class InventoryStockRecord(Base):
     manual_report = Column(Float)
     reporter = Column(String)
     description = Column(String(500))
+    # value of the units this row took out of stock (from lots)
+    cost = Column(Float)
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     inventory_item = relationship("Inventory", back_populates="records")
+
+#a supplied delivery, deductions take from the oldest open lot first
+class InventoryLot(Base):
+    __tablename__ = "inventory_lot"
+
+    id = Column(Integer, primary_key=True)
+    inventory_id = Column(ForeignKey('inventory.id'), nullable=False)
+    order_detail_id = Column(ForeignKey('order_detail.id'))
+    received_date = Column(DateTime, nullable=False)
+    quantity = Column(Float, nullable=False)
+    remaining = Column(Float, nullable=False)
+    unit_cost = Column(Float, nullable=False)
+    exhausted = Column(Boolean, nullable=False, default=False)
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # head of the fifo queue of an item is one index seek
+    __table_args__ = (Index('ix_inventory_lot_queue', 'inventory_id', 'exhausted', 'received_date', 'id'),)
+
+#usage rate learned from the ledger, last_record_id is the watermark of the nightly job
+class DailyUsageEstimate(Base):
+    __tablename__ = "daily_usage_estimate"
+
+    inventory_id = Column(ForeignKey('inventory.id'), primary_key=True)
+    usage = Column(Float, nullable=False, default=0)
+    last_day = Column(Date, nullable=False)
+    last_record_id = Column(Integer, nullable=False, default=0)
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+#end of day stock, only for days the item had ledger rows (carry the last one forward)
+class InventoryDailySnapshot(Base):
+    __tablename__ = "inventory_daily_snapshot"
+
+    inventory_id = Column(ForeignKey('inventory.id'), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    stock = Column(Float, nullable=False)
+    last_record_id = Column(Integer, nullable=False, default=0)
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 #done
 class Menu(Base):
     __tablename__ = 'menu'
@@ -64,6 +111,8 @@ class Menu(Base):
     value_added_tax = Column(Float)
     serving = Column(Boolean, default=True)
     description = Column(String(500))
+    # latest EstimatedMenuPriceRecord, kept by DBHandler.add_estimatedmenupricerecord
+    current_estimate_id = Column(Integer)
 
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
@@ -115,6 +164,17 @@ class Recipe(Base):
     menu_item = relationship("Menu", back_populates='recipe', lazy="joined")
     inventory_item = relationship("Inventory", back_populates="recipes", lazy="joined")
 
+#prep items (syrups, batches) are inventory made from other inventory, amount is per one unit of the prep
+class PrepRecipe(Base):
+    __tablename__ = "prep_recipe"
+
+    prep_id = Column(ForeignKey('inventory.id'), primary_key=True)
+    inventory_id = Column(ForeignKey('inventory.id'), primary_key=True)
+    amount_usage = Column(Float, nullable=False)
+    writer = Column(String(100))
+    description = Column(String(500))
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
 #_______________THIS TABLES CAN ADD ITEM TO MY INVENTORY__________________________
 class Supplier(Base):
     __tablename__ = "supplier"
@@ -222,6 +282,9 @@ class InvoicePayment(Base):
 
 
     invoice = relationship("Invoice", back_populates="payments", lazy='joined')
+
+    # ids are never reused, archived rows keep theirs
+    __table_args__ = {'sqlite_autoincrement': True}
 #done
 class Invoice(Base):
     __tablename__ = 'invoice'
@@ -232,9 +295,15 @@ class Invoice(Base):
     total_price = Column(Float)
     closed = Column(Boolean)
     description = Column(String(500))
+    # optimistic locking: updates run as UPDATE ... WHERE version = ?
+    version = Column(Integer, nullable=False, default=1)
 
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
+    __mapper_args__ = {"version_id_col": version}
+    # ids are never reused, archived rows keep theirs
+    __table_args__ = {'sqlite_autoincrement': True}
+
 
     sales = relationship("Sales", back_populates="invoice", lazy="joined")
     payments = relationship("InvoicePayment", back_populates="invoice", lazy="joined")
@@ -258,6 +327,23 @@ class Sales(Base):
     menu_item = relationship("Menu", back_populates="sales")
     invoice = relationship("Invoice", back_populates="sales", lazy="joined")
 
+    # ids are never reused, archived rows keep theirs
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+#dedup of retried client writes (sale/payment) expired rows get purged
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_key'
+
+    # the same client key can be claimed once per scope (a sale and a payment may share it)
+    scope = Column(String(50), primary_key=True)
+    key = Column(String(100), primary_key=True)
+    status = Column(String(20), nullable=False, default='pending')
+    result_id = Column(Integer)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
 #done
 class Usage(Base):
     __tablename__ = 'usage'
@@ -360,20 +446,63 @@ class Shift(Base):
     __tablename__ = "shift"
 
     id = Column(Integer, primary_key=True)
-    date = Column(DateTime)
+    date = Column(DateTime, index=True)
     from_hr = Column(Time)
     to_hr = Column(Time)
     name = Column(String)
     lunch_payment = Column(Float)
     service_payment = Column(Float)
     extra_payment = Column(Float)
+    # cached estimated labor cost, None when it has to be recomputed (DBHandler.get_labor_cost_total)
+    labor_cost = Column(Float)
     description = Column(String(500))
+    # set when the shift is one occurrence of a routine that got overridden or assigned
+    routine_id = Column(ForeignKey("shift_routine.id"), index=True)
 
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
 
     labor = relationship("EstimatedLabor", back_populates="shift", lazy="joined")
     assignments = relationship("PersonalAssignment", back_populates="shift", lazy="joined")
+    routine = relationship("ShiftRoutine", back_populates="shifts")
+
+
+class ShiftRoutine(Base):
+    """Repeating shift, its occurrences are only stored as Shift rows once overridden or assigned"""
+    __tablename__ = "shift_routine"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    from_date = Column(DateTime, nullable=False)
+    # last day of the routine, None repeats without end
+    to_date = Column(DateTime)
+    from_hr = Column(Time, nullable=False)
+    to_hr = Column(Time, nullable=False)
+    # days of week it runs on, Monday = 0 ("01234" weekdays), None every day
+    weekdays = Column(String(7))
+    lunch_payment = Column(Float)
+    service_payment = Column(Float)
+    extra_payment = Column(Float)
+    description = Column(String(500))
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+    shifts = relationship("Shift", back_populates="routine")
+    exceptions = relationship("ShiftRoutineException", back_populates="routine", cascade="all, delete-orphan")
+
+
+class ShiftRoutineException(Base):
+    """A day the routine does not run"""
+    __tablename__ = "shift_routine_exception"
+
+    routine_id = Column(ForeignKey("shift_routine.id"), primary_key=True)
+    date = Column(DateTime, primary_key=True)
+    description = Column(String(500))
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    routine = relationship("ShiftRoutine", back_populates="exceptions")
 
 class EstimatedLabor(Base):
     __tablename__ = "estimated_labor"
@@ -478,6 +607,9 @@ class PersonalAssignment(Base):
     position_id = Column(ForeignKey("target_position_and_salary.id"))
     active = Column(Boolean, default=True)
 
+    # the primary key already serves lookups by person, this one serves lookups by shift
+    __table_args__ = (Index('ix_personal_assignment_shift', 'shift_id', 'personal_id'),)
+
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     personal = relationship("Personal", back_populates="assignments", lazy='joined')
@@ -496,6 +628,8 @@ class WorkShiftRecord(Base):
     service_paid = Column(Float)
     extra_paid = Column(Float)
     description = Column(String(500))
+    # assigned shift the record was matched to (time clock imports), None without one
+    shift_id = Column(ForeignKey("shift.id"))
 
     time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
@@ -503,6 +637,26 @@ class WorkShiftRecord(Base):
     personal = relationship("Personal", back_populates="shift_record")
 
 
+class TimeClockCheckpoint(Base):
+    """how far a time clock export (source) has been imported into working_shift_record"""
+    __tablename__ = "time_clock_checkpoint"
+
+    source = Column(String(200), primary_key=True)
+    # csv lines up to this one are done, later ones are read again on the next import
+    line = Column(Integer, nullable=False, default=0)
+
+    time_update = Column(DateTime, default=lambda: datetime.now(timezone.utc),
+                         onupdate=lambda: datetime.now(timezone.utc))
+
+
+class CacheVersion(Base):
+    """counter of a cached view (shift plans), bumped in the same transaction as the writes it depends on"""
+    __tablename__ = "cache_version"
+
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 class RecordEmployeePayment(Base):
     __tablename__ = "record_employee_payment"
 
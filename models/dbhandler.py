@@ -1,32 +1,147 @@
+import os
 from os.path import exists
-from typing import Optional, List, cast, Union
+from typing import Optional, List, cast, Union, Iterator
 
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, and_, or_, bindparam, case, event, func, inspect, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm import sessionmaker, joinedload
-from datetime import time
+from datetime import time, timedelta
+import functools
 import logging
+import threading
 from models.cafe_managment_models import *
+from models.interval_index import IntervalIndex, shift_interval
+from models.labor_cost import labor_cost, shift_hours
+from models.position_salary_index import PositionSalaryIndex
 
 logging.basicConfig(filename='app.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# how many times a write is retried when another worker got there first
+CONFLICT_RETRIES = 5
+# category of the rows compact_inventory_ledger leaves in place of archived ones
+LEDGER_SUMMARY_CATEGORY = "daily summary"
+
+
+# CacheVersion row of the shift plans cached by HRService.get_shift_plan
+SHIFT_PLAN_CACHE = "shift_plan"
+# CacheVersion row of the recipe matrix cached by RecipeMatrixCache
+RECIPE_CACHE = "recipe"
+
+
+def bumps_cache(name: str):
+    """
+    Writes to tables a cached view is built from: every commit they make also bumps the
+    CacheVersion `name`, in the same transaction, so the cached copies of all workers go stale.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            writes = self._cache_writes.__dict__.setdefault('depth', {})
+            writes[name] = writes.get(name, 0) + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                writes[name] -= 1
+        return wrapper
+    return decorator
+
+
+# shifts, labor, assignments or positions
+changes_shift_plan = bumps_cache(SHIFT_PLAN_CACHE)
+# menu / prep recipes, and menu or inventory rows they point at
+changes_recipes = bumps_cache(RECIPE_CACHE)
+
+
 class DBHandler:
     """
     add - get - edit - delete _tablename
     """
 
-    def __init__(self, db_url="sqlite:///cafe.db", engine=None, session_factory=None):
+    def __init__(self, db_url="sqlite:///cafe.db", engine=None, session_factory=None, archive_dir=None):
         if engine:
             self.engine = engine
         else:
             self.engine = create_engine(db_url)
         Base.metadata.create_all(self.engine)
+        self._upgrade_schema()
 
         if session_factory:
             self.Session = session_factory
         else:
             self.Session = sessionmaker(bind=self.engine)
 
+        # per year sqlite files with closed invoices, sales and payments (None: no archive)
+        self.archive_dir = archive_dir
+        self._archives: dict[int, dict] = {}
+        # cache name -> depth of the bumps_cache writes running in this thread
+        self._cache_writes = threading.local()
+        for name in (SHIFT_PLAN_CACHE, RECIPE_CACHE):
+            self._add_cache_version(name)
+        event.listen(self.Session, 'before_commit', self._bump_cache_version)
+
+    def _upgrade_schema(self) -> None:
+        """
+        create_all only makes missing tables, a database file from before a model got new columns
+        gets them here (ALTER TABLE ADD COLUMN with the column default, filled into existing rows).
+        idempotency_key only holds short lived keys, an old one keyed on key alone is made again.
+        """
+        try:
+            with self.engine.begin() as connection:
+                existing = inspect(connection)
+                if existing.get_pk_constraint('idempotency_key')['constrained_columns'] != ['scope', 'key']:
+                    logging.warning("Recreating idempotency_key with a (scope, key) primary key")
+                    IdempotencyKey.__table__.drop(connection)
+                    IdempotencyKey.__table__.create(connection)
+
+                for table in Base.metadata.sorted_tables:
+                    columns = {column['name'] for column in existing.get_columns(table.name)}
+                    missing = [column for column in table.columns if column.name not in columns]
+                    for column in missing:
+                        default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} " \
+                              f"{column.type.compile(dialect=connection.dialect)}"
+                        if isinstance(default, (bool, int, float)):
+                            ddl += f" NOT NULL DEFAULT {int(default) if isinstance(default, bool) else default}"
+                        connection.exec_driver_sql(ddl)
+                        logging.warning(f"Added column {table.name}.{column.name}")
+                    if missing:
+                        for index in table.indexes:
+                            index.create(connection, checkfirst=True)
+        except Exception as e:
+            logging.error(f"Failed to upgrade the database schema: {e}")
+
+    def _add_cache_version(self, name: str) -> None:
+        with self.Session() as session:
+            try:
+                if session.get(CacheVersion, name) is None:
+                    session.add(CacheVersion(name=name, version=0))
+                    session.commit()
+            except IntegrityError:
+                # another worker created it first
+                session.rollback()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add cache version {name}: {e}")
+
+    def _bump_cache_version(self, session) -> None:
+        names = [name for name, depth in getattr(self._cache_writes, 'depth', {}).items() if depth]
+        if names:
+            session.execute(update(CacheVersion).where(CacheVersion.name.in_(names))
+                            .values(version=CacheVersion.version + 1)
+                            .execution_options(synchronize_session=False))
+
+    def get_cache_version(self, name: str) -> Optional[int]:
+        """current CacheVersion of a cached view, None if it cant be read (dont use the cache then)"""
+        with self.Session() as session:
+            try:
+                return session.query(CacheVersion.version).filter(CacheVersion.name == name).scalar()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read cache version {name}: {e}")
+                return None
+
 
     #--inventory--
     def add_inventory(self, name:str,
@@ -125,6 +240,72 @@ class DBHandler:
                 logging.error(f"Failed to find inventory item(s): {e}")
                 return []
 
+    def get_stock_levels(self, inventory_ids: Optional[list[int]] = None) -> dict[int, float]:
+        """current_stock of every inventory item (or only of inventory_ids) by id, without loading full rows"""
+        with self.Session() as session:
+            try:
+                query = session.query(Inventory.id, Inventory.current_stock)
+                if inventory_ids is not None:
+                    query = query.filter(Inventory.id.in_(inventory_ids))
+                return {inventory_id: current_stock or 0 for inventory_id, current_stock in query}
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read stock levels: {e}")
+                return {}
+
+    def get_inventory_reorder_report(self,
+                                     inventory_ids: Optional[list[int]] = None,
+                                     only_alerts: bool = False,
+                                     cycle_days: float = 7) -> list[dict]:
+        """Reorder point and suggested order amount of every inventory item in one query
+
+        lead_days      = round(supplier.load_time_hr / 24) + 1   (1 without supplier)
+        reorder_point  = safety_stock + lead_days * daily_usage
+        suggested      = reorder_point + cycle_days * daily_usage - current_stock  (not below 0)
+
+        Args:
+            inventory_ids: only these items (all items if None)
+            only_alerts: only items with current_stock <= reorder_point
+            cycle_days: days the next order should cover after it arrives
+
+        Returns:
+            list of dicts, one per item, ordered by name (empty list on failure)
+        """
+        current_stock = func.coalesce(Inventory.current_stock, 0)
+        daily_usage = func.coalesce(Inventory.daily_usage, 0)
+        lead_days = func.round(func.coalesce(Supplier.load_time_hr, 0) / 24.0) + 1
+        reorder_point = func.coalesce(Inventory.safety_stock, 0) + lead_days * daily_usage
+        shortfall = reorder_point + cycle_days * daily_usage - current_stock
+        suggested = case((shortfall > 0, shortfall), else_=0)
+
+        with self.Session() as session:
+            try:
+                query = (session.query(Inventory.id.label('id'),
+                                       Inventory.name.label('name'),
+                                       Inventory.unit.label('unit'),
+                                       current_stock.label('current_stock'),
+                                       Inventory.safety_stock.label('safety_stock'),
+                                       daily_usage.label('daily_usage'),
+                                       Supplier.id.label('supplier_id'),
+                                       Supplier.name.label('supplier_name'),
+                                       lead_days.label('lead_time_days'),
+                                       reorder_point.label('reorder_point'),
+                                       suggested.label('suggested_order'))
+                         .outerjoin(Supplier, Inventory.current_supplier == Supplier.id)
+                         .order_by(Inventory.name))
+                if inventory_ids is not None:
+                    query = query.filter(Inventory.id.in_(inventory_ids))
+                if only_alerts:
+                    query = query.filter(current_stock <= reorder_point)
+
+                result = [dict(row._mapping) for row in query.all()]
+                logging.info(f"Reorder report for {len(result)} inventory items")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to build inventory reorder report: {e}")
+                return []
+
 
     def edit_inventory(self, inventory:Inventory) -> Optional[Inventory]:
         """
@@ -167,13 +348,19 @@ class DBHandler:
                 merged_inventory = session.merge(inventory)
                 session.commit()
                 session.refresh(merged_inventory)
+                inventory.version = merged_inventory.version
                 logging.info(f"Successfully updated inventory item with id: {inventory.id}")
                 return merged_inventory
+            except StaleDataError:
+                session.rollback()
+                logging.warning(f"Inventory item {inventory.id} was changed by another worker, reload and retry")
+                return None
             except Exception as e:
                 session.rollback()
                 logging.error(f"Failed to update inventory item with id: {inventory.id}: {e}")
                 return None
 
+    @changes_recipes
     def delete_inventory(self, inventory: Inventory) -> bool:
         """
         Deletes an inventory item by ID.
@@ -350,6 +537,8 @@ class DBHandler:
                     if not existing:
                         logging.error(f"No menu item found with ID: {menu.id}")
                         return None
+                    # the estimate pointer only moves with new price records
+                    menu.current_estimate_id = existing.current_estimate_id
 
                     existing = session.query(Menu).filter(
                         Menu.id.is_not(menu.id),
@@ -384,6 +573,9 @@ class DBHandler:
 
 
                         if hasattr(obj, 'id') and getattr(obj, 'id', None) is not None:
+                            stored = session.get(Menu, obj.id)
+                            if stored:
+                                obj.current_estimate_id = stored.current_estimate_id
                             existing = session.query(Menu).filter(
                                 Menu.id.is_not(obj.id),
                                 Menu.name.is_(obj.name),
@@ -410,6 +602,7 @@ class DBHandler:
                 logging.error(f"Failed to update objects in session: {e}")
                 return None
 
+    @changes_recipes
     def delete_menu(self, menu: Menu) -> bool:
         """
         Deletes an object Menu.
@@ -487,6 +680,327 @@ class DBHandler:
                 logging.error(f"Failed to add inventory record item to the database: {e}")
                 return None
 
+    def add_inventorystockrecord_batch(self,
+                                       records: list[dict],
+                                       apply_to_stock: bool = False,
+                                       valuation_method: Optional[str] = None) -> list[int]:
+        """
+        Adds many inventory records in one transaction.
+
+        Args:
+            records: dicts with the same keys as add_inventorystockrecord
+            apply_to_stock: also move Inventory.current_stock by the change_amount of the
+                records, as UPDATE ... WHERE current_stock + change >= 0, so two workers
+                cant both take the last units. Versions of the touched rows are bumped.
+            valuation_method: also take the changes out of (or back into) the lots and write
+                their cost, in the same transaction (see _consume_lots). A record with unit_cost
+                (and optional order_detail_id) is a delivery, it adds a lot of its change_amount instead
+
+        Returns:
+            ids of the new records in input order (empty list if any record is
+            invalid, stock is not enough or the insert failed, nothing is written in that case)
+        """
+        if not records:
+            return []
+
+        new_records = []
+        for record in records:
+            manual_report = record.get('manual_report')
+            if manual_report is not None and manual_report < 0:
+                logging.error("manual_report: value cant be negative")
+                return []
+            if record.get('unit_cost') is not None and (not record.get('change_amount') or record['change_amount'] <= 0
+                                                         or record['unit_cost'] < 0):
+                logging.error("Lot quantity must be positive and unit cost not negative")
+                return []
+            category = record.get('category')
+            reporter = record.get('reporter')
+            new_records.append(InventoryStockRecord(
+                inventory_id=record['inventory_id'],
+                category=category.strip().lower() if category is not None else None,
+                foreign_id=record.get('foreign_id'),
+                change_amount=record.get('change_amount'),
+                auto_calculated_amount=record.get('auto_calculated_amount'),
+                manual_report=manual_report,
+                reporter=reporter.strip().lower() if reporter is not None else None,
+                date=record.get('date') or datetime.now(),
+                description=record.get('description'),
+            ))
+
+        inventory_ids = {record.inventory_id for record in new_records}
+        stock_changes = {}
+        if apply_to_stock:
+            for record in new_records:
+                if record.change_amount:
+                    stock_changes[record.inventory_id] = stock_changes.get(record.inventory_id, 0) + record.change_amount
+
+        for attempt in range(CONFLICT_RETRIES):
+            with self.Session() as session:
+                try:
+                    found = session.query(Inventory.id).filter(Inventory.id.in_(inventory_ids)).count()
+                    if found != len(inventory_ids):
+                        logging.error("Inventory ID in batch not found")
+                        return []
+
+                    for inventory_id, change in stock_changes.items():
+                        if not self._apply_stock_change(session, inventory_id, change):
+                            session.rollback()
+                            logging.warning(f"Not enough stock of inventory {inventory_id} for change {change}")
+                            return []
+
+                    session.add_all(new_records)
+                    session.flush()
+                    new_ids = [record.id for record in new_records]
+                    if valuation_method:
+                        for record in records:
+                            if record.get('unit_cost') is not None:
+                                self._add_lot(session, record['inventory_id'], record['change_amount'],
+                                              record['unit_cost'], record.get('date'), record.get('order_detail_id'))
+                        self._consume_lots(session, self._lot_consumptions(new_ids, records), valuation_method)
+                    session.commit()
+                    logging.info(f"{len(new_ids)} inventory records added successfully")
+                    return new_ids
+                except OperationalError as e:
+                    # sqlite "database is locked" and friends, the other writer will be done soon
+                    session.rollback()
+                    logging.warning(f"Inventory record batch hit a locked database (try {attempt + 1}): {e}")
+                except Exception as e:
+                    session.rollback()
+                    logging.error(f"Failed to add inventory record batch to the database: {e}")
+                    return []
+        logging.error("Failed to add inventory record batch, database stayed locked")
+        return []
+
+    def add_stocktake(self, records: list[dict]) -> list[int]:
+        """
+        Writes the manual counts of a stocktake and recalculates the stock of the counted
+        items, all in one transaction.
+
+        Args:
+            records: dicts with inventory_id, manual_report, reporter, date, description
+                     and optional foreign_id
+
+        Returns:
+            ids of the new records (empty list if anything is invalid, nothing is written then)
+        """
+        if not records:
+            return []
+        for record in records:
+            if record.get('manual_report') is None or record['manual_report'] < 0:
+                logging.error("manual_report: value is required and cant be negative")
+                return []
+
+        inventory_ids = {record['inventory_id'] for record in records}
+        with self.Session() as session:
+            try:
+                found = session.query(Inventory.id).filter(Inventory.id.in_(inventory_ids)).count()
+                if found != len(inventory_ids):
+                    logging.error("Inventory ID in stocktake not found")
+                    return []
+
+                new_records = [InventoryStockRecord(
+                    inventory_id=record['inventory_id'],
+                    category="manual check",
+                    foreign_id=record.get('foreign_id'),
+                    manual_report=record['manual_report'],
+                    reporter=record['reporter'].strip().lower() if record.get('reporter') else None,
+                    date=record.get('date') or datetime.now(),
+                    description=record.get('description')) for record in records]
+                session.add_all(new_records)
+                session.flush()
+                new_ids = [record.id for record in new_records]
+                self._recalculate_stock(session, inventory_ids)
+                session.commit()
+                logging.info(f"Stocktake of {len(new_ids)} items added")
+                return new_ids
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add stocktake: {e}")
+                return []
+
+    def recalculate_stock(self, inventory_ids: list[int]) -> bool:
+        """Set-wise version of InventoryService._calculate_inventory for many items."""
+        with self.Session() as session:
+            try:
+                self._recalculate_stock(session, inventory_ids)
+                session.commit()
+                return True
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to recalculate stock: {e}")
+                return False
+
+    @staticmethod
+    def _recalculate_stock(session, inventory_ids) -> None:
+        # stock = latest manual report + changes dated from it on, two grouped queries for all items
+        record = InventoryStockRecord
+        latest = (session.query(record.inventory_id, func.max(record.date).label('date'))
+                  .filter(record.inventory_id.in_(inventory_ids), record.manual_report.isnot(None))
+                  .group_by(record.inventory_id).subquery())
+        base = {}
+        for inventory_id, report_id, manual_report in (
+                session.query(record.inventory_id, record.id, record.manual_report)
+                .join(latest, and_(record.inventory_id == latest.c.inventory_id, record.date == latest.c.date))
+                .filter(record.manual_report.isnot(None))
+                .order_by(record.id)):
+            base[inventory_id] = manual_report
+
+        changes = dict(session.query(record.inventory_id, func.sum(record.change_amount))
+                       .outerjoin(latest, record.inventory_id == latest.c.inventory_id)
+                       .filter(record.inventory_id.in_(inventory_ids),
+                               record.change_amount.isnot(None),
+                               record.manual_report.is_(None),
+                               or_(latest.c.date.is_(None), record.date >= latest.c.date))
+                       .group_by(record.inventory_id)
+                       .all())
+
+        inventory_table = Inventory.__table__
+        session.execute(
+            update(inventory_table)
+            .where(inventory_table.c.id == bindparam('b_id'))
+            .values(current_stock=bindparam('b_stock'), version=inventory_table.c.version + 1),
+            [{'b_id': inventory_id, 'b_stock': (base.get(inventory_id) or 0) + (changes.get(inventory_id) or 0)}
+             for inventory_id in inventory_ids])
+
+    @staticmethod
+    def _apply_stock_change(session, inventory_id: int, change: float) -> bool:
+        """
+        Conditional stock update inside the callers transaction.
+        Returns False when a negative change would take the stock below zero.
+        """
+        new_stock = func.coalesce(Inventory.current_stock, 0) + change
+        stmt = update(Inventory).where(Inventory.id == inventory_id)
+        if change < 0:
+            stmt = stmt.where(new_stock >= 0)
+        result = session.execute(
+            stmt.values(current_stock=new_stock, version=Inventory.version + 1)
+                .execution_options(synchronize_session=False))
+        return result.rowcount == 1
+
+    def compact_inventory_ledger(self, before: datetime, archive_path: str) -> int:
+        """
+        Rolls ledger rows older than `before` into one summary row per item, day and
+        stretch between manual checks, and moves the raw rows to an archive database file.
+
+        Manual checks stay as they are. A summary carries the summed change_amount and cost,
+        dated at its first row, so stock recalculation gives the same result as before.
+        Works day by day, every day in its own transaction. Needs SQLite (ATTACH).
+
+        Args:
+            before: rows dated before this are compacted
+            archive_path: SQLite file the raw rows are moved to (created if missing)
+
+        Returns:
+            number of rows archived, -1 on failure
+        """
+        if self.engine.dialect.name != 'sqlite':
+            logging.error("Ledger archive needs an sqlite database")
+            return -1
+
+        record = InventoryStockRecord
+        columns = [column.name for column in record.__table__.columns]
+        compactable = and_(record.manual_report.is_(None),
+                           or_(record.category.is_(None), record.category != LEDGER_SUMMARY_CATEGORY))
+        archived = 0
+        with self.engine.connect() as connection:
+            attached = False
+            try:
+                connection.exec_driver_sql("ATTACH DATABASE ? AS archive", (archive_path,))
+                attached = True
+                self._prepare_ledger_archive(connection, columns)
+                session = self.Session(bind=connection)
+                days = [day for (day,) in session.query(func.date(record.date)).filter(
+                    record.date < before, compactable).distinct().order_by(func.date(record.date))]
+
+                for day in days:
+                    day_start = datetime.strptime(day, '%Y-%m-%d')
+                    day_end = min(day_start + timedelta(days=1), before)
+                    rows = session.query(record).filter(record.date >= day_start,
+                                                        record.date < day_end).order_by(record.date, record.id).all()
+                    checks: dict[int, list[datetime]] = {}
+                    for row in rows:
+                        if row.manual_report is not None:
+                            checks.setdefault(row.inventory_id, []).append(row.date)
+
+                    summaries: dict[tuple, dict] = {}
+                    moved_ids = []
+                    for row in rows:
+                        if row.manual_report is not None or row.category == LEDGER_SUMMARY_CATEGORY:
+                            continue
+                        stretch = sum(1 for check in checks.get(row.inventory_id, []) if check <= row.date)
+                        summary = summaries.setdefault((row.inventory_id, stretch), {
+                            'inventory_id': row.inventory_id,
+                            'category': LEDGER_SUMMARY_CATEGORY,
+                            'date': row.date,
+                            'change_amount': 0,
+                            'cost': None,
+                            'description': f"{day} compacted"})
+                        summary['change_amount'] += row.change_amount or 0
+                        if row.cost is not None:
+                            summary['cost'] = (summary['cost'] or 0) + row.cost
+                        moved_ids.append(row.id)
+
+                    if not moved_ids:
+                        continue
+                    for chunk_start in range(0, len(moved_ids), 500):
+                        chunk = moved_ids[chunk_start:chunk_start + 500]
+                        placeholders = ", ".join("?" * len(chunk))
+                        column_list = ", ".join(columns)
+                        connection.exec_driver_sql(
+                            f"INSERT INTO archive.inventory_record ({column_list}) "
+                            f"SELECT {column_list} FROM main.inventory_record WHERE id IN ({placeholders})", tuple(chunk))
+                        connection.exec_driver_sql(
+                            f"DELETE FROM main.inventory_record WHERE id IN ({placeholders})", tuple(chunk))
+                    session.bulk_insert_mappings(InventoryStockRecord, list(summaries.values()))
+                    session.commit()
+                    archived += len(moved_ids)
+                    logging.info(f"Compacted {len(moved_ids)} ledger rows of {day} into {len(summaries)}")
+                session.close()
+                return archived
+            except Exception as e:
+                connection.rollback()
+                logging.error(f"Failed to compact inventory ledger: {e}")
+                return -1
+            finally:
+                connection.rollback()
+                # a failed ATTACH must keep its own error, not one of DETACH
+                if attached:
+                    connection.exec_driver_sql("DETACH DATABASE archive")
+
+    @staticmethod
+    def _prepare_ledger_archive(connection, columns: list[str]) -> None:
+        # same columns as the hot table, new ones added to an older archive file
+        connection.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS archive.inventory_record AS SELECT * FROM main.inventory_record WHERE 0")
+        existing = {row[1] for row in connection.exec_driver_sql("PRAGMA archive.table_info(inventory_record)")}
+        for column in columns:
+            if column not in existing:
+                connection.exec_driver_sql(f"ALTER TABLE archive.inventory_record ADD COLUMN {column}")
+        connection.commit()
+
+    def get_archived_inventorystockrecord(self, archive_path: str, inventory_id: Optional[int] = None,
+                                          from_date: Optional[datetime] = None,
+                                          to_date: Optional[datetime] = None) -> list[InventoryStockRecord]:
+        """Raw ledger rows moved to the archive file by compact_inventory_ledger, oldest first."""
+        if not exists(archive_path):
+            return []
+        archive_engine = create_engine(f"sqlite:///{archive_path}")
+        try:
+            with sessionmaker(bind=archive_engine)() as session:
+                query = session.query(InventoryStockRecord).order_by(InventoryStockRecord.date, InventoryStockRecord.id)
+                if inventory_id:
+                    query = query.filter_by(inventory_id=inventory_id)
+                if from_date:
+                    query = query.filter(InventoryStockRecord.date >= from_date)
+                if to_date:
+                    query = query.filter(InventoryStockRecord.date <= to_date)
+                return query.all()
+        except Exception as e:
+            logging.error(f"Failed to read ledger archive: {e}")
+            return []
+        finally:
+            archive_engine.dispose()
+
     def get_inventorystockrecord(
             self,
             id:Optional[int]=None,
@@ -619,6 +1133,421 @@ class DBHandler:
 
 
 
+    #--DailyUsageEstimate--
+    def get_ledger_watermark(self, after_record_id: int = 0, before: Optional[datetime] = None) -> int:
+        """
+        Biggest ledger id that can be processed: every row up to it is dated before `before`.
+        Rows are not always written in date order (offline sales), so this stops at the
+        first row that is still too new instead of skipping it.
+        """
+        with self.Session() as session:
+            try:
+                newest = session.query(func.max(InventoryStockRecord.id)).scalar() or 0
+                if before is None:
+                    return max(newest, after_record_id)
+                too_new = session.query(func.min(InventoryStockRecord.id)).filter(
+                    InventoryStockRecord.id > after_record_id,
+                    InventoryStockRecord.date >= before).scalar()
+                return too_new - 1 if too_new is not None else max(newest, after_record_id)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find inventory ledger watermark: {e}")
+                return after_record_id
+
+    def get_daily_deductions(self, after_record_id: int = 0, up_to_record_id: Optional[int] = None) -> list[dict]:
+        """
+        Stock deductions summed per inventory item and day.
+
+        Args:
+            after_record_id: only ledger rows with a bigger id
+            up_to_record_id: only ledger rows up to this id
+
+        Returns:
+            dicts with inventory_id, day (date) and used (positive amount),
+            ordered by inventory_id and day (empty list on failure)
+        """
+        day = func.date(InventoryStockRecord.date)
+        with self.Session() as session:
+            try:
+                query = (session.query(InventoryStockRecord.inventory_id,
+                                       day.label('day'),
+                                       func.sum(-InventoryStockRecord.change_amount).label('used'))
+                         .filter(InventoryStockRecord.id > after_record_id,
+                                 InventoryStockRecord.change_amount < 0,
+                                 # summaries replace rows that were already counted
+                                 or_(InventoryStockRecord.category.is_(None),
+                                     InventoryStockRecord.category != LEDGER_SUMMARY_CATEGORY))
+                         .group_by(InventoryStockRecord.inventory_id, day)
+                         .order_by(InventoryStockRecord.inventory_id, day))
+                if up_to_record_id is not None:
+                    query = query.filter(InventoryStockRecord.id <= up_to_record_id)
+
+                result = [{'inventory_id': row.inventory_id,
+                           'day': datetime.strptime(row.day, '%Y-%m-%d').date() if isinstance(row.day, str) else row.day,
+                           'used': row.used} for row in query.all()]
+                logging.info(f"Found {len(result)} daily deduction buckets")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to sum daily deductions: {e}")
+                return []
+
+    def get_dailyusageestimate(self, inventory_id: Optional[int] = None) -> list[DailyUsageEstimate]:
+        with self.Session() as session:
+            try:
+                query = session.query(DailyUsageEstimate)
+                if inventory_id:
+                    query = query.filter_by(inventory_id=inventory_id)
+                result = query.all()
+                logging.info(f"Found {len(result)} daily usage estimates")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find daily usage estimate(s): {e}")
+                return []
+
+    def save_daily_usage_estimates(self, estimates: list[dict]) -> bool:
+        """
+        Writes estimates and copies them to Inventory.daily_usage in one transaction,
+        as bulk statements instead of one merge per item.
+
+        Args:
+            estimates: dicts with inventory_id, usage, last_day, last_record_id
+        """
+        if not estimates:
+            return True
+        inventory_table = Inventory.__table__
+        with self.Session() as session:
+            try:
+                existing = {row[0] for row in session.query(DailyUsageEstimate.inventory_id).filter(
+                    DailyUsageEstimate.inventory_id.in_([item['inventory_id'] for item in estimates]))}
+                session.bulk_update_mappings(DailyUsageEstimate,
+                                             [item for item in estimates if item['inventory_id'] in existing])
+                session.bulk_insert_mappings(DailyUsageEstimate,
+                                             [item for item in estimates if item['inventory_id'] not in existing])
+                session.execute(
+                    update(inventory_table)
+                    .where(inventory_table.c.id == bindparam('b_id'))
+                    .values(daily_usage=bindparam('b_usage'), version=inventory_table.c.version + 1),
+                    [{'b_id': item['inventory_id'], 'b_usage': item['usage']} for item in estimates])
+                session.commit()
+                logging.info(f"Saved {len(estimates)} daily usage estimates")
+                return True
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to save daily usage estimates: {e}")
+                return False
+
+
+    #--InventoryDailySnapshot--
+    def get_ledger_movements(self,
+                             from_date: Optional[datetime] = None,
+                             before: Optional[datetime] = None,
+                             inventory_ids: Optional[list[int]] = None,
+                             exclude_inventory_ids: Optional[list[int]] = None) -> list:
+        """
+        Ledger rows in replay order (date, manual reports before changes of the same time, id).
+        Only the columns needed to replay stock, not full InventoryStockRecord objects.
+
+        Args:
+            from_date: rows dated from this (inclusive)
+            before: rows dated before this (exclusive)
+            inventory_ids: only these items
+            exclude_inventory_ids: not these items
+
+        Returns:
+            rows with id, inventory_id, date, change_amount, manual_report (empty list on failure)
+        """
+        with self.Session() as session:
+            try:
+                query = (session.query(InventoryStockRecord.id,
+                                       InventoryStockRecord.inventory_id,
+                                       InventoryStockRecord.date,
+                                       InventoryStockRecord.change_amount,
+                                       InventoryStockRecord.manual_report)
+                         .filter(InventoryStockRecord.date.isnot(None))
+                         .order_by(InventoryStockRecord.date,
+                                   InventoryStockRecord.manual_report.is_(None),
+                                   InventoryStockRecord.id))
+                if from_date:
+                    query = query.filter(InventoryStockRecord.date >= from_date)
+                if before:
+                    query = query.filter(InventoryStockRecord.date < before)
+                if inventory_ids is not None:
+                    query = query.filter(InventoryStockRecord.inventory_id.in_(inventory_ids))
+                if exclude_inventory_ids:
+                    query = query.filter(InventoryStockRecord.inventory_id.notin_(exclude_inventory_ids))
+                return query.all()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read ledger movements: {e}")
+                return []
+
+    def get_earliest_ledger_date(self, after_record_id: int = 0) -> Optional[datetime]:
+        """
+        Oldest date among ledger rows with id bigger than after_record_id.
+        Compaction summaries are left out, they only replace rows with the same total.
+        """
+        with self.Session() as session:
+            try:
+                return session.query(func.min(InventoryStockRecord.date)).filter(
+                    InventoryStockRecord.id > after_record_id,
+                    or_(InventoryStockRecord.category.is_(None),
+                        InventoryStockRecord.category != LEDGER_SUMMARY_CATEGORY)).scalar()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find earliest ledger date: {e}")
+                return None
+
+    def get_snapshot_state(self) -> tuple[Optional[datetime], int]:
+        """Last snapshot day and the biggest ledger id the snapshots were built from."""
+        with self.Session() as session:
+            try:
+                last_day, last_record_id = session.query(func.max(InventoryDailySnapshot.day),
+                                                         func.max(InventoryDailySnapshot.last_record_id)).one()
+                return last_day, last_record_id or 0
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read snapshot state: {e}")
+                return None, 0
+
+    def get_latest_snapshots(self, before_day, inventory_ids: Optional[list[int]] = None) -> list[InventoryDailySnapshot]:
+        """The newest snapshot of each item dated before before_day."""
+        with self.Session() as session:
+            try:
+                latest = (session.query(InventoryDailySnapshot.inventory_id,
+                                        func.max(InventoryDailySnapshot.day).label('day'))
+                          .filter(InventoryDailySnapshot.day < before_day))
+                if inventory_ids is not None:
+                    latest = latest.filter(InventoryDailySnapshot.inventory_id.in_(inventory_ids))
+                latest = latest.group_by(InventoryDailySnapshot.inventory_id).subquery()
+                result = session.query(InventoryDailySnapshot).join(
+                    latest, and_(InventoryDailySnapshot.inventory_id == latest.c.inventory_id,
+                                 InventoryDailySnapshot.day == latest.c.day)).all()
+                logging.info(f"Found {len(result)} latest snapshots")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find latest snapshots: {e}")
+                return []
+
+    def replace_snapshots(self, from_day, snapshots: list[dict]) -> bool:
+        """
+        Deletes snapshots from from_day on and bulk inserts the new ones, in one transaction.
+
+        Args:
+            snapshots: dicts with inventory_id, day, stock, last_record_id
+        """
+        with self.Session() as session:
+            try:
+                session.query(InventoryDailySnapshot).filter(
+                    InventoryDailySnapshot.day >= from_day).delete(synchronize_session=False)
+                session.bulk_insert_mappings(InventoryDailySnapshot, snapshots)
+                session.commit()
+                logging.info(f"Wrote {len(snapshots)} inventory snapshots from {from_day}")
+                return True
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to write inventory snapshots: {e}")
+                return False
+
+
+    #--InventoryLot--
+    def add_inventorylot(self,
+                         inventory_id: int,
+                         quantity: float,
+                         unit_cost: float,
+                         received_date: Optional[datetime] = None,
+                         order_detail_id: Optional[int] = None) -> Optional[InventoryLot]:
+        """
+        Adds a supplied lot and folds it into the items moving average cost, in one transaction.
+
+        average_cost = (units in open lots * old average + quantity * unit_cost) / (units + quantity)
+        """
+        if quantity is None or quantity <= 0 or unit_cost is None or unit_cost < 0:
+            logging.error("Lot quantity must be positive and unit cost not negative")
+            return None
+        with self.Session() as session:
+            try:
+                if not session.get(Inventory, inventory_id):
+                    logging.error(f"Inventory ID {inventory_id} not found")
+                    return None
+                new_lot = self._add_lot(session, inventory_id, quantity, unit_cost, received_date, order_detail_id)
+                session.commit()
+                session.refresh(new_lot)
+                logging.info(f"Lot added for inventory {inventory_id}: {quantity} at {unit_cost}")
+                return new_lot
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add inventory lot: {e}")
+                return None
+
+    @staticmethod
+    def _add_lot(session, inventory_id: int, quantity: float, unit_cost: float,
+                 received_date: Optional[datetime], order_detail_id: Optional[int]) -> InventoryLot:
+        """add_inventorylot inside the callers transaction"""
+        the_item = session.get(Inventory, inventory_id)
+        on_hand = session.query(func.coalesce(func.sum(InventoryLot.remaining), 0)).filter(
+            InventoryLot.inventory_id == inventory_id,
+            InventoryLot.exhausted.is_(False)).scalar()
+        old_average = the_item.average_cost if the_item.average_cost is not None else unit_cost
+        new_average = (on_hand * old_average + quantity * unit_cost) / (on_hand + quantity)
+
+        new_lot = InventoryLot(inventory_id=inventory_id,
+                               order_detail_id=order_detail_id,
+                               received_date=received_date or datetime.now(),
+                               quantity=quantity,
+                               remaining=quantity,
+                               unit_cost=unit_cost)
+        session.add(new_lot)
+        session.execute(update(Inventory).where(Inventory.id == inventory_id)
+                        .values(average_cost=new_average, version=Inventory.version + 1)
+                        .execution_options(synchronize_session=False))
+        return new_lot
+
+    def get_inventorylot(self,
+                         id: Optional[int] = None,
+                         inventory_id: Optional[int] = None,
+                         order_detail_id: Optional[int] = None,
+                         open_only: bool = False,
+                         row_num: Optional[int] = None) -> list[InventoryLot]:
+        """Lots in queue order (oldest first)"""
+        with self.Session() as session:
+            try:
+                query = session.query(InventoryLot).order_by(InventoryLot.received_date, InventoryLot.id)
+                if id:
+                    query = query.filter_by(id=id)
+                if inventory_id:
+                    query = query.filter_by(inventory_id=inventory_id)
+                if order_detail_id:
+                    query = query.filter_by(order_detail_id=order_detail_id)
+                if open_only:
+                    query = query.filter(InventoryLot.exhausted.is_(False))
+                if row_num:
+                    query = query.limit(row_num)
+                result = query.all()
+                logging.info(f"Found {len(result)} inventory lots")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find inventory lot(s): {e}")
+                return []
+
+    @staticmethod
+    def _lot_consumptions(record_ids: list[int], records: list[dict]) -> list[dict]:
+        """_consume_lots input of written ledger rows, a deduction consumes and a return credits"""
+        return [{'record_id': record_id,
+                 'inventory_id': record['inventory_id'],
+                 'quantity': -record['change_amount'],
+                 'order_detail_id': record.get('order_detail_id')}
+                for record_id, record in zip(record_ids, records)
+                if record.get('change_amount') and record.get('unit_cost') is None]
+
+    @staticmethod
+    def _consume_lots(session, consumptions: list[dict], method: str = "fifo") -> dict[int, float]:
+        """
+        Takes deducted units out of the open lots (oldest first) and writes the cost on the ledger rows,
+        inside the callers transaction.
+
+        Only the head of each items queue is read, lot by lot, until the quantity is covered.
+        Units not covered by lots (stock from manual reports) are valued at the average cost,
+        or current_price if the item never had a lot. Negative quantities (units coming back)
+        are credited to the newest lots that still have room, their cost is negative.
+        Every lot write is UPDATE ... WHERE remaining >= taken (or room >= credit), a lot
+        another worker changed in between is read again instead of being overwritten.
+
+        Args:
+            consumptions: dicts with record_id, inventory_id, quantity and optional order_detail_id
+                          (the lot of that delivery is taken first)
+            method: "fifo" charges the cost of the lots taken,
+                    "average" charges quantity * average_cost (lots still shrink oldest first)
+
+        Returns:
+            dict of record id -> cost
+        """
+        lot = InventoryLot.__table__
+        costs = {}
+        for consumption in consumptions:
+            inventory_id = consumption['inventory_id']
+            the_item = session.get(Inventory, inventory_id)
+            fallback_cost = the_item.average_cost if the_item.average_cost is not None \
+                else (the_item.current_price or 0)
+            quantity = consumption['quantity']
+            returned = quantity < 0
+            left = abs(quantity)
+            lots_cost = 0
+            while left > 1e-9:
+                query = session.query(InventoryLot.id, InventoryLot.remaining,
+                                      InventoryLot.quantity, InventoryLot.unit_cost)
+                if returned:
+                    # credit the lots the units most likely came from, newest with room first
+                    head = (query.filter(InventoryLot.inventory_id == inventory_id,
+                                         InventoryLot.remaining < InventoryLot.quantity)
+                            .order_by(InventoryLot.received_date.desc(), InventoryLot.id.desc())
+                            .first())
+                else:
+                    head = None
+                    if consumption.get('order_detail_id'):
+                        head = query.filter(InventoryLot.order_detail_id == consumption['order_detail_id'],
+                                            InventoryLot.inventory_id == inventory_id,
+                                            InventoryLot.exhausted.is_(False)).first()
+                    if head is None:
+                        head = (query.filter(InventoryLot.inventory_id == inventory_id,
+                                             InventoryLot.exhausted.is_(False))
+                                .order_by(InventoryLot.received_date, InventoryLot.id)
+                                .first())
+                if head is None:
+                    break
+                lot_id, remaining, lot_quantity, unit_cost = head
+                if returned:
+                    moved = min(lot_quantity - remaining, left)
+                    stmt = (update(lot).where(lot.c.id == lot_id, lot.c.remaining + moved <= lot.c.quantity)
+                            .values(remaining=lot.c.remaining + moved, exhausted=False))
+                else:
+                    moved = min(remaining, left)
+                    stmt = (update(lot).where(lot.c.id == lot_id, lot.c.remaining >= moved)
+                            .values(remaining=lot.c.remaining - moved,
+                                    exhausted=lot.c.remaining - moved <= 1e-9))
+                if session.execute(stmt).rowcount != 1:
+                    continue
+                lots_cost += moved * unit_cost
+                left -= moved
+
+            if method == "average":
+                cost = abs(quantity) * fallback_cost
+            else:
+                cost = lots_cost + max(left, 0) * fallback_cost
+            costs[consumption['record_id']] = -cost if returned else cost
+
+        if costs:
+            session.execute(update(InventoryStockRecord.__table__)
+                            .where(InventoryStockRecord.__table__.c.id == bindparam('b_id'))
+                            .values(cost=bindparam('b_cost')),
+                            [{'b_id': record_id, 'b_cost': cost} for record_id, cost in costs.items()])
+        return costs
+
+    def get_inventory_valuation(self, method: str = "fifo") -> dict[int, float]:
+        """
+        Value of the units in open lots per inventory item.
+        fifo: sum of remaining * unit_cost, average: remaining units * average_cost
+        """
+        with self.Session() as session:
+            try:
+                if method == "average":
+                    query = (session.query(InventoryLot.inventory_id,
+                                           func.sum(InventoryLot.remaining) * func.max(Inventory.average_cost))
+                             .join(Inventory, Inventory.id == InventoryLot.inventory_id))
+                else:
+                    query = session.query(InventoryLot.inventory_id,
+                                          func.sum(InventoryLot.remaining * InventoryLot.unit_cost))
+                query = query.filter(InventoryLot.exhausted.is_(False)).group_by(InventoryLot.inventory_id)
+                return {inventory_id: value or 0 for inventory_id, value in query.all()}
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to value inventory: {e}")
+                return {}
+
+
     #--EstimatedMenuPriceRecord--
     def add_estimatedmenupricerecord(self,
                  menu_id:int,
@@ -659,7 +1588,8 @@ class DBHandler:
         from_date = from_date if from_date is not None else datetime.now()
         with self.Session() as session:
             try:
-                if not session.get(Menu, menu_id):
+                menu = session.get(Menu, menu_id)
+                if not menu:
                     logging.error(f"Menu ID {menu_id} not found")
                     session.rollback()
                     return None
@@ -677,6 +1607,10 @@ class DBHandler:
                     category=category,
                 )
                 session.add(new_record)
+                session.flush()
+                current = session.get(EstimatedMenuPriceRecord, menu.current_estimate_id) if menu.current_estimate_id else None
+                if current is None or current.from_date <= from_date:
+                    menu.current_estimate_id = new_record.id
                 session.commit()
                 session.refresh(new_record)
                 logging.info("price estimation record added successfully")
@@ -738,6 +1672,89 @@ class DBHandler:
                 logging.error(f"Error fetching records for menu: {str(e)}")
                 return []
 
+    def get_current_estimatedmenupricerecord(self, menu_id: int) -> Optional[EstimatedMenuPriceRecord]:
+        """Latest price estimate of a menu item, read through the menu current_estimate_id pointer"""
+        with self.Session() as session:
+            try:
+                menu = session.get(Menu, menu_id)
+                if not menu:
+                    logging.error(f"Menu ID {menu_id} not found")
+                    return None
+                record = session.get(EstimatedMenuPriceRecord, menu.current_estimate_id) if menu.current_estimate_id else None
+                if record:
+                    return record
+
+                # menu items priced before the pointer existed
+                record = session.query(EstimatedMenuPriceRecord).filter_by(menu_id=menu_id).order_by(
+                    EstimatedMenuPriceRecord.from_date.desc(), EstimatedMenuPriceRecord.id.desc()).first()
+                if record:
+                    menu.current_estimate_id = record.id
+                    session.commit()
+                    session.refresh(record)
+                return record
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching current price estimate of menu {menu_id}: {e}")
+                return None
+
+    def get_current_menu_estimates(self, menu_ids: Optional[list[int]] = None) -> list:
+        """
+        Menu items with their current price estimate in one query, newest menu item first.
+
+        Returns:
+            rows of (id, name, current_price, estimated_price, direct_cost, profit_margin),
+            the estimate columns None for an item without estimate
+        """
+        with self.Session() as session:
+            try:
+                # menu items priced before the current_estimate_id pointer fall back to their latest record
+                latest = session.query(EstimatedMenuPriceRecord.id).filter(
+                    EstimatedMenuPriceRecord.menu_id == Menu.id
+                ).order_by(EstimatedMenuPriceRecord.from_date.desc(), EstimatedMenuPriceRecord.id.desc()
+                ).limit(1).correlate(Menu).scalar_subquery()
+                query = session.query(
+                    Menu.id, Menu.name, Menu.current_price, EstimatedMenuPriceRecord.estimated_price,
+                    EstimatedMenuPriceRecord.direct_cost, EstimatedMenuPriceRecord.profit_margin,
+                ).outerjoin(EstimatedMenuPriceRecord,
+                            EstimatedMenuPriceRecord.id == func.coalesce(Menu.current_estimate_id, latest)
+                ).order_by(Menu.time_create.desc())
+                if menu_ids:
+                    query = query.filter(Menu.id.in_(menu_ids))
+                return query.all()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching current menu price estimates: {e}")
+                return []
+
+    def compact_estimatedmenupricerecord(self, before: datetime) -> int:
+        """
+        Thins out price estimates older than before, keeping the last record of each month
+        per menu item. The current estimate of a menu item is never removed.
+
+        Returns:
+            number of deleted records, -1 on error
+        """
+        month = func.strftime('%Y-%m', EstimatedMenuPriceRecord.from_date)
+        with self.Session() as session:
+            try:
+                month_last = session.query(func.max(EstimatedMenuPriceRecord.id)).filter(
+                    EstimatedMenuPriceRecord.from_date < before
+                ).group_by(EstimatedMenuPriceRecord.menu_id, month)
+                current = session.query(Menu.current_estimate_id).filter(Menu.current_estimate_id.is_not(None))
+
+                deleted = session.query(EstimatedMenuPriceRecord).filter(
+                    EstimatedMenuPriceRecord.from_date < before,
+                    EstimatedMenuPriceRecord.id.not_in(month_last.scalar_subquery()),
+                    EstimatedMenuPriceRecord.id.not_in(current.scalar_subquery()),
+                ).delete(synchronize_session=False)
+                session.commit()
+                logging.info(f"Compacted {deleted} price estimation records before {before}")
+                return deleted
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to compact price estimation records: {e}")
+                return -1
+
     def edit_estimatedmenupricerecord(self, price_estimation_record:EstimatedMenuPriceRecord) -> Optional[EstimatedMenuPriceRecord]:
         """
         Updates an existing price estimation record in the database.
@@ -786,6 +1803,12 @@ class DBHandler:
                     logging.warning(f"No price estimation record found with id: {price_estimation_record.id}")
                     return False
                 session.delete(record)
+                menu = session.get(Menu, record.menu_id) if record.menu_id else None
+                if menu and menu.current_estimate_id == record.id:
+                    session.flush()
+                    previous = session.query(EstimatedMenuPriceRecord.id).filter_by(menu_id=record.menu_id).order_by(
+                        EstimatedMenuPriceRecord.from_date.desc(), EstimatedMenuPriceRecord.id.desc()).first()
+                    menu.current_estimate_id = previous[0] if previous else None
                 session.commit()
                 logging.info(f"Deleted price estimation record with id: {price_estimation_record.id}")
                 return True
@@ -798,6 +1821,7 @@ class DBHandler:
 
 
     #--Recipe--
+    @changes_recipes
     def add_recipe(self,
                  inventory_id:int,
                  menu_id:int,
@@ -879,6 +1903,7 @@ class DBHandler:
 
 
 
+    @changes_recipes
     def edit_recipe(self, recipe:Recipe) -> Optional[Recipe]:
         """
         Updates an existing recipe in the database.
@@ -911,39 +1936,152 @@ class DBHandler:
                     return None
                 merged_record  = session.merge(recipe)
                 session.commit()
-                session.refresh(merged_record )
-                logging.info(f"Successfully updated recipe with ids: {(recipe.inventory_id, recipe.menu_id)}")
+                session.refresh(merged_record )
+                logging.info(f"Successfully updated recipe with ids: {(recipe.inventory_id, recipe.menu_id)}")
+                return merged_record
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to update recipe with ids: {(recipe.inventory_id, recipe.menu_id)}: {e}")
+                return None
+
+    @changes_recipes
+    def delete_recipe(self, recipe:Recipe) -> bool:
+        """
+        Deletes a recipe by inventory_id and menu_id.
+        Returns True if deleted, False otherwise.
+        """
+        if not recipe.inventory_id or not recipe.menu_id:
+            logging.error("Cannot edit recipe without a valid ID (inventory, menu).")
+            return False
+        with self.Session() as session:
+
+            try:
+                record_to_delete = session.get(Recipe, (recipe.inventory_id, recipe.menu_id))
+                if record_to_delete:
+                    session.delete(record_to_delete)
+                    session.commit()
+                    logging.info(f"Deleted recipe with id: {(recipe.inventory_id, recipe.menu_id)}")
+                    return True
+                else:
+                    logging.warning(f"Recipe with ids {(recipe.inventory_id, recipe.menu_id)} not found for deletion.")
+                    return False
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to delete recipe {(recipe.inventory_id, recipe.menu_id)}: {e}")
+                return False
+
+    #--PrepRecipe--
+    @changes_recipes
+    def add_preprecipe(self,
+                       prep_id: int,
+                       inventory_id: int,
+                       amount_usage: float,
+                       writer: Optional[str] = None,
+                       description: Optional[str] = None,
+                       ) -> Optional[PrepRecipe]:
+        """ adding an ingredient of a prep item """
+        if amount_usage is None or amount_usage <= 0:
+            logging.error("amount_usage: value must be positive")
+            return None
+        if prep_id == inventory_id:
+            logging.error("A prep item cant be made from itself")
+            return None
+        if writer:
+            writer = writer.lower().strip()
+        with self.Session() as session:
+            try:
+                for the_id in (prep_id, inventory_id):
+                    if not session.get(Inventory, the_id):
+                        logging.error(f"Inventory ID {the_id} not found")
+                        return None
+
+                new_record = PrepRecipe(prep_id=prep_id,
+                                        inventory_id=inventory_id,
+                                        amount_usage=amount_usage,
+                                        writer=writer,
+                                        description=description)
+                session.add(new_record)
+                session.commit()
+                session.refresh(new_record)
+                logging.info("Prep recipe added successfully")
+                return new_record
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add prep recipe to the database: {e}")
+                return None
+
+    def get_preprecipe(self,
+                       prep_id: Optional[int] = None,
+                       inventory_id: Optional[int] = None) -> list[PrepRecipe]:
+        with self.Session() as session:
+            try:
+                query = session.query(PrepRecipe).order_by(PrepRecipe.time_create.desc())
+                if prep_id:
+                    query = query.filter_by(prep_id=prep_id)
+                if inventory_id:
+                    query = query.filter_by(inventory_id=inventory_id)
+                result = query.all()
+                logging.info(f"Found {len(result)} prep recipes")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching prep recipe : {str(e)}")
+                return []
+
+    @changes_recipes
+    def edit_preprecipe(self, prep_recipe: PrepRecipe) -> Optional[PrepRecipe]:
+        if prep_recipe.amount_usage is None or prep_recipe.amount_usage <= 0:
+            logging.error("amount_usage: value must be positive")
+            return None
+        with self.Session() as session:
+            try:
+                if not session.get(PrepRecipe, (prep_recipe.prep_id, prep_recipe.inventory_id)):
+                    logging.info(f"No prep recipe found with ID: {(prep_recipe.prep_id, prep_recipe.inventory_id)}")
+                    return None
+                merged_record = session.merge(prep_recipe)
+                session.commit()
+                session.refresh(merged_record)
+                logging.info(f"Successfully updated prep recipe {(prep_recipe.prep_id, prep_recipe.inventory_id)}")
                 return merged_record
             except Exception as e:
                 session.rollback()
-                logging.error(f"Failed to update recipe with ids: {(recipe.inventory_id, recipe.menu_id)}: {e}")
+                logging.error(f"Failed to update prep recipe: {e}")
                 return None
 
-    def delete_recipe(self, recipe:Recipe) -> bool:
-        """
-        Deletes a recipe by inventory_id and menu_id.
-        Returns True if deleted, False otherwise.
-        """
-        if not recipe.inventory_id or not recipe.menu_id:
-            logging.error("Cannot edit recipe without a valid ID (inventory, menu).")
-            return False
+    @changes_recipes
+    def delete_preprecipe(self, prep_recipe: PrepRecipe) -> bool:
         with self.Session() as session:
-
             try:
-                record_to_delete = session.get(Recipe, (recipe.inventory_id, recipe.menu_id))
-                if record_to_delete:
-                    session.delete(record_to_delete)
-                    session.commit()
-                    logging.info(f"Deleted recipe with id: {(recipe.inventory_id, recipe.menu_id)}")
-                    return True
-                else:
-                    logging.warning(f"Recipe with ids {(recipe.inventory_id, recipe.menu_id)} not found for deletion.")
+                record_to_delete = session.get(PrepRecipe, (prep_recipe.prep_id, prep_recipe.inventory_id))
+                if not record_to_delete:
+                    logging.warning(f"Prep recipe {(prep_recipe.prep_id, prep_recipe.inventory_id)} not found for deletion.")
                     return False
+                session.delete(record_to_delete)
+                session.commit()
+                logging.info(f"Deleted prep recipe {(prep_recipe.prep_id, prep_recipe.inventory_id)}")
+                return True
             except Exception as e:
                 session.rollback()
-                logging.error(f"Failed to delete recipe {(recipe.inventory_id, recipe.menu_id)}: {e}")
+                logging.error(f"Failed to delete prep recipe: {e}")
                 return False
 
+    def get_recipe_matrix_rows(self) -> tuple[list, list]:
+        """
+        Plain (menu_id, inventory_id, amount) and (prep_id, inventory_id, amount) rows
+        of all recipes, without loading the joined Menu/Inventory objects.
+        """
+        with self.Session() as session:
+            try:
+                menu_rows = session.query(Recipe.menu_id, Recipe.inventory_id,
+                                          Recipe.inventory_item_amount_usage).all()
+                prep_rows = session.query(PrepRecipe.prep_id, PrepRecipe.inventory_id,
+                                          PrepRecipe.amount_usage).all()
+                return menu_rows, prep_rows
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read recipe rows: {e}")
+                return [], []
+
     #todo load time to time what if it get in 4 hr
     #--Supplier--
     def add_supplier(self,
@@ -1733,6 +2871,39 @@ class DBHandler:
 
 
 
+    def get_open_deliveries(self, until: Optional[datetime] = None) -> list[dict]:
+        """
+        Amounts still to arrive from order details, in inventory units
+        (boxes ordered - approved - rejected, times box_amount).
+
+        Args:
+            until: only deliveries expected before this
+
+        Returns:
+            dicts with inventory_id, expected_delivery_date, amount (empty list on failure)
+        """
+        outstanding = (OrderDetail.boxes_ordered
+                       - func.coalesce(OrderDetail.numbers_of_box_approved, 0)
+                       - func.coalesce(OrderDetail.numbers_of_box_rejected, 0))
+        with self.Session() as session:
+            try:
+                query = (session.query(OrderDetail.inventory_id,
+                                       OrderDetail.expected_delivery_date,
+                                       (outstanding * func.coalesce(OrderDetail.box_amount, 1)).label('amount'))
+                         .filter(outstanding > 0,
+                                 OrderDetail.expected_delivery_date.isnot(None)))
+                if until:
+                    query = query.filter(OrderDetail.expected_delivery_date < until)
+
+                result = [dict(row._mapping) for row in query.all()]
+                logging.info(f"Found {len(result)} open deliveries")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find open deliveries: {e}")
+                return []
+
+
     #--InvoicePayment--
 
     def add_invoicepayment(self,
@@ -1927,6 +3098,127 @@ class DBHandler:
                 return False
 
 
+    #--Invoice archive--
+    ARCHIVED_SALES_TABLES = ('invoice', 'sales', 'invoice_payment')
+
+    def _archive_path(self, year: int) -> str:
+        return os.path.join(self.archive_dir, f"sales_{year}.db")
+
+    def _archive_years(self) -> list[int]:
+        """Years that have an archive file, newest first."""
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return []
+        years = []
+        for file_name in os.listdir(self.archive_dir):
+            name, extension = os.path.splitext(file_name)
+            if extension == '.db' and name.startswith('sales_') and name[len('sales_'):].isdigit():
+                years.append(int(name[len('sales_'):]))
+        return sorted(years, reverse=True)
+
+    def _archive(self, year: int) -> dict:
+        archive = self._archives.get(year)
+        if archive is None:
+            engine = create_engine(f"sqlite:///{self._archive_path(year)}")
+            Base.metadata.create_all(engine, tables=[Base.metadata.tables[name] for name in self.ARCHIVED_SALES_TABLES])
+            archive = {'engine': engine, 'session': sessionmaker(bind=engine), 'until': None}
+            self._archives[year] = archive
+        return archive
+
+    def _archive_session(self, year: int):
+        return self._archive(year)['session']()
+
+    def _archived_until(self, year: int) -> Optional[datetime]:
+        """Newest invoice date in the archive of the year (cached until the next archive run)."""
+        archive = self._archive(year)
+        if archive['until'] is None:
+            with archive['session']() as session:
+                archive['until'] = session.query(func.max(Invoice.date)).scalar() or datetime.min
+        return archive['until']
+
+    def _archive_years_for(self, from_date: Optional[datetime], to_date: Optional[datetime],
+                           lookup_id: Optional[int] = None) -> list[int]:
+        """
+        Archive years a query has to read. Queries without dates stay on the hot database,
+        unless an id was not found there (lookup_id).
+        """
+        years = self._archive_years()
+        if lookup_id:
+            return years
+        if from_date is None and to_date is None:
+            return []
+        return [year for year in years
+                if (to_date is None or year <= to_date.year)
+                and (from_date is None or from_date <= self._archived_until(year))]
+
+    def archive_invoices(self, before: datetime) -> int:
+        """
+        Moves closed invoices dated before `before`, with their sales and payments, out of the
+        hot database into the archive file of their year (one transaction per year).
+        Open invoices stay, whatever their date.
+
+        Returns:
+            number of invoices archived, -1 on failure
+        """
+        if not self.archive_dir or self.engine.dialect.name != 'sqlite':
+            logging.error("Invoice archive needs an archive_dir and an sqlite database")
+            return -1
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        with self.Session() as session:
+            # tables made before AUTOINCREMENT hand out max(id) + 1, the invoice holding the newest
+            # row of such a table stays (until a later run) so an archived id is never given again
+            kept = set()
+            for model, invoice_column in ((Invoice, Invoice.id), (Sales, Sales.invoice_id),
+                                          (InvoicePayment, InvoicePayment.invoice_id)):
+                table_sql = session.connection().exec_driver_sql(
+                    "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (model.__tablename__,)).scalar()
+                if 'AUTOINCREMENT' not in (table_sql or '').upper():
+                    kept.add(session.query(invoice_column).order_by(model.id.desc()).limit(1).scalar())
+
+            by_year: dict[int, list[int]] = {}
+            for invoice_id, date in session.query(Invoice.id, Invoice.date).filter(
+                    Invoice.closed.is_(True), Invoice.date < before):
+                if invoice_id not in kept:
+                    by_year.setdefault(date.year, []).append(invoice_id)
+
+        archived = 0
+        for year, invoice_ids in sorted(by_year.items()):
+            self._archive(year)
+            with self.engine.connect() as connection:
+                attached = False
+                try:
+                    connection.exec_driver_sql("ATTACH DATABASE ? AS archive", (self._archive_path(year),))
+                    attached = True
+                    moved = 0
+                    for chunk_start in range(0, len(invoice_ids), 500):
+                        chunk = tuple(invoice_ids[chunk_start:chunk_start + 500])
+                        # an invoice reopened since it was picked stays, every statement checks again
+                        still_closed = f"SELECT id FROM main.invoice WHERE id IN ({', '.join('?' * len(chunk))}) " \
+                                       f"AND closed = 1"
+                        for table_name, key in (('invoice', 'id'), ('sales', 'invoice_id'), ('invoice_payment', 'invoice_id')):
+                            column_list = ", ".join(column.name for column in Base.metadata.tables[table_name].columns)
+                            connection.exec_driver_sql(
+                                f"INSERT INTO archive.{table_name} ({column_list}) SELECT {column_list} "
+                                f"FROM main.{table_name} WHERE {key} IN ({still_closed})", chunk)
+                        for table_name, key in (('sales', 'invoice_id'), ('invoice_payment', 'invoice_id')):
+                            connection.exec_driver_sql(
+                                f"DELETE FROM main.{table_name} WHERE {key} IN ({still_closed})", chunk)
+                        moved += connection.exec_driver_sql(
+                            f"DELETE FROM main.invoice WHERE id IN ({still_closed})", chunk).rowcount
+                    connection.commit()
+                    archived += moved
+                    self._archives[year]['until'] = None
+                    logging.info(f"Archived {moved} invoices of {year}")
+                except Exception as e:
+                    connection.rollback()
+                    logging.error(f"Failed to archive invoices of {year}: {e}")
+                    return -1
+                finally:
+                    if attached:
+                        connection.exec_driver_sql("DETACH DATABASE archive")
+        return archived
+
+
     #--Invoice--
 
     def add_invoice(self,
@@ -1983,49 +3275,60 @@ class DBHandler:
     ) -> list[Invoice]:
         """Get invoice with optional filters
 
-
+        Archived years are read too when the date range reaches them, or when an id
+        is not found in the hot database.
 
         Returns:
             List of matching invoices (empty list if no matches or no filters provided)
         """
+        if saler:
+            saler = saler.lower().strip()
         with self.Session() as session:
                 try:
-                    query = session.query(Invoice).order_by(Invoice.date.desc())
-                    if id:
-                        query = query.filter_by(id=id)
-                    if closed is not None:
-                        query = query.filter_by(closed=closed)
-
                     if pay_id:
                         check = session.get(InvoicePayment, pay_id)
                         if not check:
                             logging.info(f"No ship found with pay_id: {pay_id}")
                             return []
-                        query = query.filter_by(pay_id=pay_id)
-
-                    if saler:
-                        saler = saler.lower().strip()
-                        query = query.filter_by(saler=saler)
-
-                    if from_date:
-                        query = query.filter(Invoice.date >= from_date)
-
-                    if to_date:
-                        query = query.filter(Invoice.date <= to_date)
-
-                    if row_num:
-                        query = query.limit(row_num)
+                    query = self._invoice_query(session, id, saler, pay_id, closed, from_date, to_date, row_num)
 
                     result = query.all()
                     logging.info(f"Found {len(result)} invoices")
-
-                    return cast(List[Invoice], result)
-
                 except Exception as e:
                     session.rollback()
                     logging.error(f"Error fetching invoice(s): {str(e)}")
                     return []
 
+        if closed is False or pay_id:
+            return cast(List[Invoice], result)
+        for year in self._archive_years_for(from_date, to_date, lookup_id=id if id and not result else None):
+            with self._archive_session(year) as session:
+                try:
+                    result += self._invoice_query(session, id, saler, None, closed, from_date, to_date, row_num).all()
+                except Exception as e:
+                    logging.error(f"Error fetching archived invoice(s) of {year}: {str(e)}")
+        result.sort(key=lambda invoice: invoice.date or datetime.min, reverse=True)
+        return cast(List[Invoice], result[:row_num] if row_num else result)
+
+    @staticmethod
+    def _invoice_query(session, id, saler, pay_id, closed, from_date, to_date, row_num):
+        query = session.query(Invoice).order_by(Invoice.date.desc())
+        if id:
+            query = query.filter_by(id=id)
+        if closed is not None:
+            query = query.filter_by(closed=closed)
+        if pay_id:
+            query = query.filter_by(pay_id=pay_id)
+        if saler:
+            query = query.filter_by(saler=saler)
+        if from_date:
+            query = query.filter(Invoice.date >= from_date)
+        if to_date:
+            query = query.filter(Invoice.date <= to_date)
+        if row_num:
+            query = query.limit(row_num)
+        return query
+
 
     def edit_invoice(self, invoice:Invoice) -> Optional[Invoice]:
         """
@@ -2056,8 +3359,13 @@ class DBHandler:
                 merged_invoice  = session.merge(invoice)
                 session.commit()
                 session.refresh(merged_invoice )
+                invoice.version = merged_invoice.version
                 logging.info(f"Successfully updated invoice with ids: {invoice.id}")
                 return merged_invoice
+            except StaleDataError:
+                session.rollback()
+                logging.warning(f"Invoice {invoice.id} was changed by another worker, reload and retry")
+                return None
             except Exception as e:
                 session.rollback()
                 logging.error(f"Failed to update invoice with ids: {invoice.id}: {e}")
@@ -2146,44 +3454,194 @@ class DBHandler:
                 logging.error(f"Failed to add sales to the database: {e}")
                 return None
 
+    def record_sale(self,
+                    menu_id: int,
+                    number: int,
+                    price: float,
+                    stock_changes: list[dict],
+                    discount: Optional[float] = 0,
+                    invoice_id: Optional[int] = None,
+                    saler: Optional[str] = None,
+                    date: Optional[datetime] = None,
+                    description: Optional[str] = None,
+                    category: str = "sales",
+                    request_key: Optional[str] = None,
+                    valuation_method: Optional[str] = "fifo",
+                    key_ttl_hr: float = 24,
+                    ) -> tuple[str, Optional[Sales]]:
+        """
+        Writes a whole sale in one transaction: the request key, a new invoice (when invoice_id is None),
+        the sales row, the invoice total, the stock ledger rows with the guarded stock update and the
+        lot consumption. The key is claimed and settled in the same commit, so a failure anywhere
+        leaves nothing behind and the request can simply be sent again.
+
+        Args:
+            stock_changes: dicts with inventory_id and change_amount (negative) of the sale
+            request_key: client key of the request, a second sale with it is not written
+
+        Returns:
+            (status, sale): 'applied' with the new sale, 'duplicate' with the first sale of the key,
+            'retry' (the key is still being written by another worker), 'conflict' (unknown menu
+            or invoice, not enough stock) or 'error'
+        """
+        if not number or number <= 0 or price is None or price <= 0 or (discount or 0) < 0:
+            logging.error("number and price must be greater than 0, discount cant be negative")
+            return 'error', None
+        if saler:
+            saler = saler.lower().strip()
+        date = date or datetime.now()
+
+        changes: dict[int, float] = {}
+        for change in stock_changes:
+            changes[change['inventory_id']] = changes.get(change['inventory_id'], 0) + change['change_amount']
+
+        for attempt in range(CONFLICT_RETRIES):
+            with self.Session() as session:
+                try:
+                    the_key = None
+                    if request_key:
+                        now = datetime.now()
+                        session.query(IdempotencyKey).filter(IdempotencyKey.scope == "sale",
+                                                             IdempotencyKey.key == request_key,
+                                                             IdempotencyKey.expires_at < now).delete(
+                            synchronize_session=False)
+                        the_key = IdempotencyKey(scope="sale", key=request_key, status='pending',
+                                                 expires_at=now + timedelta(hours=key_ttl_hr))
+                        session.add(the_key)
+                        try:
+                            session.flush()
+                        except IntegrityError:
+                            session.rollback()
+                            existing = session.get(IdempotencyKey, ("sale", request_key))
+                            if existing is None or existing.status != 'done':
+                                return 'retry', None
+                            logging.info(f"sale request {request_key} already applied")
+                            return 'duplicate', session.get(Sales, existing.result_id) if existing.result_id else None
+
+                    if session.get(Menu, menu_id) is None:
+                        session.rollback()
+                        logging.info(f"No menu item found with menu id: {menu_id}")
+                        return 'conflict', None
+                    if invoice_id is None:
+                        the_invoice = Invoice(saler=saler, date=date, closed=False, description=f'Order: {description}')
+                        session.add(the_invoice)
+                        session.flush()
+                    else:
+                        the_invoice = session.get(Invoice, invoice_id)
+                        if the_invoice is None:
+                            session.rollback()
+                            logging.info(f"No invoice found with invoice id: {invoice_id}")
+                            return 'conflict', None
+
+                    the_sale = Sales(menu_id=menu_id, invoice_id=the_invoice.id, number=number,
+                                     discount=discount, price=price)
+                    session.add(the_sale)
+                    session.flush()
+                    full_price, full_discount = session.query(func.coalesce(func.sum(Sales.price), 0),
+                                                              func.coalesce(func.sum(Sales.discount), 0)).filter(
+                        Sales.invoice_id == the_invoice.id).one()
+                    # version checked update, a payment closing the invoice meanwhile means another try
+                    the_invoice.total_price = full_price - full_discount
+                    session.flush()
+
+                    for inventory_id, change in changes.items():
+                        if not self._apply_stock_change(session, inventory_id, change):
+                            session.rollback()
+                            logging.warning(f"Not enough stock of inventory {inventory_id} for change {change}")
+                            return 'conflict', None
+                    new_records = [InventoryStockRecord(inventory_id=change['inventory_id'],
+                                                        category=category,
+                                                        foreign_id=the_invoice.id,
+                                                        change_amount=change['change_amount'],
+                                                        date=date) for change in stock_changes]
+                    session.add_all(new_records)
+                    session.flush()
+                    if valuation_method:
+                        record_ids = [record.id for record in new_records]
+                        self._consume_lots(session, self._lot_consumptions(record_ids, stock_changes), valuation_method)
+
+                    if the_key is not None:
+                        the_key.status = 'done'
+                        the_key.result_id = the_sale.id
+                    session.commit()
+                    session.refresh(the_sale)
+                    logging.info(f"sale {the_sale.id} recorded on invoice {the_sale.invoice_id}")
+                    return 'applied', the_sale
+                except (StaleDataError, OperationalError) as e:
+                    session.rollback()
+                    logging.warning(f"Sale hit a concurrent write (try {attempt + 1}): {e}")
+                except Exception as e:
+                    session.rollback()
+                    logging.error(f"Failed to record sale: {e}")
+                    return 'error', None
+        logging.error("Failed to record sale, the invoice or stock kept changing")
+        return 'retry', None
+
     def get_sales(
             self,
             id: Optional[int] = None,
             menu_id: Optional[int] = None,
             invoice_id: Optional[int] = None,
             row_num: Optional[int] = None,
+            from_date: Optional[datetime] = None,
+            to_date: Optional[datetime] = None,
 
     ) -> list[Sales]:
         """Get sales with optional filters
 
-
+        from_date/to_date filter on the invoice date. Archived years are read too when
+        the date range reaches them, or when an id / invoice_id is not in the hot database.
 
         Returns:
             List of matching Sales (empty list if no matches or no filters provided)
         """
         with self.Session() as session:
                 try:
-                    query = session.query(Sales).order_by(Sales.time_create.desc())
-                    if id:
-                        query = query.filter_by(id=id)
-                    if menu_id:
-                        query = query.filter_by(menu_id=menu_id)
-                    if invoice_id:
-                        query = query.filter_by(invoice_id=invoice_id)
-
-                    if row_num:
-                        query = query.limit(row_num)
-
-                    result = query.all()
+                    result = self._sales_query(session, id, menu_id, invoice_id, row_num, from_date, to_date).all()
                     logging.info(f"Found {len(result)} sales")
-
-                    return cast(List[Sales], result)
-
                 except Exception as e:
                     session.rollback()
                     logging.error(f"Error fetching sales: {str(e)}")
                     return []
 
+        lookup_id = (id or invoice_id) if (id or invoice_id) and not result else None
+        years = self._archive_years_for(from_date, to_date, lookup_id=lookup_id)
+        seen = {sale.id for sale in result}
+        for year in years:
+            with self._archive_session(year) as session:
+                try:
+                    for sale in self._sales_query(session, id, menu_id, invoice_id, row_num, from_date, to_date):
+                        # archive_invoices keeps ids from being reused, a clash means the files were mixed up
+                        if sale.id in seen:
+                            logging.warning(f"Archived sale {sale.id} of {year} has the id of another sale, skipped")
+                            continue
+                        seen.add(sale.id)
+                        result.append(sale)
+                except Exception as e:
+                    logging.error(f"Error fetching archived sales of {year}: {str(e)}")
+        if years:
+            result.sort(key=lambda sale: sale.time_create or datetime.min, reverse=True)
+        return cast(List[Sales], result[:row_num] if row_num else result)
+
+    @staticmethod
+    def _sales_query(session, id, menu_id, invoice_id, row_num, from_date, to_date):
+        query = session.query(Sales).order_by(Sales.time_create.desc())
+        if id:
+            query = query.filter_by(id=id)
+        if menu_id:
+            query = query.filter_by(menu_id=menu_id)
+        if invoice_id:
+            query = query.filter_by(invoice_id=invoice_id)
+        if from_date or to_date:
+            query = query.join(Invoice, Sales.invoice_id == Invoice.id)
+            if from_date:
+                query = query.filter(Invoice.date >= from_date)
+            if to_date:
+                query = query.filter(Invoice.date <= to_date)
+        if row_num:
+            query = query.limit(row_num)
+        return query
+
 
     def edit_sales(self, sales:Sales) -> Optional[Sales]:
         """
@@ -2257,6 +3715,155 @@ class DBHandler:
 
 
 
+    #--IdempotencyKey--
+
+    def add_idempotencykey(self,
+                           key: str,
+                           scope: str,
+                           ttl_hr: float = 24,
+                           ) -> Optional[IdempotencyKey]:
+        """
+        Claims a client request key. The insert itself is the dedup check, so a
+        retried request costs one write and no pre-check query.
+
+        Returns:
+            The new IdempotencyKey row, or None if the key is already claimed
+            (the request is a retry) or an error occurred.
+        """
+        if not key or not scope:
+            logging.error("key and scope are required")
+            return None
+
+        scope = scope.strip().lower()
+        now = datetime.now()
+
+        with self.Session() as session:
+            try:
+                # ttl: expired keys are dropped here so the table stays small
+                session.query(IdempotencyKey).filter(IdempotencyKey.expires_at < now).delete(
+                    synchronize_session=False)
+
+                new_key = IdempotencyKey(
+                    key=key,
+                    scope=scope,
+                    status='pending',
+                    expires_at=now + timedelta(hours=ttl_hr),
+                )
+                session.add(new_key)
+                session.commit()
+                session.refresh(new_key)
+                logging.info(f"idempotency key {key} claimed for {scope}")
+                return new_key
+            except IntegrityError:
+                session.rollback()
+                logging.info(f"idempotency key {key} already claimed, request is a retry")
+                return None
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add idempotency key to the database: {e}")
+                return None
+
+    def get_idempotencykey(self,
+                           key: Optional[str] = None,
+                           scope: Optional[str] = None,
+                           status: Optional[str] = None,
+                           row_num: Optional[int] = None,
+                           ) -> list[IdempotencyKey]:
+        """Get idempotency keys with optional filters
+
+        Returns:
+            List of matching IdempotencyKey (empty list if no matches)
+        """
+        with self.Session() as session:
+            try:
+                query = session.query(IdempotencyKey).order_by(IdempotencyKey.time_create.desc())
+                if key:
+                    query = query.filter_by(key=key)
+                if scope:
+                    query = query.filter_by(scope=scope.strip().lower())
+                if status:
+                    query = query.filter_by(status=status)
+                if row_num:
+                    query = query.limit(row_num)
+
+                result = query.all()
+                logging.info(f"Found {len(result)} idempotency keys")
+                return cast(List[IdempotencyKey], result)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching idempotency keys: {str(e)}")
+                return []
+
+    def edit_idempotencykey(self, idempotency_key: IdempotencyKey) -> Optional[IdempotencyKey]:
+        """
+        Updates an existing idempotency key (status / result_id).
+
+        Returns:
+            The updated IdempotencyKey if successful, None on error.
+        """
+        if not idempotency_key.key or not idempotency_key.scope:
+            logging.error("Cannot edit idempotency key without key and scope")
+            return None
+
+        with self.Session() as session:
+            try:
+                existing = session.get(IdempotencyKey, (idempotency_key.scope, idempotency_key.key))
+                if not existing:
+                    logging.error(f"No idempotency key found: {idempotency_key.key}")
+                    return None
+                merged = session.merge(idempotency_key)
+                session.commit()
+                session.refresh(merged)
+                logging.info(f"Successfully updated idempotency key: {idempotency_key.key}")
+                return merged
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to update idempotency key {idempotency_key.key}: {e}")
+                return None
+
+    def delete_idempotencykey(self, idempotency_key: IdempotencyKey) -> bool:
+        """
+        Releases an idempotency key so the request can be retried.
+        Returns True if deleted, False otherwise.
+        """
+        if not idempotency_key.key or not idempotency_key.scope:
+            logging.error("Cannot delete idempotency key without key and scope")
+            return False
+
+        with self.Session() as session:
+            try:
+                existing = session.get(IdempotencyKey, (idempotency_key.scope, idempotency_key.key))
+                if not existing:
+                    logging.warning(f"No idempotency key found: {idempotency_key.key}")
+                    return False
+                session.delete(existing)
+                session.commit()
+                logging.info(f"Deleted idempotency key: {idempotency_key.key}")
+                return True
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to delete idempotency key {idempotency_key.key}: {e}")
+                return False
+
+    def purge_idempotencykey(self, before: Optional[datetime] = None) -> int:
+        """
+        Deletes keys that expired before the given time (default now).
+        Returns the number of removed keys.
+        """
+        before = before if before is not None else datetime.now()
+        with self.Session() as session:
+            try:
+                removed = session.query(IdempotencyKey).filter(IdempotencyKey.expires_at < before).delete(
+                    synchronize_session=False)
+                session.commit()
+                logging.info(f"Purged {removed} idempotency keys")
+                return removed
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to purge idempotency keys: {e}")
+                return 0
+
+
     #--Usage--
 
     def add_usage(self,
@@ -2898,6 +4505,29 @@ class DBHandler:
 
 
 
+    def get_salesforecast_overlapping(self, from_date: datetime, to_date: datetime) -> list[SalesForecast]:
+        """
+        Sales forecasts with a sell_number that overlap [from_date, to_date), for
+        InventoryService.forecast_ingredient_usage (empty list on failure)
+        """
+        # to_date of a forecast is its last day at midnight, a forecast ending today still counts at noon
+        first_day = datetime.combine(from_date.date(), time.min)
+        with self.Session() as session:
+            try:
+                result = (session.query(SalesForecast)
+                          .filter(SalesForecast.from_date < to_date,
+                                  SalesForecast.to_date >= first_day,
+                                  SalesForecast.sell_number > 0)
+                          .order_by(SalesForecast.from_date)
+                          .all())
+                logging.info(f"Found {len(result)} overlapping sales forecasts")
+                return result
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to find overlapping sales forecasts: {e}")
+                return []
+
+
     #--EstimatedBills--
 
     def add_estimatedbills(self,
@@ -3307,6 +4937,7 @@ class DBHandler:
 
     #--TargetPositionAndSalary--
 
+    @changes_shift_plan
     def add_targetpositionandsalary(self,
                           position: str,
                           from_date: datetime,
@@ -3374,6 +5005,9 @@ class DBHandler:
                     extra_hr_payment=extra_hr_payment,
                 )
                 session.add(new_one)
+                session.flush()
+                # new terms change the rate in force for shifts of the same position
+                self._invalidate_labor_costs(session, position_id=new_one.id)
                 session.commit()
                 session.refresh(new_one)
                 logging.info("added successfully")
@@ -3424,11 +5058,9 @@ class DBHandler:
 
                     if from_date:
                         query = query.filter(TargetPositionAndSalary.from_date >= from_date)
-                        a=len(query.all())
 
                     if to_date:
                         query = query.filter(TargetPositionAndSalary.from_date <= to_date)
-                        b=len(query.all())
 
                     if row_num:
                         query = query.limit(row_num)
@@ -3444,6 +5076,7 @@ class DBHandler:
                     return []
 
 
+    @changes_shift_plan
     def edit_targetpositionandsalary(self,
                                      target_position_and_salary:TargetPositionAndSalary
                                      ) -> Optional[TargetPositionAndSalary]:
@@ -3483,7 +5116,11 @@ class DBHandler:
                     return None
 
 
+                # shifts of the old and of the new position name
+                self._invalidate_labor_costs(session, position_id=target_position_and_salary.id)
                 merged  = session.merge(target_position_and_salary)
+                session.flush()
+                self._invalidate_labor_costs(session, position_id=merged.id)
                 session.commit()
                 session.refresh(merged)
                 logging.info(f"Successfully updated")
@@ -3493,6 +5130,7 @@ class DBHandler:
                 logging.error(f"Failed to update TargetPositionAndSalary : {e}")
                 return None
 
+    @changes_shift_plan
     def delete_targetpositionandsalary(self, target_position_and_salary:TargetPositionAndSalary) -> bool:
         """
         Deletes a Object from the database.
@@ -3508,6 +5146,7 @@ class DBHandler:
             try:
                 obj = session.get(TargetPositionAndSalary, target_position_and_salary.id)
                 if obj:
+                    self._invalidate_labor_costs(session, position_id=obj.id)
                     session.delete(obj)
                     session.commit()
                     logging.info(f"Deleted successfully")
@@ -3527,6 +5166,7 @@ class DBHandler:
 
     #--Shift--
 
+    @changes_shift_plan
     def add_shift(self,
                           date: datetime,
                           from_hr: time,
@@ -3594,72 +5234,54 @@ class DBHandler:
                 logging.error(f"Failed to add Shift to the database: {e}")
                 return None
 
-    def add_routine_shift(self,
-                          routine_list: list[tuple[datetime, time, time]],
-                          name: Optional[str] = None,
-                          lunch_payment: Optional[float] = None,
-                          service_payment: Optional[float] = None,
-                          extra_payment: Optional[float] = None,
-                          description: Optional[str] = None,
-                    ) -> list[Shift]:
-
-        """ adding new record to db  """
-
-        if lunch_payment is not None and lunch_payment < 0:
-            logging.error("Total amount can not be negative")
-            return []
+    def find_shift_conflicts(self, routine_list: list[tuple[datetime, time, time]],
+                             name: Optional[str] = None) -> list[dict]:
+        """
+        Shifts of routine_list that overlap each other or an existing shift of the same name.
 
-        if service_payment is not None and service_payment < 0:
-            logging.error("Total amount can not be negative")
+        Returns:
+            one dict per conflict: index in routine_list and the other index or existing shift id
+        """
+        if name is not None:
+            name = name.lower().strip()
+        if not routine_list:
             return []
 
-        if extra_payment is not None and extra_payment < 0:
-            logging.error("Total amount can not be negative")
-            return []
+        index = IntervalIndex()
+        for number, (date, from_hr, to_hr) in enumerate(routine_list):
+            start, end = shift_interval(date, from_hr, to_hr)
+            index.add(name, start, end, ('new', number))
 
-        if name is not None:
-            name = name.lower().strip()
-        successful_shifts = []
+        days = [date for date, _, _ in routine_list]
+        first_day = datetime.combine(min(days).date(), time()) - timedelta(days=1)
+        last_day = datetime.combine(max(days).date(), time()) + timedelta(days=2)
         with self.Session() as session:
             try:
-                for date, from_hr, to_hr in routine_list:
-
-
-                # existing_overlap = session.query(Shift).filter(
-                #     Shift.date == date,
-                #     Shift.from_hr < to_hr,  # CORRECT - Proper overlap detection
-                #     Shift.to_hr > from_hr  # CORRECT - Check if existing shift ends after new shift starts
-                # ).first()
-                #
-                # if existing_overlap:
-                #     logging.error(f"Time overlap with existing shift ID: {existing_overlap.id}) "
-                #                   f"from {existing_overlap.from_hr} to {existing_overlap.to_hr}")
-                #     return None
-
-
-                    new_one = Shift(
-                        date=date,
-                        from_hr=from_hr,
-                        to_hr=to_hr,
-                        name=name,
-                        lunch_payment=lunch_payment,
-                        service_payment=service_payment,
-                        extra_payment=extra_payment,
-                        description=description,
-                    )
-                    session.add(new_one)
-                    successful_shifts.append(new_one)
-                session.commit()
-                for shift in successful_shifts:
-                    session.refresh(shift)
-                logging.info("added successfully")
-                return successful_shifts
+                existing = session.query(Shift.id, Shift.date, Shift.from_hr, Shift.to_hr).filter(
+                    Shift.name.is_(None) if name is None else Shift.name == name,
+                    Shift.date >= first_day,
+                    Shift.date < last_day,
+                ).all()
             except Exception as e:
                 session.rollback()
-                logging.error(f"Failed to add Shift to the database: {e}")
-                return []
-
-
+                logging.error(f"Failed to read shifts for overlap check: {e}")
+                return [{'index': None, 'error': str(e)}]
+        for shift_id, date, from_hr, to_hr in existing:
+            if date and from_hr and to_hr:
+                start, end = shift_interval(date, from_hr, to_hr)
+                index.add(name, start, end, ('shift', shift_id), new=False)
+        for shift in self.iter_routine_shifts(first_day, last_day - timedelta(days=1)):
+            if shift.name == name:
+                start, end = shift_interval(shift.date, shift.from_hr, shift.to_hr)
+                index.add(name, start, end, ('routine', shift.routine_id), new=False)
+
+        conflicts = []
+        for _, (_, number), (kind, other) in index.conflicts():
+            conflict = {'index': number, 'date': routine_list[number][0],
+                        'from_hr': routine_list[number][1], 'to_hr': routine_list[number][2]}
+            conflict[{'shift': 'shift_id', 'routine': 'routine_id'}.get(kind, 'other_index')] = other
+            conflicts.append(conflict)
+        return conflicts
 
     #problem datetime time hr
     def get_shift(
@@ -3742,6 +5364,47 @@ class DBHandler:
                     return []
 
 
+    def get_shift_plan_rows(self, from_date: datetime, to_date: datetime) -> dict[str, list]:
+        """
+        Plain rows of the shifts dated in [from_date, to_date), no ORM objects are loaded.
+
+        Returns:
+            {'labor': shift columns with their EstimatedLabor and position columns (None without labor),
+             'assignments': (shift_id, personal_id, first_name, last_name, position)}
+        """
+        with self.Session() as session:
+            try:
+                labor = session.query(
+                    Shift.id.label('shift_id'), Shift.date, Shift.from_hr, Shift.to_hr, Shift.name,
+                    Shift.description, Shift.lunch_payment, Shift.service_payment, Shift.extra_payment,
+                    Shift.routine_id, Shift.labor_cost,
+                    EstimatedLabor.position_id, EstimatedLabor.number, EstimatedLabor.extra_hr,
+                    TargetPositionAndSalary.position, TargetPositionAndSalary.category,
+                    TargetPositionAndSalary.from_date.label('position_from_date'),
+                    TargetPositionAndSalary.to_date.label('position_to_date'),
+                    TargetPositionAndSalary.monthly_hr, TargetPositionAndSalary.monthly_payment,
+                    TargetPositionAndSalary.monthly_insurance, TargetPositionAndSalary.extra_hr_payment,
+                ).outerjoin(EstimatedLabor, EstimatedLabor.shift_id == Shift.id
+                ).outerjoin(TargetPositionAndSalary, TargetPositionAndSalary.id == EstimatedLabor.position_id
+                ).filter(Shift.date >= from_date, Shift.date < to_date
+                ).order_by(Shift.date, Shift.from_hr, Shift.id).all()
+
+                assignments = session.query(
+                    PersonalAssignment.shift_id, Personal.id, Personal.first_name, Personal.last_name,
+                    TargetPositionAndSalary.position,
+                ).join(Shift, Shift.id == PersonalAssignment.shift_id
+                ).join(Personal, Personal.id == PersonalAssignment.personal_id
+                ).outerjoin(TargetPositionAndSalary, TargetPositionAndSalary.id == PersonalAssignment.position_id
+                ).filter(Shift.date >= from_date, Shift.date < to_date,
+                         or_(PersonalAssignment.active.is_(None), PersonalAssignment.active.is_(True))
+                ).order_by(PersonalAssignment.shift_id, Personal.id).all()
+                return {'labor': labor, 'assignments': assignments}
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error reading shift plan: {e}")
+                return {'labor': [], 'assignments': []}
+
+    @changes_shift_plan
     def edit_shift(self,
                                      shift:Shift
                                      ) -> Optional[Shift]:
@@ -3782,6 +5445,8 @@ class DBHandler:
                 #     return None
 
 
+                # hours or extra payment may have changed
+                shift.labor_cost = None
                 merged  = session.merge(shift)
                 session.commit()
                 session.refresh(merged)
@@ -3792,6 +5457,7 @@ class DBHandler:
                 logging.error(f"Failed to update Shift : {e}")
                 return None
 
+    @changes_shift_plan
     def delete_shift(self, shift:Shift) -> bool:
         """
         Deletes an Object from the database.
@@ -3823,8 +5489,257 @@ class DBHandler:
     #todo change all from_hr to_hr to from_date to_date as datetime
 
 
+    #--ShiftRoutine--
+    @staticmethod
+    def _routine_runs_on(routine: ShiftRoutine, day) -> bool:
+        if day < routine.from_date.date() or (routine.to_date and day > routine.to_date.date()):
+            return False
+        return not routine.weekdays or str(day.weekday()) in routine.weekdays
+
+    @changes_shift_plan
+    def add_shiftroutine(self,
+                         from_date: datetime,
+                         from_hr: time,
+                         to_hr: time,
+                         to_date: Optional[datetime] = None,
+                         name: Optional[str] = None,
+                         weekdays: Optional[str] = None,
+                         lunch_payment: Optional[float] = None,
+                         service_payment: Optional[float] = None,
+                         extra_payment: Optional[float] = None,
+                         description: Optional[str] = None,
+                         ) -> Optional[ShiftRoutine]:
+        """ adding a repeating shift, from_date to to_date (last day, None for no end) """
+        for amount in (lunch_payment, service_payment, extra_payment):
+            if amount is not None and amount < 0:
+                logging.error("Total amount can not be negative")
+                return None
+        if not from_date or not from_hr or not to_hr:
+            logging.error("from_date, from_hr and to_hr are required")
+            return None
+        from_date = datetime.combine(from_date.date(), time())
+        if to_date is not None:
+            to_date = datetime.combine(to_date.date(), time())
+            if to_date < from_date:
+                logging.error("start date can not be later than end date")
+                return None
+        if weekdays is not None:
+            weekdays = "".join(sorted(set(str(weekdays))))
+            if not weekdays or not set(weekdays) <= set("0123456"):
+                logging.error("weekdays should be digits 0 (Monday) to 6 (Sunday)")
+                return None
+        if name is not None:
+            name = name.lower().strip()
+
+        with self.Session() as session:
+            try:
+                new_one = ShiftRoutine(
+                    name=name,
+                    from_date=from_date,
+                    to_date=to_date,
+                    from_hr=from_hr,
+                    to_hr=to_hr,
+                    weekdays=weekdays,
+                    lunch_payment=lunch_payment,
+                    service_payment=service_payment,
+                    extra_payment=extra_payment,
+                    description=description,
+                )
+                session.add(new_one)
+                session.commit()
+                session.refresh(new_one)
+                logging.info("added successfully")
+                return new_one
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add ShiftRoutine to the database: {e}")
+                return None
+
+    def get_shiftroutine(self,
+                         id: Optional[int] = None,
+                         name: Optional[str] = None,
+                         from_date: Optional[datetime] = None,
+                         to_date: Optional[datetime] = None,
+                         ) -> list[ShiftRoutine]:
+        """Get routines, from_date/to_date keep the ones running some time in that range"""
+        if name is not None:
+            name = name.lower().strip()
+        with self.Session() as session:
+            try:
+                query = session.query(ShiftRoutine).order_by(ShiftRoutine.from_date, ShiftRoutine.from_hr)
+                if id:
+                    query = query.filter_by(id=id)
+                if name:
+                    query = query.filter_by(name=name)
+                if from_date:
+                    query = query.filter(or_(ShiftRoutine.to_date.is_(None),
+                                             ShiftRoutine.to_date >= datetime.combine(from_date.date(), time())))
+                if to_date:
+                    query = query.filter(ShiftRoutine.from_date <= to_date)
+                return cast(list[ShiftRoutine], query.all())
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching ShiftRoutine: {e}")
+                return []
+
+    @changes_shift_plan
+    def edit_shiftroutine(self, routine: ShiftRoutine) -> Optional[ShiftRoutine]:
+        """Changes a routine, occurrences already stored as Shift rows keep their values"""
+        if not routine.id:
+            logging.error("Cannot edit routine without ID")
+            return None
+        if routine.to_date and routine.to_date < routine.from_date:
+            logging.error("start date can not be later than end date")
+            return None
+        with self.Session() as session:
+            try:
+                if not session.get(ShiftRoutine, routine.id):
+                    logging.error(f"No routine found with ID: {routine.id}")
+                    return None
+                merged = session.merge(routine)
+                session.commit()
+                session.refresh(merged)
+                return merged
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to update routine {routine.id}: {e}")
+                return None
+
+    @changes_shift_plan
+    def delete_shiftroutine(self, routine: ShiftRoutine) -> bool:
+        """Deletes a routine and its exceptions, its stored shifts stay as standalone shifts"""
+        with self.Session() as session:
+            try:
+                stored = session.get(ShiftRoutine, routine.id)
+                if not stored:
+                    logging.warning(f"routine with ID {routine.id} not found")
+                    return False
+                session.query(Shift).filter_by(routine_id=routine.id).update(
+                    {Shift.routine_id: None}, synchronize_session=False)
+                session.delete(stored)
+                session.commit()
+                return True
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to delete routine {routine.id}: {e}")
+                return False
+
+    @changes_shift_plan
+    def add_shiftroutineexception(self, routine_id: int, date: datetime,
+                                  description: Optional[str] = None) -> Optional[ShiftRoutineException]:
+        """ the routine does not run on that day """
+        day = datetime.combine(date.date(), time())
+        with self.Session() as session:
+            try:
+                routine = session.get(ShiftRoutine, routine_id)
+                if not routine:
+                    logging.error(f"Routine ID {routine_id} not found")
+                    return None
+                stored = session.query(Shift.id).filter(Shift.routine_id == routine_id, Shift.date >= day,
+                                                        Shift.date < day + timedelta(days=1)).first()
+                if stored:
+                    logging.error(f"Routine {routine_id} has a stored shift {stored.id} on {day:%Y-%m-%d}, delete it instead")
+                    return None
+                if session.get(ShiftRoutineException, (routine_id, day)):
+                    logging.warning(f"Routine {routine_id} already skips {day:%Y-%m-%d}")
+                    return None
+                exception = ShiftRoutineException(routine_id=routine_id, date=day, description=description)
+                session.add(exception)
+                session.commit()
+                session.refresh(exception)
+                return exception
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add routine exception: {e}")
+                return None
+
+    def iter_routine_shifts(self, from_date: datetime, to_date: datetime,
+                            routine_id: Optional[int] = None) -> Iterator[Shift]:
+        """
+        Occurrences of the routines from from_date to to_date (days, inclusive) that are not
+        stored as Shift rows, day by day. They are unsaved Shift objects with routine_id set and no id.
+        """
+        first, last = from_date.date(), to_date.date()
+        with self.Session() as session:
+            try:
+                query = session.query(ShiftRoutine).filter(
+                    ShiftRoutine.from_date < datetime.combine(last, time()) + timedelta(days=1),
+                    or_(ShiftRoutine.to_date.is_(None), ShiftRoutine.to_date >= datetime.combine(first, time())),
+                ).order_by(ShiftRoutine.from_hr, ShiftRoutine.id)
+                if routine_id:
+                    query = query.filter_by(id=routine_id)
+                routines = query.all()
+                ids = [routine.id for routine in routines]
+                window = (datetime.combine(first, time()), datetime.combine(last, time()) + timedelta(days=1))
+                skipped = {(row.routine_id, row.date.date()) for row in session.query(
+                    ShiftRoutineException.routine_id, ShiftRoutineException.date).filter(
+                    ShiftRoutineException.routine_id.in_(ids),
+                    ShiftRoutineException.date >= window[0], ShiftRoutineException.date < window[1])}
+                skipped |= {(row.routine_id, row.date.date()) for row in session.query(
+                    Shift.routine_id, Shift.date).filter(
+                    Shift.routine_id.in_(ids), Shift.date >= window[0], Shift.date < window[1])}
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error reading routines: {e}")
+                return
+
+        day = first
+        while day <= last:
+            for routine in routines:
+                if (routine.id, day) not in skipped and self._routine_runs_on(routine, day):
+                    yield Shift(date=datetime.combine(day, time()),
+                                from_hr=routine.from_hr,
+                                to_hr=routine.to_hr,
+                                name=routine.name,
+                                lunch_payment=routine.lunch_payment,
+                                service_payment=routine.service_payment,
+                                extra_payment=routine.extra_payment,
+                                description=routine.description,
+                                routine_id=routine.id)
+            day += timedelta(days=1)
+
+    @changes_shift_plan
+    def materialize_routine_shift(self, routine_id: int, date: datetime) -> Optional[Shift]:
+        """
+        Stores the routine occurrence of that day as a Shift row, so it can be assigned or changed.
+        Returns the already stored one if there is.
+        """
+        day = datetime.combine(date.date(), time())
+        with self.Session() as session:
+            try:
+                routine = session.get(ShiftRoutine, routine_id)
+                if not routine:
+                    logging.error(f"Routine ID {routine_id} not found")
+                    return None
+                stored = session.query(Shift).filter(Shift.routine_id == routine_id, Shift.date >= day,
+                                                     Shift.date < day + timedelta(days=1)).first()
+                if stored:
+                    return stored
+                if not self._routine_runs_on(routine, day.date()) or session.get(ShiftRoutineException, (routine_id, day)):
+                    logging.error(f"Routine {routine_id} does not run on {day:%Y-%m-%d}")
+                    return None
+                shift = Shift(date=day,
+                              from_hr=routine.from_hr,
+                              to_hr=routine.to_hr,
+                              name=routine.name,
+                              lunch_payment=routine.lunch_payment,
+                              service_payment=routine.service_payment,
+                              extra_payment=routine.extra_payment,
+                              description=routine.description,
+                              routine_id=routine.id)
+                session.add(shift)
+                session.commit()
+                session.refresh(shift)
+                return shift
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to store routine shift: {e}")
+                return None
+
+
     #--EstimatedLabor--
 
+    @changes_shift_plan
     def add_estimatedlabor(self,
                             position_id: int,
                           shift_id: int,
@@ -3856,6 +5771,7 @@ class DBHandler:
                     extra_hr=extra_hr
                 )
                 session.add(new_one)
+                self._invalidate_labor_costs(session, shift_ids=[shift_id])
                 session.commit()
                 session.refresh(new_one)
                 logging.info("added successfully")
@@ -3903,6 +5819,7 @@ class DBHandler:
                     return []
 
 
+    @changes_shift_plan
     def edit_estimatedlabor(self,
                                      labor:EstimatedLabor
                                      ) -> Optional[EstimatedLabor]:
@@ -3930,6 +5847,7 @@ class DBHandler:
                     return None
 
                 merged  = session.merge(labor)
+                self._invalidate_labor_costs(session, shift_ids=[labor.shift_id])
                 session.commit()
                 session.refresh(merged)
                 logging.info(f"Successfully updated")
@@ -3939,6 +5857,7 @@ class DBHandler:
                 logging.error(f"Failed to update EstimatedLabor : {e}")
                 return None
 
+    @changes_shift_plan
     def delete_estimatedlabor(self, labor:EstimatedLabor) -> bool:
         """
         Deletes an Object from the database.
@@ -3955,6 +5874,7 @@ class DBHandler:
                 obj = session.get(EstimatedLabor, key)
                 if obj:
                     session.delete(obj)
+                    self._invalidate_labor_costs(session, shift_ids=[labor.shift_id])
                     session.commit()
                     logging.info(f"Deleted successfully")
                     return True
@@ -3966,6 +5886,142 @@ class DBHandler:
                 logging.error(f"Failed to delete EstimatedLabor {key}: {e}")
                 return False
 
+    @changes_shift_plan
+    def replace_estimatedlabor(self, shift_ids: list[int], rows: list[dict]) -> int:
+        """
+        Replaces the estimated labor of the given shifts with rows
+        ({'shift_id', 'position_id', 'number', 'extra_hr'}) in one bulk write.
+
+        Returns:
+            number of written rows, -1 on error
+        """
+        with self.Session() as session:
+            try:
+                if shift_ids:
+                    session.query(EstimatedLabor).filter(
+                        EstimatedLabor.shift_id.in_(shift_ids)).delete(synchronize_session=False)
+                session.bulk_insert_mappings(EstimatedLabor, rows)
+                self._invalidate_labor_costs(session, shift_ids=list(shift_ids) + [row['shift_id'] for row in rows])
+                session.commit()
+                logging.info(f"Estimated labor of {len(shift_ids)} shifts replaced with {len(rows)} rows")
+                return len(rows)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to replace EstimatedLabor: {e}")
+                return -1
+
+
+    #--Shift labor cost--
+    @staticmethod
+    def _invalidate_labor_costs(session, shift_ids: Optional[list[int]] = None, position_id: Optional[int] = None):
+        """
+        Marks the cached labor_cost of shifts stale, by shift or by position terms.
+        Terms change the rate of every shift staffed with their position, whichever terms the labor points at.
+        """
+        query = session.query(Shift)
+        if shift_ids is not None:
+            query = query.filter(Shift.id.in_(shift_ids))
+        if position_id is not None:
+            same_position = session.query(TargetPositionAndSalary.id).filter(
+                TargetPositionAndSalary.position == session.query(TargetPositionAndSalary.position).filter(
+                    TargetPositionAndSalary.id == position_id).scalar_subquery())
+            query = query.filter(Shift.id.in_(session.query(EstimatedLabor.shift_id).filter(or_(
+                EstimatedLabor.position_id == position_id,
+                EstimatedLabor.position_id.in_(same_position.scalar_subquery())))))
+        query.update({Shift.labor_cost: None}, synchronize_session=False)
+
+    @staticmethod
+    def _position_salary_index(session) -> PositionSalaryIndex:
+        return PositionSalaryIndex(session.query(
+            TargetPositionAndSalary.id, TargetPositionAndSalary.position, TargetPositionAndSalary.category,
+            TargetPositionAndSalary.from_date, TargetPositionAndSalary.to_date,
+            TargetPositionAndSalary.monthly_hr, TargetPositionAndSalary.monthly_payment,
+            TargetPositionAndSalary.monthly_insurance, TargetPositionAndSalary.extra_hr_payment,
+        ).all())
+
+    def get_position_salary_index(self) -> PositionSalaryIndex:
+        """Every TargetPositionAndSalary as an effective dated lookup, read in one query."""
+        with self.Session() as session:
+            try:
+                return self._position_salary_index(session)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error reading position salaries: {e}")
+                return PositionSalaryIndex([])
+
+    def refresh_shift_labor_costs(self, from_date: Optional[datetime] = None, to_date: Optional[datetime] = None) -> int:
+        """
+        Computes labor_cost of the shifts (dated from_date to to_date, inclusive) whose cache is stale.
+        Read and write are one transaction, and only shifts still stale are written: a shift
+        invalidated meanwhile keeps None and is computed again next time.
+
+        Returns:
+            number of refreshed shifts, -1 on error
+        """
+        with self.Session() as session:
+            try:
+                stale = session.query(Shift.id, Shift.date, Shift.from_hr, Shift.to_hr, Shift.extra_payment
+                                      ).filter(Shift.labor_cost.is_(None))
+                if from_date:
+                    stale = stale.filter(Shift.date >= from_date)
+                if to_date:
+                    stale = stale.filter(Shift.date <= to_date)
+                stale_rows = stale.all()
+                if not stale_rows:
+                    return 0
+                costs = {shift_id: [date, shift_hours(from_hr, to_hr), 0.0]
+                         for shift_id, date, from_hr, to_hr, _ in stale_rows}
+                extra_payments = {shift_id: extra_payment or 0.0 for shift_id, _, _, _, extra_payment in stale_rows}
+
+                labor = session.query(
+                    EstimatedLabor.shift_id, EstimatedLabor.position_id, EstimatedLabor.number, EstimatedLabor.extra_hr,
+                ).filter(EstimatedLabor.shift_id.in_(stale.with_entities(Shift.id).scalar_subquery())).all()
+
+                # the rate in force on the shift date, not necessarily the terms the labor row was made with
+                salaries = self._position_salary_index(session)
+                for shift_id, position_id, number, extra_hr in labor:
+                    if shift_id not in costs:
+                        continue
+                    date, hours, _ = costs[shift_id]
+                    terms = salaries.resolve_for(position_id, date)
+                    if terms:
+                        costs[shift_id][2] += labor_cost(hours, number, extra_hr, terms.monthly_hr,
+                                                         terms.monthly_payment, terms.monthly_insurance,
+                                                         terms.extra_hr_payment)
+                # the shift's extra payment is paid once to a staffed shift, an unstaffed one costs nothing
+                for shift_id in {row[0] for row in labor if row[0] in costs}:
+                    costs[shift_id][2] += extra_payments[shift_id]
+
+                shift_table = Shift.__table__
+                session.execute(update(shift_table)
+                                .where(shift_table.c.id == bindparam('b_id'), shift_table.c.labor_cost.is_(None))
+                                .values(labor_cost=bindparam('b_cost')),
+                                [{'b_id': shift_id, 'b_cost': cost} for shift_id, (_, _, cost) in costs.items()])
+                session.commit()
+                logging.info(f"Labor cost of {len(costs)} shifts refreshed")
+                return len(costs)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to refresh shift labor costs: {e}")
+                return -1
+
+    def get_labor_cost_total(self, from_date: Optional[datetime] = None, to_date: Optional[datetime] = None) -> float:
+        """Estimated labor cost of the shifts dated from_date to to_date (inclusive), stale ones recomputed first."""
+        if self.refresh_shift_labor_costs(from_date, to_date) < 0:
+            return 0.0
+        with self.Session() as session:
+            try:
+                query = session.query(func.coalesce(func.sum(Shift.labor_cost), 0.0))
+                if from_date:
+                    query = query.filter(Shift.date >= from_date)
+                if to_date:
+                    query = query.filter(Shift.date <= to_date)
+                return float(query.scalar())
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to sum labor cost: {e}")
+                return 0.0
+
 
     #--Equipment--
 
@@ -4342,6 +6398,78 @@ class DBHandler:
                 logging.error(f"Failed to delete rent {rent.id}: {e}")
                 return False
 
+    #--Cost allocation--
+    def get_indirect_cost_rows(self, from_date: datetime, to_date: datetime) -> dict[str, list]:
+        """
+        Plain rows of rent, estimated bills and equipment whose time range overlaps [from_date, to_date).
+
+        Returns:
+            {'rent': [(from_date, to_date, cost)], 'bills': [(from_date, to_date, cost)],
+             'equipment': [(purchase_date, expire_date, monthly_depreciation)]}
+        """
+        with self.Session() as session:
+            try:
+                rent_cost = func.coalesce(Rent.rent, 0) + func.coalesce(Rent.mortgage, 0) * func.coalesce(Rent.mortgage_percentage_to_rent, 0)
+                rents = session.query(Rent.from_date, Rent.to_date, rent_cost).filter(
+                    Rent.from_date < to_date,
+                    or_(Rent.to_date.is_(None), Rent.to_date > from_date, Rent.from_date >= from_date),
+                ).all()
+                bills = session.query(EstimatedBills.from_date, EstimatedBills.to_date, EstimatedBills.cost).filter(
+                    EstimatedBills.cost.is_not(None),
+                    EstimatedBills.from_date < to_date,
+                    or_(EstimatedBills.to_date.is_(None), EstimatedBills.to_date > from_date,
+                        EstimatedBills.from_date >= from_date),
+                ).all()
+                equipment = session.query(Equipment.purchase_date, Equipment.expire_date,
+                                          Equipment.monthly_depreciation).filter(
+                    Equipment.monthly_depreciation.is_not(None),
+                    Equipment.purchase_date < to_date,
+                    or_(Equipment.expire_date.is_(None), Equipment.expire_date > from_date),
+                ).all()
+                return {'rent': rents, 'bills': bills, 'equipment': equipment}
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read indirect cost rows: {e}")
+                return {'rent': [], 'bills': [], 'equipment': []}
+
+    #--Staffing demand--
+    def get_hourly_sales(self, from_date: datetime, to_date: datetime) -> list[tuple[int, int, float]]:
+        """
+        Sold items in [from_date, to_date) grouped by weekday (0 = Monday) and hour of the invoice.
+
+        Returns:
+            rows of (weekday, hour, items)
+        """
+        with self.Session() as session:
+            try:
+                weekday = func.strftime('%w', Invoice.date)
+                hour = func.strftime('%H', Invoice.date)
+                rows = session.query(weekday, hour, func.sum(func.coalesce(Sales.number, 0))
+                                     ).join(Sales, Sales.invoice_id == Invoice.id).filter(
+                    Invoice.date >= from_date,
+                    Invoice.date < to_date,
+                ).group_by(weekday, hour).all()
+                # sqlite counts weekdays from sunday
+                return [((int(day) - 1) % 7, int(hr), float(items or 0)) for day, hr, items in rows]
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read hourly sales: {e}")
+                return []
+
+    def get_forecast_rows(self, from_date: datetime, to_date: datetime) -> list[tuple[datetime, datetime, int]]:
+        """Plain (from_date, to_date, sell_number) of sales forecasts overlapping [from_date, to_date)."""
+        with self.Session() as session:
+            try:
+                return session.query(SalesForecast.from_date, SalesForecast.to_date, SalesForecast.sell_number).filter(
+                    SalesForecast.sell_number.is_not(None),
+                    SalesForecast.from_date < to_date,
+                    SalesForecast.to_date > from_date,
+                ).all()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read sales forecast rows: {e}")
+                return []
+
 
 
 
@@ -4422,6 +6550,7 @@ class DBHandler:
             to_date: Optional[datetime] = None,
             active: Optional[bool] = None,
             row_num: Optional[int] = None,
+            offset: Optional[int] = None,
             with_payments_records: bool = False,
             with_shift_records: bool = False,
             with_assignments_records: bool = False,
@@ -4487,6 +6616,8 @@ class DBHandler:
 
                     if row_num:
                         query = query.limit(row_num)
+                    if offset:
+                        query = query.offset(offset)
 
                     result = query.all()
                     logging.info(f"Found {len(result)}")
@@ -4499,6 +6630,75 @@ class DBHandler:
                     return []
 
 
+    def get_personal_summaries(self,
+                               month_start: datetime,
+                               shifts_from: datetime,
+                               upcoming_until: datetime,
+                               active: Optional[bool] = None,
+                               row_num: Optional[int] = None,
+                               offset: Optional[int] = None,
+                               ) -> list:
+        """
+        Personal with aggregates computed in grouped subqueries.
+
+        Returns:
+            rows of (Personal, hours worked since month_start, last payment to_date,
+                     last payment amount, shifts dated shifts_from to upcoming_until, next shift date)
+            Shift.date is the day (midnight), pass the start of today to count today's shifts.
+        """
+        with self.Session() as session:
+            try:
+                hours = session.query(
+                    WorkShiftRecord.personal_id.label('personal_id'),
+                    func.sum(WorkShiftRecord.worked_hr).label('worked_hr'),
+                ).filter(WorkShiftRecord.from_date >= month_start).group_by(WorkShiftRecord.personal_id).subquery()
+
+                last_paid = session.query(
+                    RecordEmployeePayment.personal_id.label('personal_id'),
+                    func.max(RecordEmployeePayment.to_date).label('to_date'),
+                ).group_by(RecordEmployeePayment.personal_id).subquery()
+                last_payment = session.query(
+                    RecordEmployeePayment.personal_id.label('personal_id'),
+                    last_paid.c.to_date.label('to_date'),
+                    func.max(RecordEmployeePayment.payment).label('payment'),
+                ).join(last_paid, and_(last_paid.c.personal_id == RecordEmployeePayment.personal_id,
+                                       last_paid.c.to_date == RecordEmployeePayment.to_date)
+                       ).group_by(RecordEmployeePayment.personal_id, last_paid.c.to_date).subquery()
+
+                upcoming = session.query(
+                    PersonalAssignment.personal_id.label('personal_id'),
+                    func.count().label('shifts'),
+                    func.min(Shift.date).label('next_date'),
+                ).join(Shift, Shift.id == PersonalAssignment.shift_id).filter(
+                    Shift.date >= shifts_from,
+                    Shift.date < upcoming_until,
+                    or_(PersonalAssignment.active.is_(None), PersonalAssignment.active.is_(True)),
+                ).group_by(PersonalAssignment.personal_id).subquery()
+
+                query = session.query(
+                    Personal,
+                    func.coalesce(hours.c.worked_hr, 0),
+                    last_payment.c.to_date,
+                    last_payment.c.payment,
+                    func.coalesce(upcoming.c.shifts, 0),
+                    upcoming.c.next_date,
+                ).outerjoin(hours, hours.c.personal_id == Personal.id
+                ).outerjoin(last_payment, last_payment.c.personal_id == Personal.id
+                ).outerjoin(upcoming, upcoming.c.personal_id == Personal.id
+                ).order_by(Personal.time_create.desc(), Personal.id.desc())
+                if active is not None:
+                    query = query.filter(Personal.active.is_(active))
+                if row_num:
+                    query = query.limit(row_num)
+                if offset:
+                    query = query.offset(offset)
+                return query.all()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching personal summaries: {e}")
+                return []
+
+    @changes_shift_plan
     def edit_personal(self,
                                      personal:Personal
                                      ) -> Optional[Personal]:
@@ -4543,6 +6743,7 @@ class DBHandler:
                 logging.error(f"Failed to update personal : {e}")
                 return None
 
+    @changes_shift_plan
     def delete_personal(self, personal:Personal) -> bool:
         """
         Deletes an Object from the database.
@@ -4654,6 +6855,7 @@ class DBHandler:
             from_date: Optional[datetime] = None,
             to_date: Optional[datetime] = None,
             row_num: Optional[int] = None,
+            offset: Optional[int] = None,
     ) -> list[WorkShiftRecord]:
         """Get with optional filters
         Returns:
@@ -4667,7 +6869,7 @@ class DBHandler:
 
         with self.Session() as session:
                 try:
-                    query = session.query(WorkShiftRecord).order_by(WorkShiftRecord.from_date.desc())
+                    query = session.query(WorkShiftRecord).order_by(WorkShiftRecord.from_date.desc(), WorkShiftRecord.id.desc())
                     if id:
                         query = query.filter_by(id=id)
 
@@ -4683,6 +6885,8 @@ class DBHandler:
 
                     if row_num:
                         query = query.limit(row_num)
+                    if offset:
+                        query = query.offset(offset)
 
                     result = query.all()
                     logging.info(f"Found {len(result)}")
@@ -4770,6 +6974,83 @@ class DBHandler:
 
 
 
+    #--Time clock--
+    def get_timeclock_checkpoint(self, source: str) -> int:
+        """last csv line of the source that is fully imported, 0 if never imported"""
+        with self.Session() as session:
+            try:
+                checkpoint = session.get(TimeClockCheckpoint, source)
+                return checkpoint.line if checkpoint else 0
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error reading time clock checkpoint {source}: {e}")
+                return 0
+
+    def get_assigned_shift_slots(self, personal_ids: list[int], from_date: datetime, to_date: datetime) -> list:
+        """
+        Active assignments of the people to shifts dated from_date to to_date (inclusive), as plain rows of
+        (personal_id, shift_id, date, from_hr, to_hr, lunch_payment, service_payment, extra_payment).
+        """
+        with self.Session() as session:
+            try:
+                return session.query(
+                    PersonalAssignment.personal_id, Shift.id, Shift.date, Shift.from_hr, Shift.to_hr,
+                    Shift.lunch_payment, Shift.service_payment, Shift.extra_payment,
+                ).join(Shift, Shift.id == PersonalAssignment.shift_id).filter(
+                    PersonalAssignment.personal_id.in_(personal_ids),
+                    or_(PersonalAssignment.active.is_(None), PersonalAssignment.active.is_(True)),
+                    Shift.date >= from_date,
+                    Shift.date <= to_date,
+                ).all()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error reading assigned shifts: {e}")
+                return []
+
+    def write_timeclock_batch(self, source: str, records: list[dict], line: int) -> tuple[int, int]:
+        """
+        Bulk inserts WorkShiftRecord rows and moves the checkpoint of source to line, in one transaction.
+        Records of unknown people or already imported (same person and from_date) are skipped,
+        so a batch read again after a crash does not write twice.
+
+        Returns:
+            (written rows, skipped rows), (-1, 0) on error
+        """
+        with self.Session() as session:
+            try:
+                rows = []
+                if records:
+                    personal_ids = {record['personal_id'] for record in records}
+                    known = {personal_id for personal_id, in session.query(Personal.id).filter(
+                        Personal.id.in_(personal_ids))}
+                    first = min(record['from_date'] for record in records)
+                    last = max(record['from_date'] for record in records)
+                    imported = set(session.query(WorkShiftRecord.personal_id, WorkShiftRecord.from_date).filter(
+                        WorkShiftRecord.personal_id.in_(personal_ids),
+                        WorkShiftRecord.from_date >= first,
+                        WorkShiftRecord.from_date <= last,
+                    ))
+                    for record in records:
+                        key = (record['personal_id'], record['from_date'])
+                        if record['personal_id'] in known and key not in imported:
+                            imported.add(key)
+                            rows.append(record)
+                    session.bulk_insert_mappings(WorkShiftRecord, rows)
+
+                checkpoint = session.get(TimeClockCheckpoint, source)
+                if checkpoint is None:
+                    session.add(TimeClockCheckpoint(source=source, line=line))
+                else:
+                    checkpoint.line = max(checkpoint.line, line)
+                session.commit()
+                logging.info(f"Time clock {source}: {len(rows)} work records, checkpoint at line {line}")
+                return len(rows), len(records) - len(rows)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to write time clock batch of {source}: {e}")
+                return -1, 0
+
+
     #--RecordEmployeePayment--
 
     def add_recordemployeepayment(self,
@@ -4867,6 +7148,7 @@ class DBHandler:
             from_date: Optional[datetime] = None,
             to_date: Optional[datetime] = None,
             row_num: Optional[int] = None,
+            offset: Optional[int] = None,
     ) -> list[RecordEmployeePayment]:
         """Get with optional filters
         Returns:
@@ -4879,7 +7161,7 @@ class DBHandler:
 
         with self.Session() as session:
                 try:
-                    query = session.query(RecordEmployeePayment).order_by(RecordEmployeePayment.time_create.desc())
+                    query = session.query(RecordEmployeePayment).order_by(RecordEmployeePayment.time_create.desc(), RecordEmployeePayment.id.desc())
                     if id:
                         query = query.filter_by(id=id)
                     if personal_id:
@@ -4893,6 +7175,8 @@ class DBHandler:
 
                     if row_num:
                         query = query.limit(row_num)
+                    if offset:
+                        query = query.offset(offset)
 
                     result = query.all()
                     logging.info(f"Found {len(result)}")
@@ -4977,7 +7261,77 @@ class DBHandler:
                 logging.error(f"Failed to delete record_employee_payment {record_employee_payment.id}: {e}")
                 return False
 
+    def get_payroll_inputs(self, from_date: datetime, to_date: datetime) -> list:
+        """
+        Active personal with their work in [from_date, to_date) summed per person.
+
+        Returns:
+            rows of (Personal, worked_hr, lunch_paid, service_paid, extra_paid)
+        """
+        with self.Session() as session:
+            try:
+                totals = session.query(
+                    WorkShiftRecord.personal_id.label('personal_id'),
+                    func.sum(WorkShiftRecord.worked_hr).label('worked_hr'),
+                    func.sum(WorkShiftRecord.lunch_paid).label('lunch_paid'),
+                    func.sum(WorkShiftRecord.service_paid).label('service_paid'),
+                    func.sum(WorkShiftRecord.extra_paid).label('extra_paid'),
+                ).filter(
+                    WorkShiftRecord.from_date >= from_date,
+                    WorkShiftRecord.from_date < to_date,
+                ).group_by(WorkShiftRecord.personal_id).subquery()
+
+                rows = session.query(
+                    Personal,
+                    func.coalesce(totals.c.worked_hr, 0),
+                    func.coalesce(totals.c.lunch_paid, 0),
+                    func.coalesce(totals.c.service_paid, 0),
+                    func.coalesce(totals.c.extra_paid, 0),
+                ).outerjoin(totals, totals.c.personal_id == Personal.id).filter(
+                    Personal.active.is_(True)
+                ).order_by(Personal.id).all()
+                return rows
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read payroll inputs: {e}")
+                return []
+
+    def replace_payroll_run(self, from_date: datetime, to_date: datetime, payments: list[dict],
+                            description: str) -> tuple[int, list[int]]:
+        """
+        Writes the payments of a payroll run in bulk. Rows of an earlier run of the same
+        period (same description) are replaced, so running it again gives the same result.
+        People that already have another payment overlapping the period are skipped.
+
+        Returns:
+            (number of written rows, skipped personal ids), (-1, []) on error
+        """
+        with self.Session() as session:
+            try:
+                session.query(RecordEmployeePayment).filter(
+                    RecordEmployeePayment.from_date == from_date,
+                    RecordEmployeePayment.to_date == to_date,
+                    RecordEmployeePayment.description == description,
+                ).delete(synchronize_session=False)
+
+                paid = {personal_id for personal_id, in session.query(RecordEmployeePayment.personal_id).filter(
+                    RecordEmployeePayment.from_date < to_date,
+                    RecordEmployeePayment.to_date > from_date,
+                )}
+                rows = [dict(payment, from_date=from_date, to_date=to_date, description=description)
+                        for payment in payments if payment['personal_id'] not in paid]
+                session.bulk_insert_mappings(RecordEmployeePayment, rows)
+                session.commit()
+                skipped = sorted({payment['personal_id'] for payment in payments} & paid)
+                logging.info(f"Payroll run {from_date:%Y-%m}: {len(rows)} payments, {len(skipped)} skipped")
+                return len(rows), skipped
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to write payroll run: {e}")
+                return -1, []
+
     # --PersonalAssignment--
+    @changes_shift_plan
     def add_personalassignment(self,
                                personal_id: int,
                                shift_id: int,
@@ -5009,6 +7363,12 @@ class DBHandler:
                     logging.warning(f"Assignment already exists for personal {personal_id} and position {shift_id}")
                     return None
 
+                if active is not False:
+                    conflicts = self.find_assignment_conflicts([(personal_id, shift_id)])
+                    if conflicts:
+                        logging.error(f"Personal {personal_id} is already working then: {conflicts}")
+                        return None
+
                 new_assignment = PersonalAssignment(
                     personal_id=personal_id,
                     position_id=position_id,
@@ -5025,6 +7385,142 @@ class DBHandler:
                 logging.error(f"Failed to add personal assignment: {e}")
                 return None
 
+    def find_assignment_conflicts(self, assignments: list[tuple[int, int]]) -> list[dict]:
+        """
+        Assignments (personal_id, shift_id) that would double book someone, against each other
+        and against the person's active assignments.
+
+        Returns:
+            one dict per conflict: personal_id, shift_id and the other shift_id
+        """
+        if not assignments:
+            return []
+        personal_ids = {personal_id for personal_id, _ in assignments}
+        with self.Session() as session:
+            try:
+                shifts = {row.id: row for row in session.query(Shift.id, Shift.date, Shift.from_hr, Shift.to_hr).filter(
+                    Shift.id.in_({shift_id for _, shift_id in assignments})).all()}
+                dated = [shift.date for shift in shifts.values() if shift.date]
+                if not dated:
+                    return []
+                first_day = datetime.combine(min(dated).date(), time()) - timedelta(days=1)
+                last_day = datetime.combine(max(dated).date(), time()) + timedelta(days=2)
+                existing = session.query(PersonalAssignment.personal_id, Shift.id, Shift.date, Shift.from_hr,
+                                         Shift.to_hr).join(Shift, Shift.id == PersonalAssignment.shift_id).filter(
+                    PersonalAssignment.personal_id.in_(personal_ids),
+                    or_(PersonalAssignment.active.is_(None), PersonalAssignment.active.is_(True)),
+                    Shift.date >= first_day,
+                    Shift.date < last_day,
+                ).all()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to read assignments for overlap check: {e}")
+                return [{'error': str(e)}]
+
+        index = IntervalIndex()
+        new_pairs = set()
+        for personal_id, shift_id in assignments:
+            shift = shifts.get(shift_id)
+            if shift is None or not (shift.date and shift.from_hr and shift.to_hr) or (personal_id, shift_id) in new_pairs:
+                continue
+            new_pairs.add((personal_id, shift_id))
+            start, end = shift_interval(shift.date, shift.from_hr, shift.to_hr)
+            index.add(personal_id, start, end, shift_id)
+        for personal_id, shift_id, date, from_hr, to_hr in existing:
+            if (personal_id, shift_id) in new_pairs or not (date and from_hr and to_hr):
+                continue
+            start, end = shift_interval(date, from_hr, to_hr)
+            index.add(personal_id, start, end, shift_id, new=False)
+
+        return [{'personal_id': personal_id, 'shift_id': shift_id, 'other_shift_id': other}
+                for personal_id, shift_id, other in index.conflicts()]
+
+    def get_personal_shifts(self,
+                            personal_id: int,
+                            from_date: Optional[datetime] = None,
+                            to_date: Optional[datetime] = None,
+                            active_only: bool = False,
+                            row_num: Optional[int] = None,
+                            offset: Optional[int] = None,
+                            ) -> list[Shift]:
+        """Shifts someone is assigned to, newest first (one join, dates filtered in the query)"""
+        with self.Session() as session:
+            try:
+                query = session.query(Shift).join(
+                    PersonalAssignment, PersonalAssignment.shift_id == Shift.id
+                ).filter(PersonalAssignment.personal_id == personal_id).order_by(Shift.date.desc(), Shift.id.desc())
+                if from_date:
+                    query = query.filter(Shift.date >= from_date)
+                if to_date:
+                    query = query.filter(Shift.date <= to_date)
+                if active_only:
+                    query = query.filter(or_(PersonalAssignment.active.is_(None), PersonalAssignment.active.is_(True)))
+                if row_num:
+                    query = query.limit(row_num)
+                if offset:
+                    query = query.offset(offset)
+                return cast(list[Shift], query.all())
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error fetching shifts of personal {personal_id}: {e}")
+                return []
+
+    @changes_shift_plan
+    def add_personalassignments(self, assignments: list[dict]) -> list[PersonalAssignment]:
+        """
+        Adds many assignments (dicts of personal_id, shift_id, position_id, active) at once.
+        Nothing is added if one of them is invalid or double books someone.
+        """
+        pairs = [(assignment['personal_id'], assignment['shift_id']) for assignment in assignments]
+        if len(set(pairs)) != len(pairs):
+            logging.error("Same assignment given twice")
+            return []
+        with self.Session() as session:
+            try:
+                personal_ids = {personal_id for personal_id, _ in pairs}
+                shift_ids = {shift_id for _, shift_id in pairs}
+                position_ids = {assignment.get('position_id') for assignment in assignments} - {None}
+                if session.query(func.count(Personal.id)).filter(Personal.id.in_(personal_ids)).scalar() != len(personal_ids) \
+                        or session.query(func.count(Shift.id)).filter(Shift.id.in_(shift_ids)).scalar() != len(shift_ids) \
+                        or session.query(func.count(TargetPositionAndSalary.id)).filter(
+                            TargetPositionAndSalary.id.in_(position_ids)).scalar() != len(position_ids):
+                    logging.error("Unknown personal, shift or position in assignments")
+                    return []
+                existing = session.query(PersonalAssignment.personal_id, PersonalAssignment.shift_id).filter(
+                    PersonalAssignment.personal_id.in_(personal_ids),
+                    PersonalAssignment.shift_id.in_(shift_ids)).all()
+                if set(pairs) & {tuple(row) for row in existing}:
+                    logging.error("Some of the assignments already exist")
+                    return []
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to check assignments: {e}")
+                return []
+
+        conflicts = self.find_assignment_conflicts(
+            [pair for pair, assignment in zip(pairs, assignments) if assignment.get('active', True) is not False])
+        if conflicts:
+            for conflict in conflicts:
+                logging.error(f"Assignment double books: {conflict}")
+            return []
+
+        new_assignments = [PersonalAssignment(personal_id=assignment['personal_id'],
+                                              shift_id=assignment['shift_id'],
+                                              position_id=assignment.get('position_id'),
+                                              active=assignment.get('active', True)) for assignment in assignments]
+        with self.Session() as session:
+            try:
+                session.add_all(new_assignments)
+                session.commit()
+                for assignment in new_assignments:
+                    session.refresh(assignment)
+                logging.info(f"Added {len(new_assignments)} personal assignments")
+                return new_assignments
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to add personal assignments: {e}")
+                return []
+
     def get_personalassignment(
             self,
             personal_id: Optional[int] = None,
@@ -5063,6 +7559,7 @@ class DBHandler:
                 logging.error(f"Error fetching personal assignments: {str(e)}")
                 return []
 
+    @changes_shift_plan
     def edit_personalassignment(self, assignment: PersonalAssignment) -> Optional[PersonalAssignment]:
         """
         Updates an existing personal assignment in the database.
@@ -5095,6 +7592,7 @@ class DBHandler:
                 logging.error(f"Failed to update assignment: {e}")
                 return None
 
+    @changes_shift_plan
     def delete_personalassignment(self, assignment: PersonalAssignment) -> bool:
         """
         Deletes a personal assignment.
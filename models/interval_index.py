@@ -0,0 +1,49 @@
+import heapq
+from datetime import datetime, time, timedelta
+from typing import Hashable
+
+
+def shift_interval(date: datetime, from_hr: time, to_hr: time) -> tuple[datetime, datetime]:
+    """[start, end) of a shift, a shift ending at or before its start hour ends the next day."""
+    day = date.date() if isinstance(date, datetime) else date
+    start = datetime.combine(day, from_hr)
+    end = datetime.combine(day, to_hr)
+    if end <= start:
+        end += timedelta(days=1)
+    return start, end
+
+
+class IntervalIndex:
+    """
+    Half open [start, end) intervals grouped by key (a shift name, an employee ...).
+
+    Intervals are marked new or existing, conflicts() finds every overlapping pair
+    that involves a new one with one sort and sweep per key, O(n log n + conflicts).
+    """
+
+    def __init__(self):
+        self._intervals: dict[Hashable, list[tuple]] = {}
+
+    def add(self, key: Hashable, start, end, ref, new: bool = True):
+        self._intervals.setdefault(key, []).append((start, end, ref, new))
+
+    def __len__(self):
+        return sum(len(intervals) for intervals in self._intervals.values())
+
+    def conflicts(self) -> list[tuple[Hashable, object, object]]:
+        """(key, ref, other ref) for each overlapping pair, the new interval's ref first."""
+        found = []
+        for key, intervals in self._intervals.items():
+            intervals.sort(key=lambda interval: (interval[0], interval[1]))
+            active = []  # heap of (end, order, interval) still open at the sweep position
+            for order, interval in enumerate(intervals):
+                start, end, ref, new = interval
+                while active and active[0][0] <= start:
+                    heapq.heappop(active)
+                for _, _, (_, _, other_ref, other_new) in active:
+                    if new:
+                        found.append((key, ref, other_ref))
+                    elif other_new:
+                        found.append((key, other_ref, ref))
+                heapq.heappush(active, (end, order, interval))
+        return found
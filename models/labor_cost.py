@@ -0,0 +1,41 @@
+from datetime import time
+from typing import Optional
+
+# overtime pay when a position has no extra_hr_payment: hourly rate x OVERTIME_FACTOR
+OVERTIME_FACTOR = 1.4
+
+
+def hours_of(value: Optional[time]) -> float:
+    """time of day (or a duration stored as time) as float hours"""
+    if not value:
+        return 0.0
+    return value.hour + value.minute / 60 + value.second / 3600
+
+
+def shift_hours(from_hr: Optional[time], to_hr: Optional[time]) -> float:
+    """length of a shift, one that ends at or before its start hour ends the next day"""
+    if from_hr is None or to_hr is None:
+        return 0.0
+    hours = hours_of(to_hr) - hours_of(from_hr)
+    return hours if hours > 0 else hours + 24
+
+
+def labor_cost(hours: float,
+               number: Optional[int],
+               extra_hr: Optional[time],
+               monthly_hr: Optional[float],
+               monthly_payment: Optional[float],
+               monthly_insurance: Optional[float],
+               extra_hr_payment: Optional[float]) -> float:
+    """
+    Cost of `number` people of a position on a shift of `hours`:
+    regular hours at the monthly rate, extra_hr at the overtime rate and a day of insurance.
+    """
+    if not number:
+        return 0.0
+    hourly = monthly_payment / monthly_hr if monthly_hr and monthly_payment else 0.0
+    overtime_rate = extra_hr_payment if extra_hr_payment else hourly * OVERTIME_FACTOR
+    overtime = hours_of(extra_hr)
+    regular = max(0.0, hours - overtime)
+    insurance = monthly_insurance / 30 if monthly_insurance else 0.0
+    return (regular * hourly + overtime * overtime_rate + insurance) * number
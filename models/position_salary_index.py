@@ -0,0 +1,82 @@
+from bisect import bisect_right
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+
+class SalaryTerms(NamedTuple):
+    id: int
+    position: str
+    category: Optional[str]
+    from_date: Optional[datetime]
+    to_date: Optional[datetime]
+    monthly_hr: Optional[float]
+    monthly_payment: Optional[float]
+    monthly_insurance: Optional[float]
+    extra_hr_payment: Optional[float]
+
+
+class PositionSalaryIndex:
+    """
+    Effective dated TargetPositionAndSalary terms, per position a list sorted by from_date.
+
+    resolve() finds the terms in force on a date with one bisect, O(log n), walking back past terms that
+    already ended. When terms of a position overlap, the one that started last wins. A missing from_date
+    counts as always, a missing to_date as open.
+    """
+
+    def __init__(self, rows):
+        self._terms: dict[str, list[SalaryTerms]] = {}
+        self._by_id: dict[int, SalaryTerms] = {}
+        for row in rows:
+            terms = SalaryTerms(*row)
+            self._by_id[terms.id] = terms
+            self._terms.setdefault(self.key(terms.position), []).append(terms)
+        self._starts: dict[str, list[datetime]] = {}
+        for name, terms in self._terms.items():
+            terms.sort(key=lambda term: (term.from_date or datetime.min, term.id))
+            self._starts[name] = [term.from_date or datetime.min for term in terms]
+
+    @staticmethod
+    def key(position: Optional[str]) -> str:
+        return (position or '').lower().strip()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def positions(self) -> list[str]:
+        return list(self._terms)
+
+    def get(self, terms_id: int) -> Optional[SalaryTerms]:
+        return self._by_id.get(terms_id)
+
+    def history(self, position: str) -> list[SalaryTerms]:
+        """all terms of the position, oldest first"""
+        return list(self._terms.get(self.key(position), []))
+
+    def resolve(self, position: str, date: datetime) -> Optional[SalaryTerms]:
+        """terms of the position in force on date, None if there are none"""
+        name = self.key(position)
+        index = bisect_right(self._starts.get(name, []), date) - 1
+        # the latest start may have ended already while an earlier, longer term is still open
+        while index >= 0:
+            terms = self._terms[name][index]
+            if terms.to_date is None or terms.to_date >= date:
+                return terms
+            index -= 1
+        return None
+
+    def resolve_for(self, terms_id: int, date: datetime) -> Optional[SalaryTerms]:
+        """terms in force on date of the position that terms_id belongs to, terms_id itself if none are"""
+        terms = self._by_id.get(terms_id)
+        if terms is None:
+            return None
+        return self.resolve(terms.position, date) or terms
+
+    def in_force(self, date: datetime) -> dict[str, SalaryTerms]:
+        """{position: terms} of every position with terms in force on date"""
+        found = {}
+        for name in self._terms:
+            terms = self.resolve(name, date)
+            if terms is not None:
+                found[name] = terms
+        return found
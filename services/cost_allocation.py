@@ -0,0 +1,112 @@
+import calendar
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Optional
+
+from dateutil.relativedelta import relativedelta
+
+from models.dbhandler import DBHandler
+
+COST_CATEGORIES = ('rent', 'bills', 'equipment')
+PERIODS = {'day': relativedelta(days=1), 'week': relativedelta(weeks=1),
+           'month': relativedelta(months=1), 'year': relativedelta(years=1)}
+DAY = timedelta(days=1)
+
+
+def _days(start: datetime, end: datetime) -> float:
+    return (end - start) / DAY
+
+
+class CostAllocation:
+    """
+    Period x category cost matrix. Period i is [boundaries[i], boundaries[i + 1]),
+    values[i][j] is the cost of COST_CATEGORIES[j] that falls in it.
+    """
+
+    def __init__(self, boundaries: list[datetime]):
+        self.boundaries = boundaries
+        self.categories = COST_CATEGORIES
+        self.values = [array('d', bytes(8 * len(COST_CATEGORIES))) for _ in boundaries[:-1]]
+
+    def add_interval(self, category: str, start: datetime, end: datetime, daily_cost: float):
+        """Spreads daily_cost over every day of [start, end) that is inside the matrix."""
+        column = self.categories.index(category)
+        start, end = max(start, self.boundaries[0]), min(end, self.boundaries[-1])
+        period = bisect_right(self.boundaries, start) - 1
+        while start < end:
+            period_end = min(end, self.boundaries[period + 1])
+            self.values[period][column] += daily_cost * _days(start, period_end)
+            start = period_end
+            period += 1
+
+    def add_at(self, category: str, day: datetime, cost: float):
+        """One-off cost on a single moment."""
+        if self.boundaries[0] <= day < self.boundaries[-1]:
+            self.values[bisect_right(self.boundaries, day) - 1][self.categories.index(category)] += cost
+
+    def total(self, category: Optional[str] = None) -> float:
+        if category is None:
+            return sum(sum(row) for row in self.values)
+        column = self.categories.index(category)
+        return sum(row[column] for row in self.values)
+
+    def column(self, category: str) -> list[float]:
+        column = self.categories.index(category)
+        return [row[column] for row in self.values]
+
+    def rows(self) -> list[dict]:
+        return [{'from_date': self.boundaries[index], 'to_date': self.boundaries[index + 1],
+                 **dict(zip(self.categories, row)), 'total': sum(row)}
+                for index, row in enumerate(self.values)]
+
+
+class CostAllocator:
+    """
+    Prorates rent, estimated bills and equipment depreciation over time windows.
+
+    A rent or bill costs its amount spread evenly over its own [from_date, to_date).
+    Equipment costs monthly_depreciation for every month from purchase to expire date,
+    partial months by their share of days.
+    """
+
+    def __init__(self, db_handler: DBHandler):
+        self.db = db_handler
+
+    def allocate(self, from_date: datetime, to_date: datetime, period: str = 'month') -> Optional[CostAllocation]:
+        """
+        Args:
+            from_date: window start
+            to_date: window end (exclusive)
+            period: day, week, month or year rows
+        Returns:
+            CostAllocation or None for an invalid window
+        """
+        if period not in PERIODS or to_date <= from_date:
+            return None
+        boundaries = [from_date]
+        while boundaries[-1] < to_date:
+            boundaries.append(min(boundaries[-1] + PERIODS[period], to_date))
+        allocation = CostAllocation(boundaries)
+
+        rows = self.db.get_indirect_cost_rows(from_date, to_date)
+        for category in ('rent', 'bills'):
+            for start, end, cost in rows[category]:
+                if not cost or start is None:
+                    continue
+                if end is None or end <= start:
+                    allocation.add_at(category, start, cost)
+                else:
+                    allocation.add_interval(category, start, end, cost / _days(start, end))
+
+        for start, end, monthly in rows['equipment']:
+            if not monthly or start is None:
+                continue
+            end = min(end, to_date) if end else to_date
+            month_start = max(start, from_date)
+            while month_start < end:
+                days_in_month = calendar.monthrange(month_start.year, month_start.month)[1]
+                next_month = datetime(month_start.year, month_start.month, 1) + relativedelta(months=1)
+                allocation.add_interval('equipment', month_start, min(next_month, end), monthly / days_in_month)
+                month_start = next_month
+        return allocation
@@ -1,7 +1,9 @@
+import copy
 from typing import Optional
 from datetime import datetime, time, timedelta
-from models.dbhandler import DBHandler
+from models.dbhandler import DBHandler, SHIFT_PLAN_CACHE
 from models.cafe_managment_models import *
+from models.labor_cost import OVERTIME_FACTOR, shift_hours
 
 def str_to_time_object_hr_min(the_time:str):
     the_time_object = datetime.strptime(the_time, '%H:%M').time()
@@ -34,9 +36,15 @@ def time_to_float_hr(self, time_obj: time) -> float:
         return 0.0
     return time_obj.hour + time_obj.minute / 60.0 + time_obj.second / 3600.0
 
+PAYROLL_DESCRIPTION = "payroll run"
+# windows of get_shift_plan kept in memory
+SHIFT_PLAN_CACHE_SIZE = 16
+
 class HRService:
     def __init__(self, db_handler: DBHandler):
         self.db = db_handler
+        # (from_date, to_date) -> (shift_plan CacheVersion, plan)
+        self._shift_plans: dict[tuple[datetime, datetime], tuple[int, list[dict]]] = {}
 
     #___________Personal CRUD (add/deactivate)__________
     def new_personal(self,
@@ -143,6 +151,53 @@ class HRService:
             extra_expenses=extra_expenses,
             description=description,
         ))
+    def run_payroll(self, year: int, month: int) -> Optional[list[dict]]:
+        """
+        Computes and records the month's pay of all active personal from their work records.
+
+        Hours up to the monthly hours are paid at monthly_payment / monthly_hr, the rest as
+        overtime. Salary terms of the person come first, then of their position valid in the month.
+        Running a month again replaces its earlier run.
+
+        Returns:
+            the written payments, None on error
+        """
+        from_date = datetime(year, month, 1)
+        to_date = datetime(year + month // 12, month % 12 + 1, 1)
+
+        positions = {}
+        for position in self.db.get_targetpositionandsalary():
+            if position.from_date and position.from_date >= to_date:
+                continue
+            if position.to_date and position.to_date < from_date:
+                continue
+            # newest first, keep the first match per name
+            positions.setdefault((position.position or '').lower().strip(), position)
+
+        payments = []
+        for person, worked_hr, lunch, service, extra in self.db.get_payroll_inputs(from_date, to_date):
+            position = positions.get((person.position or '').lower().strip())
+            monthly_hr = person.monthly_hr or (position.monthly_hr if position else 0) or 0
+            monthly_payment = person.monthly_payment or (position.monthly_payment if position else 0) or 0
+            hourly_rate = monthly_payment / monthly_hr if monthly_hr else 0
+            overtime_rate = position.extra_hr_payment if position and position.extra_hr_payment else hourly_rate * OVERTIME_FACTOR
+
+            regular_hr = min(worked_hr, monthly_hr) if monthly_hr else worked_hr
+            extra_hr = worked_hr - regular_hr
+            payments.append({'personal_id': person.id,
+                             'monthly_salary': monthly_payment,
+                             'payment': regular_hr * hourly_rate + extra_hr * overtime_rate,
+                             'indirect_payment': lunch + service,
+                             'insurance': (position.monthly_insurance if position else 0) or 0,
+                             'work_hr': regular_hr,
+                             'extra_hr': extra_hr,
+                             'extra_expenses': extra})
+
+        written, skipped = self.db.replace_payroll_run(from_date, to_date, payments, PAYROLL_DESCRIPTION)
+        if written < 0:
+            return None
+        return [payment for payment in payments if payment['personal_id'] not in skipped]
+
     #_________record work (recording work)___________
     def add_work_record(self,
                         personal_id,
@@ -257,43 +312,146 @@ class HRService:
                              lunch_payment=None,
                              service_payment=None,
                              extra_payment=None,
-                             description=None):
-        date_range = []
-        main_list = []
+                             description=None,
+                             weekdays:Optional[str]=None):
+        """
+        Daily shifts from from_date for continue_days more days, one routine per (start, end) slot.
+        Only the rules are stored, days are materialized when they get assigned or changed.
+        """
         if from_date is None:
             from_date = datetime.now()
         target_date = from_date + timedelta(days=continue_days)
 
-        while from_date <= target_date:
-            date_range.append(from_date)
-            from_date += timedelta(days=1)
-
-        for date in date_range:
-            for tuple_start_end_daily in list_tuple_start_end_daily:
-                main_tuple = (date, tuple_start_end_daily[0], tuple_start_end_daily[1])
-                main_list.append(main_tuple)
-
-        if self.db.add_routine_shift(main_list,
-                                  name=name,
-                                  lunch_payment=lunch_payment,
-                                  service_payment=service_payment,
-                                  extra_payment=extra_payment,
-                                  description=description):
-            return True
-        return None
+        occurrences = []
+        for day in range(continue_days + 1):
+            date = from_date + timedelta(days=day)
+            if weekdays and str(date.weekday()) not in weekdays:
+                continue
+            for start, end in list_tuple_start_end_daily:
+                occurrences.append((date, start, end))
+        if self.db.find_shift_conflicts(occurrences, name=name):
+            return None
+
+        routines = []
+        for start, end in list_tuple_start_end_daily:
+            routine = self.db.add_shiftroutine(from_date=from_date, to_date=target_date,
+                                               from_hr=start, to_hr=end, name=name, weekdays=weekdays,
+                                               lunch_payment=lunch_payment,
+                                               service_payment=service_payment,
+                                               extra_payment=extra_payment,
+                                               description=description)
+            if not routine:
+                for added in routines:
+                    self.db.delete_shiftroutine(added)
+                return None
+            routines.append(routine)
+        return True
+
+    def get_shifts(self, from_date: datetime, to_date: datetime) -> list[Shift]:
+        """stored shifts and routine occurrences of the days, by date and start hour"""
+        shifts = self.db.get_shift(from_date=from_date, to_date=to_date)
+        shifts.extend(self.db.iter_routine_shifts(from_date, to_date))
+        return sorted(shifts, key=lambda shift: (shift.date, shift.from_hr or time()))
+
+    def get_shift_plan(self, from_date: datetime, to_date: datetime) -> list[dict]:
+        """
+        Shifts of [from_date, to_date) with their estimated labor, cost and assigned staff.
+        Plans are cached per window until a shift, labor, assignment or position is written
+        (by any worker, the version is kept in the database). Callers get their own copy.
+        """
+        key = (from_date, to_date)
+        version = self.db.get_cache_version(SHIFT_PLAN_CACHE)
+        cached = self._shift_plans.get(key)
+        if cached and version is not None and cached[0] == version:
+            return copy.deepcopy(cached[1])
+
+        # refresh takes an inclusive end, the plan window excludes to_date
+        self.db.refresh_shift_labor_costs(from_date, to_date - timedelta(microseconds=1))
+        rows = self.db.get_shift_plan_rows(from_date, to_date)
+        # labor is costed with the terms in force on the shift date, show those
+        salaries = self.db.get_position_salary_index()
+        plan, by_id = [], {}
+        for row in rows['labor']:
+            shift = by_id.get(row.shift_id)
+            if shift is None:
+                shift = by_id[row.shift_id] = self._plan_entry(row.shift_id, row)
+                shift['labor_cost'] = row.labor_cost or shift['labor_cost']
+                plan.append(shift)
+            if row.position_id is None:
+                continue
+            # None only when the position row is gone, its columns in the plan row are empty then too
+            terms = salaries.resolve_for(row.position_id, row.date)
+            shift['labor_estimation'].append({
+                'position_id': row.position_id,
+                'position': row.position,
+                'category': getattr(terms, 'category', None),
+                'number': row.number,
+                'extra_hr': row.extra_hr,
+                'from_to_date': f"{getattr(terms, 'from_date', None)} to {getattr(terms, 'to_date', None)}",
+                'monthly_payment': getattr(terms, 'monthly_payment', None),
+                'monthly_hr': getattr(terms, 'monthly_hr', None),
+                'over_time_payment_hr': getattr(terms, 'extra_hr_payment', None),
+            })
+        for shift_id, personal_id, first_name, last_name, position in rows['assignments']:
+            by_id[shift_id]['assignment'].append({'personal_id': personal_id, 'name': first_name,
+                                                  'last_name': last_name, 'position': position})
+
+        last_day = to_date - timedelta(microseconds=1)
+        if last_day >= from_date:
+            plan.extend(self._plan_entry(None, shift) for shift in self.db.iter_routine_shifts(from_date, last_day))
+        for shift in plan:
+            shift['labor_cost'] = round(shift['labor_cost'], 2)
+        plan.sort(key=lambda shift: (shift['shift_date'], shift['from_hr'] or time()))
+
+        if version is not None:
+            if len(self._shift_plans) >= SHIFT_PLAN_CACHE_SIZE:
+                self._shift_plans.pop(next(iter(self._shift_plans)))
+            self._shift_plans[key] = (version, plan)
+        return copy.deepcopy(plan)
+
+    @staticmethod
+    def _plan_entry(shift_id: Optional[int], shift) -> dict:
+        return {'shift_id': shift_id,
+                'routine_id': shift.routine_id,
+                'shift_date': shift.date,
+                'from_hr': shift.from_hr,
+                'to_hr': shift.to_hr,
+                'hours': shift_hours(shift.from_hr, shift.to_hr),
+                'name': shift.name,
+                'description': shift.description,
+                'lunch': shift.lunch_payment,
+                'service': shift.service_payment,
+                'extra_payment': shift.extra_payment,
+                'labor_estimation': [],
+                # unstaffed (no estimated labor) costs nothing, not even its extra payment
+                'labor_cost': 0.0,
+                'assignment': []}
+
+    def assign_routine_shift(self, employee_id: int, routine_id: int, date: datetime, position_id: int) -> bool:
+        """assign someone to the day of a routine"""
+        shift = self.db.materialize_routine_shift(routine_id, date)
+        if not shift:
+            return False
+        return self.assign_shift(employee_id, shift.id, position_id)
+
+    def override_routine_shift(self, routine_id: int, date: datetime, **changes) -> Optional[Shift]:
+        """change one day of a routine (from_hr, to_hr, name, payments, description)"""
+        shift = self.db.materialize_routine_shift(routine_id, date)
+        if not shift:
+            return None
+        for key, value in changes.items():
+            if key in ('from_hr', 'to_hr', 'name', 'lunch_payment', 'service_payment', 'extra_payment', 'description'):
+                setattr(shift, key, value)
+        return self.db.edit_shift(shift)
+
+    def cancel_routine_shift(self, routine_id: int, date: datetime, description: Optional[str] = None) -> bool:
+        """the routine does not run that day"""
+        return bool(self.db.add_shiftroutineexception(routine_id, date, description=description))
 
     def get_shift_schedule(self, personal_id: int,
                            from_date: datetime,
                            to_date: datetime) -> list[Shift]:
-        shift_in_that_range = self.db.get_shift(from_date=from_date,
-                                                to_date=to_date)
-        personal_shifts_assigned = []
-        for shift in shift_in_that_range:
-            if getattr(shift, "assignments", None):
-                for personal_assigned in shift.assignments:
-                    if personal_assigned.personal_id == personal_id:
-                        personal_shifts_assigned.append(shift)
-        return personal_shifts_assigned
+        return self.db.get_personal_shifts(personal_id, from_date=from_date, to_date=to_date)
 
     def assign_shift(self, employee_id: int, shift_id: int, position_id: int) -> bool:
         return bool(self.db.add_personalassignment(personal_id=employee_id,
@@ -301,6 +459,12 @@ class HRService:
                                                    position_id=position_id
                                                    ))
 
+    def assign_shifts(self, assignments: list[tuple[int, int, Optional[int]]]) -> bool:
+        """assign many (employee_id, shift_id, position_id) at once, all or nothing"""
+        return bool(self.db.add_personalassignments([
+            {'personal_id': employee_id, 'shift_id': shift_id, 'position_id': position_id}
+            for employee_id, shift_id, position_id in assignments]))
+
     def remove_shift_assignment(self, employee_id: int, shift_id: int) -> bool:
         """Remove an employee from a shift"""
         assignments = self.db.get_personalassignment(
@@ -316,20 +480,7 @@ class HRService:
                             from_date: Optional[datetime] = None,
                             to_date: Optional[datetime] = None) -> list[Shift]:
         """Get all shifts assigned to a specific employee"""
-        assignments = self.db.get_personalassignment(personal_id=employee_id)
-
-        shift_ids = [assignment.shift_id for assignment in assignments]
-        if not shift_ids:
-            return []
-
-        # Get the actual shift objects
-        shifts = self.db.get_shift(id=shift_ids)
-
-        # Filter by date range if provided
-        if from_date and to_date:
-            shifts = [shift for shift in shifts if from_date <= shift.date <= to_date]
-
-        return shifts
+        return self.db.get_personal_shifts(employee_id, from_date=from_date, to_date=to_date)
 
 #_______________estimate positions & salary & labor_______________________
 
@@ -1,60 +1,34 @@
 from typing import Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
 
-from models.dbhandler import DBHandler
-from models.cafe_managment_models import Inventory, Menu, InventoryStockRecord
+from models.dbhandler import DBHandler, CONFLICT_RETRIES
+from models.cafe_managment_models import Inventory, Menu, InventoryStockRecord, InventoryLot, PrepRecipe
+from services.recipe_matrix import RecipeMatrixCache
 
 INITIATE_STOCK_CATEGORY = "Initiate Stock"
+# weight of the newest day in the daily usage average (~ last 9 days matter most)
+DAILY_USAGE_ALPHA = 0.2
+# how deductions are valued from supplied lots: "fifo" or "average"
+VALUATION_METHOD = "fifo"
+# ledger rows younger than this stay raw, older ones are compacted into daily summaries
+LEDGER_HOT_DAYS = 90
+LEDGER_ARCHIVE_PATH = "inventory_archive.db"
 
 class InventoryService:
-    def __init__(self, db_handler:DBHandler):
+    def __init__(self, db_handler:DBHandler, valuation_method: str = VALUATION_METHOD):
         self.db = db_handler
+        self.valuation_method = valuation_method
+        self.recipes = RecipeMatrixCache(db_handler)
 
     def _calculate_inventory(self, inventory_item_id: int):
         """
         Recalculates the stock amount for an inventory item.
-        Uses the latest manual report as base and sums subsequent changes.
+        Uses the latest manual report as base and sums subsequent changes, read and written
+        in one transaction so a change committed meanwhile is not overwritten.
         """
-
-        # Step 1: Get latest manual report
-        latest_manual_report = self.db.get_inventorystockrecord(
-            inventory_id=inventory_item_id,
-            latest_check=True
-        )
-
-        if latest_manual_report:
-            last_report: InventoryStockRecord = latest_manual_report[0]
-            base_amount = last_report.manual_report or 0
-            from_time = last_report.date
-        else:
-            base_amount = 0
-            from_time = None
-
-        # Step 2: Get all subsequent stock changes
-        calculating_amounts = self.db.get_inventorystockrecord(
-            from_date=from_time,
-            inventory_id=inventory_item_id
-        )
-
-        # Step 3: Exclude manual report itself if included
-        if latest_manual_report:
-            calculating_amounts = [item for item in calculating_amounts if item.id != last_report.id]
-
-        # Step 4: Sum all change_amounts
-        total_changes = sum(item.change_amount for item in calculating_amounts if item.change_amount is not None)
-
-        # Step 5: Final stock
-        final_stock = base_amount + total_changes
-
-        # Step 6: Update inventory
-        fetch_inventory_items = self.db.get_inventory(id=inventory_item_id)
-        if fetch_inventory_items:
-            inventory_item: Inventory = fetch_inventory_items[0]
-            inventory_item.current_stock = final_stock
-            self.db.edit_inventory(inventory_item)
-            return True
-        else:
+        if not self.db.get_inventory(id=inventory_item_id):
             return False
+        return self.db.recalculate_stock([inventory_item_id])
 
 
 
@@ -70,48 +44,117 @@ class InventoryService:
 
 
     #check if it is possible to make this item
-    def check_stock_for_menu(self, menu_item:Menu, quantity:float=1) -> tuple[bool, dict[str, float], int]:
+    def stock_for_menu(self, menu_item: Menu) -> dict[int, float]:
+        """current stock of only the inventory a sale of the menu item can take"""
+        return self.db.get_stock_levels(list(self.recipes.get().inventory_of([menu_item.id])))
+
+    def check_stock_for_menu(self,
+                             menu_item: Menu,
+                             quantity: float = 1,
+                             stock: Optional[dict[int, float]] = None) -> tuple[bool, dict[str, float], int]:
         """
         Check if a menu item can be prepared given the current inventory stock.
 
-        For each ingredient in the menu's recipe, compares the required amount
-        (inventory_item_amount_usage * quantity) with the current stock.
-        If any ingredient is insufficient, records the missing amount.
+        Same check as check_stock_for_cart: the recipe times quantity against the stock,
+        prep items that ran out are made from their ingredients.
 
         Args:
             menu_item (int): the Menu object.
             quantity (float, optional): Number of menu items to prepare. Defaults to 1.
+            stock: inventory id -> amount to check against (default stock_for_menu)
 
         Returns:
             tuple[bool, dict[str, float, int]]:
                 - bool: True if all ingredients are sufficient, False if any are missing.
                 - dict[str, float]: Mapping of inventory item names to missing amounts
                   (empty if all ingredients are sufficient).
+                - int: how many the stock allows on its own (prep items from stock only)
         """
+        matrix = self.recipes.get()
+        if stock is None:
+            stock = self.db.get_stock_levels(list(matrix.inventory_of([menu_item.id])))
+        is_satisfied, missing = matrix.check_cart({menu_item.id: quantity}, stock)
+        max_available = matrix.max_producible(stock, [menu_item.id]).get(menu_item.id, 0)
 
-        is_satisfied = True
+        names = {used_item.inventory_id: used_item.inventory_item.name for used_item in menu_item.recipe}
         missing_items = {}
-        number_of_available_ingredients = []
-        max_available = 0
+        for inventory_id, amount in missing.items():
+            if inventory_id not in names:
+                found = self.db.get_inventory(id=inventory_id)
+                names[inventory_id] = found[0].name if found else str(inventory_id)
+            missing_items[names[inventory_id]] = amount
+        return is_satisfied, missing_items, max_available
 
-        menu_item:Menu = menu_item
-        menu_recipe = menu_item.recipe
-        for used_item in menu_recipe:
-            inventory_item = used_item.inventory_item
-            amount = used_item.inventory_item_amount_usage
-            amount_needed = amount * quantity
-            current_stock = inventory_item.current_stock or 0
-            if current_stock < amount_needed:
-                is_satisfied = False
-                missing_items[inventory_item.name] = amount_needed - current_stock
-            else:
-                number_available_by_this_ingredient =int( current_stock / amount )
-                number_of_available_ingredients.append(number_available_by_this_ingredient)
+    def check_stock_for_cart(self,
+                             cart: dict[int, float],
+                             stock: Optional[dict[int, float]] = None) -> tuple[bool, dict[int, float]]:
+        """
+        Checks a whole order at once against current stock, prep items that ran out
+        are made from their ingredients.
+
+        Args:
+            cart: menu id -> quantity
+            stock: inventory id -> amount to check against (default current stock)
+
+        Returns:
+            (all available, inventory id -> missing amount)
+        """
+        return self.recipes.get().check_cart(cart, self.db.get_stock_levels() if stock is None else stock)
 
-            max_available = min(number_of_available_ingredients) if number_of_available_ingredients else 0
+    def max_producible(self) -> dict[int, int]:
+        """Menu id -> how many can be made from current stock, for every menu with a recipe."""
+        return self.recipes.get().max_producible(self.db.get_stock_levels())
 
+    def forecast_ingredient_usage(self, from_date: datetime, to_date: datetime) -> list[dict]:
+        """
+        Sales forecasts overlapping the period, exploded through the recipes into raw inventory
+        (prep items broken down).
+
+        Returns:
+            dicts with inventory_id, from_date, to_date and amount (used by the whole forecast),
+            one per forecast and ingredient
+        """
+        matrix = self.recipes.get()
+        usages = []
+        for forecast in self.db.get_salesforecast_overlapping(from_date, to_date):
+            for inventory_id, amount in matrix.needs({forecast.menu_item_id: forecast.sell_number},
+                                                     exploded=True).items():
+                usages.append({'inventory_id': inventory_id,
+                               'from_date': forecast.from_date,
+                               'to_date': forecast.to_date,
+                               'amount': amount})
+        return usages
+
+    def forecast_ingredient_needs(self, from_date: datetime, to_date: datetime) -> dict[int, float]:
+        """
+        Raw inventory (prep items broken down) needed for the sales forecasts of the period.
+        Forecasts partly inside the period count by the share of their days inside it.
+        """
+        needs: dict[int, float] = {}
+        for usage in self.forecast_ingredient_usage(from_date, to_date):
+            total_days = (usage['to_date'] - usage['from_date']).days + 1
+            overlap_days = (min(usage['to_date'], to_date) - max(usage['from_date'], from_date)).days + 1
+            share = max(min(overlap_days / total_days, 1), 0)
+            needs[usage['inventory_id']] = needs.get(usage['inventory_id'], 0) + usage['amount'] * share
+        return needs
+
+    def add_prep_recipe(self,
+                        prep_id: int,
+                        inventory_id: int,
+                        amount_usage: float,
+                        writer: str = None,
+                        description: str = None) -> Optional[PrepRecipe]:
+        """Adds an ingredient to a prep item (syrup, batch ...) made from other inventory."""
+        if self.recipes.get().would_cycle(prep_id, inventory_id):
+            return None
+        new = self.db.add_preprecipe(prep_id=prep_id,
+                                     inventory_id=inventory_id,
+                                     amount_usage=amount_usage,
+                                     writer=writer,
+                                     description=description)
+        self.recipes.invalidate()
+        return new
 
-        return is_satisfied, missing_items, max_available
     #check if it is possible to make this item
     def check_stock_for_inventory(self, inventory_id:int, quantity:float, date:datetime=None) -> tuple[bool, dict[str, float]]:
         is_satisfied = True
@@ -141,26 +184,27 @@ class InventoryService:
         satisfied, items, _ = self.check_stock_for_menu(menu_item=menu_item, quantity=quantity)
         if not satisfied:
             return False
-        ids = []
-        menu_recipe = menu_item.recipe
-        for used_item in menu_recipe:
-            inventory_item: Inventory = used_item.inventory_item
-            amount = used_item.inventory_item_amount_usage
-            amount_change = -(amount * quantity)
-            new = self.db.add_inventorystockrecord(inventory_id=inventory_item.id,
-                                                   change_amount=amount_change,
-                                                   category=category,
-                                                   foreign_id=foreign_id,
-                                                   date=date or datetime.now(),
-                                                   description=description)
-            ids.append(new.id)
-        if None in ids:
-            if self._correct_failed_group_attempt(ids):
-                return False
-        for used_item in menu_recipe:
-            inventory_id = used_item.inventory_id
-            self._calculate_inventory(inventory_item_id=inventory_id)
-        return True
+        # the check above can be stale by now, the batch re-checks stock in the same UPDATE
+        records = [dict(change,
+                        category=category,
+                        foreign_id=foreign_id,
+                        date=date or datetime.now(),
+                        description=description) for change in self.stock_changes_for_menu(menu_item, quantity)]
+        return self.deduct_stock_batch(records)
+
+    def stock_changes_for_menu(self,
+                               menu_item: Menu,
+                               quantity: float,
+                               stock: Optional[dict[int, float]] = None) -> list[dict]:
+        """
+        inventory_id and change_amount of everything a sale of quantity takes out of stock,
+        prep items short in stock are taken as their ingredients (as check_stock_for_cart counts them)
+        """
+        matrix = self.recipes.get()
+        if stock is None:
+            stock = self.db.get_stock_levels(list(matrix.inventory_of([menu_item.id])))
+        takes = matrix.takes({menu_item.id: quantity}, stock)
+        return [{'inventory_id': inventory_id, 'change_amount': -amount} for inventory_id, amount in takes.items()]
 
     def deduct_stock_by_inventory_item(self,
                                        inventory_item_id:int,
@@ -168,25 +212,57 @@ class InventoryService:
                                        category: str = None,
                                        date: datetime = None,
                                        description: str = None,
-                                       foreign_id: int = None) -> bool:
+                                       foreign_id: int = None,
+                                       order_detail_id: int = None) -> bool:
 
         satisfied, missing = self.check_stock_for_inventory(inventory_id=inventory_item_id, quantity=quantity)
         if not satisfied:
             return False
 
-        changed_amount = -quantity
-        new: Optional[InventoryStockRecord] = self.db.add_inventorystockrecord(inventory_id=inventory_item_id,
-                                               change_amount=changed_amount,
-                                               category=category,
-                                               foreign_id=foreign_id,
-                                               date=date or datetime.now(),
-                                               description=description)
+        return self.deduct_stock_batch([{'inventory_id': inventory_item_id,
+                                         'change_amount': -quantity,
+                                         'category': category,
+                                         'foreign_id': foreign_id,
+                                         'date': date or datetime.now(),
+                                         'description': description,
+                                         'order_detail_id': order_detail_id}])
 
-        if new:
-            self._calculate_inventory(inventory_item_id=inventory_item_id)
-            return True
+    def deduct_stock_batch(self, records: list[dict]) -> bool:
+        """
+        Writes the stock changes of many sales/usages at once.
 
-        return False
+        All records go in with one insert and every touched inventory item is
+        recalculated once, instead of once per ingredient per sale.
+        Stock is guarded in the database (UPDATE ... WHERE current_stock >= needed),
+        so if any item ran out meanwhile nothing is written and False is returned.
+        The lots are consumed and the cost written in the same transaction.
+
+        Args:
+            records: dicts with inventory_id, change_amount, category, foreign_id, date, description
+                     and optional order_detail_id (consume the lot of that delivery first)
+        """
+        if not records:
+            return True
+        # the stock is moved by the same transaction, no recalculation after it
+        return bool(self.db.add_inventorystockrecord_batch(records, apply_to_stock=True,
+                                                           valuation_method=self.valuation_method))
+
+    def receive_lot(self,
+                    inventory_id: int,
+                    quantity: float,
+                    unit_cost: float,
+                    date: datetime = None,
+                    order_detail_id: int = None) -> Optional[InventoryLot]:
+        """Registers supplied units with their purchase cost as a lot for valuation."""
+        return self.db.add_inventorylot(inventory_id=inventory_id,
+                                        quantity=quantity,
+                                        unit_cost=unit_cost,
+                                        received_date=date,
+                                        order_detail_id=order_detail_id)
+
+    def inventory_valuation(self) -> dict[int, float]:
+        """Value of the stock in open lots per inventory id, by the service valuation method."""
+        return self.db.get_inventory_valuation(method=self.valuation_method)
 
 
     def restock_by_menu(self, menu_item: Menu,
@@ -197,26 +273,18 @@ class InventoryService:
                              description:str=None,
                              ) -> bool:
 
-        ids = []
         menu_recipe = menu_item.recipe
-        for used_item in menu_recipe:
-            inventory_item: Inventory = used_item.inventory_item
-            amount = used_item.inventory_item_amount_usage
-            amount_change = (amount * quantity)
-            new = self.db.add_inventorystockrecord(inventory_id=inventory_item.id,
-                                                   change_amount=amount_change,
-                                                   category=category,
-                                                   foreign_id=foreign_id,
-                                                   date=date or datetime.now(),
-                                                   description=description)
-            ids.append(new.id)
-        if None in ids:
-            if self._correct_failed_group_attempt(ids):
-                return False
-        for used_item in menu_recipe:
-            inventory_id = used_item.inventory_id
-            self._calculate_inventory(inventory_item_id=inventory_id)
-        return True
+        # returned units are credited back to the lots they were taken from, in the same transaction
+        records = [{'inventory_id': used_item.inventory_id,
+                    'change_amount': used_item.inventory_item_amount_usage * quantity,
+                    'category': category,
+                    'foreign_id': foreign_id,
+                    'date': date or datetime.now(),
+                    'description': description} for used_item in menu_recipe]
+        if not records:
+            return True
+        return bool(self.db.add_inventorystockrecord_batch(records, apply_to_stock=True,
+                                                           valuation_method=self.valuation_method))
 
     def restock_by_inventory_item(self,
                                       inventory_item_id:int,
@@ -224,21 +292,24 @@ class InventoryService:
                                        category: str = None,
                                        date: datetime = None,
                                        description: str = None,
-                                       foreign_id: int = None) -> bool:
-
-        changed_amount = quantity
-        new: Optional[InventoryStockRecord] = self.db.add_inventorystockrecord(inventory_id=inventory_item_id,
-                                               change_amount=changed_amount,
-                                               category=category,
-                                               foreign_id=foreign_id,
-                                               date=date or datetime.now(),
-                                               description=description)
-
-        if new:
-            self._calculate_inventory(inventory_item_id=inventory_item_id)
-            return True
-
-        return False
+                                       foreign_id: int = None,
+                                       unit_cost: float = None,
+                                       order_detail_id: int = None) -> bool:
+        """
+        Adds quantity to stock. With unit_cost the units are a delivery: its lot (for valuation)
+        is added in the same transaction as the record and the stock.
+        """
+        record = {'inventory_id': inventory_item_id,
+                  'change_amount': quantity,
+                  'category': category,
+                  'foreign_id': foreign_id,
+                  'date': date or datetime.now(),
+                  'description': description}
+        if unit_cost is not None:
+            record.update(unit_cost=unit_cost, order_detail_id=order_detail_id)
+        return bool(self.db.add_inventorystockrecord_batch([record], apply_to_stock=True,
+                                                           valuation_method=self.valuation_method
+                                                           if unit_cost is not None else None))
 
 
     #manual correction after check
@@ -251,58 +322,253 @@ class InventoryService:
         if date is None:
             date = datetime.now()
 
-        recorded = self.db.add_inventorystockrecord(inventory_id=inventory_id,
-                                         category="Manual Check",
-                                         foreign_id=foreign_id,
-                                         date=date,
-                                         manual_report=amount,
-                                         reporter=reporter,
-                                         description=reason)
-        if recorded is None:
-            return False
+        # the report and the recalculated stock are written in one transaction
+        return bool(self.db.add_stocktake([{'inventory_id': inventory_id,
+                                            'manual_report': amount,
+                                            'reporter': reporter,
+                                            'date': date,
+                                            'foreign_id': foreign_id,
+                                            'description': reason}]))
 
-        self._calculate_inventory(inventory_item_id=inventory_id)
-        return True
+
+    def stocktake(self,
+                  counts: dict[int, float],
+                  reporter: str,
+                  date: Optional[datetime] = None,
+                  reason: Optional[str] = None) -> Optional[list[dict]]:
+        """
+        Manual count of many items at once (weekly stocktake).
+
+        All counts are written in one transaction and the stock of the counted items is
+        recalculated set-wise, instead of manual_report + _calculate_inventory per item.
+
+        Args:
+            counts: inventory id -> counted amount
+
+        Returns:
+            variance report, one dict per item with inventory_id, name, unit, expected,
+            counted, variance and variance_value (at average cost or current price),
+            None if the stocktake was rejected
+        """
+        if not counts:
+            return []
+        if date is None:
+            date = datetime.now()
+        inventory_ids = list(counts)
+        expected = self.stock_as_of(date, inventory_ids=inventory_ids)
+
+        recorded = self.db.add_stocktake([{'inventory_id': inventory_id,
+                                           'manual_report': amount,
+                                           'reporter': reporter,
+                                           'date': date,
+                                           'description': reason} for inventory_id, amount in counts.items()])
+        if not recorded:
+            return None
+
+        report = []
+        for item in self.db.get_inventory():
+            if item.id not in counts:
+                continue
+            variance = counts[item.id] - expected.get(item.id, 0)
+            unit_cost = item.average_cost if item.average_cost is not None else (item.current_price or 0)
+            report.append({'inventory_id': item.id,
+                           'name': item.name,
+                           'unit': item.unit,
+                           'expected': expected.get(item.id, 0),
+                           'counted': counts[item.id],
+                           'variance': variance,
+                           'variance_value': variance * unit_cost})
+        return report
 
 
     #returns items blow threshold
     def low_stock_alerts(self, item_list:Optional[list[Inventory]] = None) -> dict[str, float]:
-        alert_dict = {}
-
-        if item_list is None:
-            all_inventory = self.db.get_inventory()
-            for inventory_item in all_inventory:
-                current_stock = inventory_item.current_stock or 0
-                safety_stock = inventory_item.safety_stock or 0
-                the_supplier = inventory_item.supplier
-                load_time_hr = the_supplier.load_time_hr or 0
-                daily_usage = inventory_item.daily_usage or 0
-
-                load_time_day = load_time_hr / 24
-                load_time_day = round(load_time_day) + 1
-                threshold = safety_stock + (load_time_day * daily_usage)
-                if current_stock <= threshold:
-                    alert_dict[inventory_item.name] = current_stock
-        else:
-            for inventory_item in item_list:
-                current_stock = inventory_item.current_stock
-                safety_stock = inventory_item.safety_stock
-                load_time_day = inventory_item.current_supplier.load_time_day
-                daily_usage = inventory_item.daily_usage
+        """
+        Items at or below their reorder point (safety stock + supplier lead time usage).
+
+        Args:
+            item_list: only check these items, all inventory if None
 
-                threshold = safety_stock + (load_time_day * daily_usage)
-                if current_stock <= threshold:
-                    alert_dict[inventory_item.name] = current_stock
+        Returns:
+            dict of item name -> current stock
+        """
+        inventory_ids = [item.id for item in item_list] if item_list is not None else None
+        alerts = self.reorder_report(inventory_ids=inventory_ids, only_alerts=True)
+        return {row['name']: row['current_stock'] for row in alerts}
+
+    def reorder_report(self,
+                       inventory_ids: Optional[list[int]] = None,
+                       only_alerts: bool = False,
+                       cycle_days: float = 7) -> list[dict]:
+        """
+        Reorder points and suggested order quantities, computed by the database
+        for all items in one query instead of walking inventory and supplier rows here.
+        """
+        if inventory_ids is not None and not inventory_ids:
+            return []
+        return self.db.get_inventory_reorder_report(inventory_ids=inventory_ids,
+                                                    only_alerts=only_alerts,
+                                                    cycle_days=cycle_days)
 
 
-        return alert_dict
+    def compact_ledger(self,
+                       keep_days: int = LEDGER_HOT_DAYS,
+                       archive_path: str = LEDGER_ARCHIVE_PATH,
+                       until: datetime = None) -> int:
+        """
+        Periodic job: keeps the hot ledger bounded. Rows older than keep_days become daily
+        summaries (manual checks kept) and the raw rows move to the archive file.
 
+        Returns:
+            number of rows archived, -1 on failure
+        """
+        before = datetime.combine((until or datetime.now()).date() - timedelta(days=keep_days), time.min)
+        return self.db.compact_inventory_ledger(before=before, archive_path=archive_path)
 
     #see where stock went
     def get_inventory_stock_report(self, inventory_id:int, from_date: datetime=None, to_date: datetime=None) -> list[InventoryStockRecord]:
         return self.db.get_inventorystockrecord(inventory_id=inventory_id, from_date=from_date, to_date=to_date)
 
 
+    def estimate_daily_usage(self, alpha: float = DAILY_USAGE_ALPHA, until: datetime = None) -> int:
+        """
+        Nightly job: learns Inventory.daily_usage from the deductions in the stock ledger.
+
+        Usage per day is an exponentially weighted average, days without deductions count
+        as zero. Only ledger rows after the last processed id are read, up to the first row
+        dated on the day of `until` (default today, so only complete days). They are summed
+        per item and day by the database and all items are written back in one transaction.
+
+        Returns:
+            number of inventory items updated, or -1 if saving failed
+        """
+        end_day = (until or datetime.now()).date() - timedelta(days=1)
+        states = {state.inventory_id: state for state in self.db.get_dailyusageestimate()}
+        watermark = max((state.last_record_id for state in states.values()), default=0)
+
+        last_record_id = self.db.get_ledger_watermark(after_record_id=watermark,
+                                                      before=datetime.combine(end_day + timedelta(days=1), time.min))
+        buckets: dict[int, list[dict]] = {}
+        for bucket in self.db.get_daily_deductions(after_record_id=watermark, up_to_record_id=last_record_id):
+            buckets.setdefault(bucket['inventory_id'], []).append(bucket)
+
+        estimates = []
+        for inventory_id in states.keys() | buckets.keys():
+            days = buckets.get(inventory_id, [])
+            state = states.get(inventory_id)
+            if state:
+                usage, last_day = state.usage, state.last_day
+            else:
+                usage, last_day = days[0]['used'], days[0]['day']
+                days = days[1:]
+            if not days and last_day >= end_day:
+                continue
+
+            for bucket in days:
+                if bucket['day'] <= last_day:
+                    # late ledger rows (e.g. synced offline sales) go into the current value
+                    usage += alpha * bucket['used']
+                    continue
+                usage *= (1 - alpha) ** ((bucket['day'] - last_day).days - 1)
+                usage = alpha * bucket['used'] + (1 - alpha) * usage
+                last_day = bucket['day']
+            if end_day > last_day:
+                usage *= (1 - alpha) ** (end_day - last_day).days
+                last_day = end_day
+
+            estimates.append({'inventory_id': inventory_id,
+                              'usage': usage,
+                              'last_day': last_day,
+                              'last_record_id': last_record_id})
+
+        if not self.db.save_daily_usage_estimates(estimates):
+            return -1
+        return len(estimates)
+
+
+    @staticmethod
+    def _replay_movement(stocks: dict[int, float], movement) -> None:
+        # same rule as _calculate_inventory: a manual report resets the stock, changes add up
+        if movement.manual_report is not None:
+            stocks[movement.inventory_id] = movement.manual_report
+        else:
+            stocks[movement.inventory_id] = stocks.get(movement.inventory_id, 0) + (movement.change_amount or 0)
+
+    def build_stock_snapshots(self, until: datetime = None) -> int:
+        """
+        Nightly job: writes end of day stock of every item that had ledger rows that day.
+
+        Continues after the last snapshot day up to yesterday (day of `until` is not complete).
+        If ledger rows were written for days already snapshotted (offline sales, corrections)
+        those days are rebuilt too.
+
+        Returns:
+            number of snapshots written, or -1 if saving failed
+        """
+        end = datetime.combine((until or datetime.now()).date(), time.min)
+        last_day, watermark = self.db.get_snapshot_state()
+
+        earliest_new = self.db.get_earliest_ledger_date(after_record_id=watermark)
+        candidates = [last_day + timedelta(days=1)] if last_day is not None else []
+        if earliest_new is not None:
+            candidates.append(earliest_new.date())
+        if not candidates or min(candidates) >= end.date():
+            return 0
+        from_day = min(candidates)
+
+        stocks = {snapshot.inventory_id: snapshot.stock for snapshot in self.db.get_latest_snapshots(before_day=from_day)}
+        snapshots: dict[tuple, dict] = {}
+        last_record_id = watermark
+        for movement in self.db.get_ledger_movements(from_date=datetime.combine(from_day, time.min), before=end):
+            self._replay_movement(stocks, movement)
+            last_record_id = max(last_record_id, movement.id)
+            snapshots[(movement.inventory_id, movement.date.date())] = {
+                'inventory_id': movement.inventory_id,
+                'day': movement.date.date(),
+                'stock': stocks[movement.inventory_id],
+                'last_record_id': last_record_id}
+
+        if not self.db.replace_snapshots(from_day, list(snapshots.values())):
+            return -1
+        return len(snapshots)
+
+    def stock_as_of(self, at: datetime, inventory_ids: Optional[list[int]] = None) -> dict[int, float]:
+        """
+        Stock of items at a point in time (ledger rows dated before `at`).
+
+        Starts from each items newest snapshot before that day and replays only the ledger
+        after it. Items without a snapshot are replayed from their first ledger row.
+
+        Returns:
+            dict of inventory id -> stock
+        """
+        snapshots = self.db.get_latest_snapshots(before_day=at.date(), inventory_ids=inventory_ids)
+        stocks = {snapshot.inventory_id: snapshot.stock for snapshot in snapshots}
+        replay_from = {snapshot.inventory_id: datetime.combine(snapshot.day + timedelta(days=1), time.min)
+                       for snapshot in snapshots}
+
+        movements = []
+        if snapshots:
+            movements += self.db.get_ledger_movements(from_date=min(replay_from.values()),
+                                                      before=at,
+                                                      inventory_ids=list(replay_from))
+        if inventory_ids is None:
+            movements += self.db.get_ledger_movements(before=at, exclude_inventory_ids=list(replay_from))
+        else:
+            without_snapshot = [inventory_id for inventory_id in inventory_ids if inventory_id not in replay_from]
+            if without_snapshot:
+                movements += self.db.get_ledger_movements(before=at, inventory_ids=without_snapshot)
+
+        for movement in movements:
+            start = replay_from.get(movement.inventory_id)
+            if start is None or movement.date >= start:
+                self._replay_movement(stocks, movement)
+
+        for inventory_id in inventory_ids or []:
+            stocks.setdefault(inventory_id, 0)
+        return stocks
+
+
     #do not handle gaps
     #Predict future needs based on
     def forecast_inventory(self, inventory_id, days=7) -> dict[str, float]:
@@ -327,6 +593,60 @@ class InventoryService:
 
 
 
+    def forecast_all_inventory(self, days: int = 14, start: datetime = None) -> list[dict]:
+        """
+        Projects the stock of every inventory item day by day over the horizon.
+
+        Each day the stock gets the open order deliveries expected that day (overdue ones on
+        the first day) and loses the larger of daily_usage and the forecasted menu sales
+        exploded through the recipes (prep items broken down). The larger, not the sum,
+        because daily_usage already contains the usual sales.
+
+        Uses a few queries for the whole catalogue, no per-item lookups.
+
+        Returns:
+            dicts with inventory_id, name, current_stock, projected_stock (end of horizon),
+            lowest_stock and stockout_date (first day the stock goes below zero, or None)
+        """
+        start = start or datetime.now()
+        first_day = start.date()
+        end = datetime.combine(first_day + timedelta(days=days), time.min)
+
+        incoming: dict[int, list[float]] = {}
+        for delivery in self.db.get_open_deliveries(until=end):
+            index = max((delivery['expected_delivery_date'].date() - first_day).days, 0)
+            incoming.setdefault(delivery['inventory_id'], [0.0] * days)[index] += delivery['amount']
+
+        forecasted: dict[int, list[float]] = {}
+        for usage in self.forecast_ingredient_usage(start, end):
+            from_day, to_day = usage['from_date'].date(), usage['to_date'].date()
+            per_day = usage['amount'] / ((to_day - from_day).days + 1)
+            row = forecasted.setdefault(usage['inventory_id'], [0.0] * days)
+            for index in range(max((from_day - first_day).days, 0), min((to_day - first_day).days + 1, days)):
+                row[index] += per_day
+
+        no_change = [0.0] * days
+        projections = []
+        for item in self.db.get_inventory():
+            stock = item.current_stock or 0
+            lowest = stock
+            stockout_date = None
+            item_incoming = incoming.get(item.id, no_change)
+            item_forecast = forecasted.get(item.id, no_change)
+            for index in range(days):
+                stock += item_incoming[index] - max(item.daily_usage or 0, item_forecast[index])
+                lowest = min(lowest, stock)
+                if stock < 0 and stockout_date is None:
+                    stockout_date = first_day + timedelta(days=index)
+            projections.append({'inventory_id': item.id,
+                                'name': item.name,
+                                'current_stock': item.current_stock or 0,
+                                'projected_stock': stock,
+                                'lowest_stock': lowest,
+                                'stockout_date': stockout_date})
+        return projections
+
+
     def create_new_inventory_item(self,
                                   item_name:str,
                                   unit:str,
@@ -3,14 +3,20 @@ from typing import Optional
 
 from models.dbhandler import DBHandler
 from models.cafe_managment_models import Inventory, Menu, Recipe, EstimatedMenuPriceRecord
+from services.cost_allocation import CostAllocator, COST_CATEGORIES
+
+# price estimates older than this are thinned out to one per month
+PRICE_HISTORY_DAYS = 180
 
 
 class MenuPriceService:
     def __init__(self, db_handler: DBHandler):
         self.db = db_handler
+        self.costs = CostAllocator(db_handler)
 
 
-    def _calculate_suggested_price(self, direct_cost: float, indirect_cost: float,
+    @staticmethod
+    def _calculate_suggested_price(direct_cost: float, indirect_cost: float,
                               sales_forecast: int, profit_margin: float) -> Optional[float]:
         """the calculation of the estimated price to suggest it"""
         if not sales_forecast:
@@ -26,81 +32,9 @@ class MenuPriceService:
 
 
 
-    def _time_difference_to_float_hr(self, start:time, end:time)->float:
-        today = datetime.today().date()
-        dt_start = datetime.combine(today, start)
-        dt_end = datetime.combine(today, end)
-
-        if dt_end < dt_start:
-            dt_end += timedelta(days=1)
-
-        delta = dt_end - dt_start
-        return delta.total_seconds() / 3600
-
-    def _time_to_float_hr(self, time_obj: time) -> float:
-        """Convert time object to float hours"""
-        if not time_obj:
-            return 0.0
-        return time_obj.hour + time_obj.minute / 60.0 + time_obj.second / 3600.0
-
-    #todo this looks like shit
     def _get_estimated_labor_cost(self, from_date, to_date):
-        """this estimates the price of labor in shifts"""
-        shifts = self.db.get_shift(from_date=from_date, to_date=to_date)
-        total_labor_cost = 0
-
-        for shift  in shifts:
-            if not shift :
-                continue
-
-            # Get all labor assignments for this shift
-            labor_assignments = self.db.get_estimatedlabor(shift_id=shift.id)
-            for labor in labor_assignments:
-                if not labor:
-                    continue
-
-                # Get the position details
-                positions = self.db.get_targetpositionandsalary(id=labor.position_id)
-                if not positions:
-                    continue
-
-                position = positions[0]
-
-                # Calculate shift duration in hours
-                shift_duration = self._time_difference_to_float_hr(shift.from_hr, shift.to_hr)
-
-                # Calculate regular hours (total hours minus overtime)
-                regular_hours = max(0, shift_duration - self._time_to_float_hr(labor.extra_hr))
-
-                # Calculate overtime hours
-                overtime_hours = self._time_to_float_hr(labor.extra_hr)
-
-                # Calculate hourly rate
-                if position.monthly_hr and position.monthly_hr > 0:
-                    hourly_rate = position.monthly_payment / position.monthly_hr if position.monthly_payment else 0
-                else:
-                    hourly_rate = 0
-
-                # Calculate overtime rate
-                overtime_rate = position.extra_hr_payment if position.extra_hr_payment else hourly_rate * 1.4  # Default 1.4x for overtime
-
-                # Normal payment for regular hours
-                normal_payment = regular_hours * hourly_rate * labor.number
-
-                # Overtime payment
-                overtime_payment = overtime_hours * overtime_rate * labor.number
-
-                # Insurance (daily pro-rata)
-                daily_insurance = (position.monthly_insurance
-                                   / 30) * labor.number if position.monthly_insurance else 0
-
-                # Extra payments from shift
-                extra_payment = shift.extra_payment if shift.extra_payment else 0
-
-                # Sum for this labor assignment
-                total_labor_cost += normal_payment + overtime_payment + daily_insurance + extra_payment
-
-        return total_labor_cost
+        """labor cost of the shifts from_date to to_date, one SUM over the per shift cost cache"""
+        return self.db.get_labor_cost_total(from_date, to_date)
 
 
 
@@ -125,15 +59,7 @@ class MenuPriceService:
                 menu_ids.append(item.id)
 
         for menu_id in menu_ids:
-            latest_item_records = self.db.get_estimatedmenupricerecord(menu_id=menu_id, row_num=1)
-            try:
-                print(menu_id, latest_item_records[0].manual_price)
-            except:
-                print("wtf could not")
-            if not latest_item_records:
-                the_record = None
-            else:
-                the_record = latest_item_records[0]
+            the_record = self.db.get_current_estimatedmenupricerecord(menu_id)
 
             last_direct_cost = the_record.direct_cost if getattr(the_record, "direct_cost", None)  else 0
             last_indirect_cost = the_record.estimated_indirect_costs if getattr(the_record, "estimated_indirect_costs", None) else 0
@@ -152,12 +78,18 @@ class MenuPriceService:
             if not suggested_price:
                 suggested_price = None
 
+            if the_record and (the_record.direct_cost, the_record.estimated_indirect_costs, the_record.sales_forecast,
+                               the_record.profit_margin, the_record.manual_price, the_record.estimated_price) == \
+                    (the_direct_cost, the_indirect_cost, the_sales_forecast, the_profit_margin, the_manual_price, suggested_price):
+                # nothing changed since the current estimate, no need for another record
+                continue
+
             print(menu_id, the_manual_price)
             new_record =  self.db.add_estimatedmenupricerecord(menu_id=menu_id,
-                                                               direct_cost=direct_cost,
-                                                               estimated_indirect_costs=indirect_cost,
-                                                               sales_forecast=sales_forecast,
-                                                               profit_margin=profit_margin,
+                                                               direct_cost=the_direct_cost,
+                                                               estimated_indirect_costs=the_indirect_cost,
+                                                               sales_forecast=the_sales_forecast,
+                                                               profit_margin=the_profit_margin,
                                                                manual_price=the_manual_price,
                                                                description=description,
                                                                category=category,
@@ -237,25 +169,8 @@ class MenuPriceService:
     #then should generate new record
     def calculate_indirect_cost(self, year=datetime.today().year, num_year=1, category:str = None)-> bool | float:
         """calculate the indirect costs"""
-        start_date = datetime(year=year, month=1, day=1)
-        end_date = datetime(year=year + num_year - 1, month=12, day=31)
-
-        list_of_rents = self.db.get_rent(from_date=start_date, to_date=end_date)
-        cost_rent = sum(r.rent + ((r.mortgage if r.mortgage else 0) * (r.mortgage_percentage_to_rent if r.mortgage_percentage_to_rent else 0)) for r in list_of_rents if r)
-
-
-        list_of_bills = self.db.get_estimatedbills(from_date=start_date, to_date=end_date)
-        cost_bills = sum(b.cost for b in list_of_bills if b)
-
-
-        list_equipment_depreciation = self.db.get_equipment(expire_from_date=start_date, purchase_to_date=end_date)
-        cost_equipment_depreciation = sum(e.monthly_depreciation for e in list_equipment_depreciation if e)
-
-
-        payment_labor = self._get_estimated_labor_cost(start_date, end_date)
-
-
-        indirect_price_overall = cost_rent + cost_bills + payment_labor + cost_equipment_depreciation
+        costs = self.indirect_cost_breakdown(year, num_year)
+        indirect_price_overall = sum(costs.values())
         if indirect_price_overall<= 0:
             return False
         if self._add_new_estimated_record_update_menu_suggestion(indirect_cost=indirect_price_overall, category=category):
@@ -264,6 +179,19 @@ class MenuPriceService:
         return False
 
 
+    def indirect_cost_breakdown(self, year=datetime.today().year, num_year=1) -> dict[str, float]:
+        """indirect costs of the years by kind: rent, bills, equipment and labor"""
+        start_date = datetime(year=year, month=1, day=1)
+        end_date = datetime(year=year + num_year - 1, month=12, day=31)
+
+        # rent, bills and depreciation prorated to the part that falls in the years
+        allocation = self.costs.allocate(start_date, datetime(year=year + num_year, month=1, day=1), period='year')
+        costs = {category: allocation.total(category) if allocation else 0 for category in COST_CATEGORIES}
+
+        costs['labor'] = self._get_estimated_labor_cost(start_date, end_date)
+        return costs
+
+
     #_____________________________menu manual changes updates______________________________________________
 
     def calculate_manual_price_change(self, menu_item_id, new_manual_price:float=None, profit_margin:float=None, category:Optional[str]="Manual Price Change")-> bool:
@@ -308,11 +236,7 @@ class MenuPriceService:
 
     # _____________________________forecast changes updates______________________________________________
     def calculate_forecast(self,year=datetime.today().year, num_year=1, category:Optional[str] = "Forecast Changed")-> bool:
-        start_date = datetime(year=year, month=1, day=1)
-        end_date = datetime(year=year + num_year, month=1, day=1)
-
-        list_of_forecasts = self.db.get_salesforecast(from_date=start_date, to_date=end_date)
-        number_of_sales_forecasted = sum(sf.sell_number for sf in list_of_forecasts if list_of_forecasts)
+        number_of_sales_forecasted = self.total_sales_forecast(year, num_year)
 
         if self._add_new_estimated_record_update_menu_suggestion(sales_forecast=number_of_sales_forecasted, category=category):
 
@@ -320,11 +244,21 @@ class MenuPriceService:
         return False
 
 
+    def total_sales_forecast(self, year=datetime.today().year, num_year=1) -> int:
+        """number of sales forecasted for the years, all menu items"""
+        start_date = datetime(year=year, month=1, day=1)
+        end_date = datetime(year=year + num_year, month=1, day=1)
+
+        list_of_forecasts = self.db.get_salesforecast(from_date=start_date, to_date=end_date)
+        return sum(sf.sell_number for sf in list_of_forecasts if list_of_forecasts)
+
+
     #_________________________________Read ______________________________________________
     def get_latest_update_price(self, menu_id:int)->Optional[EstimatedMenuPriceRecord]:
-        fetch = self.db.get_estimatedmenupricerecord(id=menu_id)
-        if fetch:
-            return fetch[0]
-        else:
-            return None
+        return self.db.get_current_estimatedmenupricerecord(menu_id)
+
+    def compact_price_history(self, keep_days:int=PRICE_HISTORY_DAYS, now:Optional[datetime]=None) -> int:
+        """keeps every estimate of the last keep_days and the last one of each month before that"""
+        now = now if now else datetime.now()
+        return self.db.compact_estimatedmenupricerecord(before=now - timedelta(days=keep_days))
 
@@ -0,0 +1,156 @@
+import json
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+# the buffer lives on the terminal (or an edge process next to it), not in the cafe db
+BufferBase = declarative_base()
+
+SYNCED_STATUSES = {'applied', 'duplicate'}
+CONFLICT_STATUSES = {'conflict', 'error'}
+
+
+class BufferedWrite(BufferBase):
+    __tablename__ = 'buffered_write'
+
+    id = Column(Integer, primary_key=True)
+    request_key = Column(String(100), nullable=False, unique=True)
+    kind = Column(String(20), nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default='pending', index=True)
+    error = Column(String(500))
+    attempts = Column(Integer, default=0)
+
+    time_create = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot store {type(value).__name__} in the buffer")
+
+
+class PosWriteBuffer:
+    """
+    Write-ahead queue of sales and payments kept in a local SQLite file.
+
+    Terminals enqueue writes while offline and push them in batches to the
+    bulk ingest endpoint (sale/batch). Every entry carries its own request key,
+    so a batch that timed out can be sent again without double sales.
+    """
+
+    def __init__(self, db_url="sqlite:///pos_buffer.db", terminal_id: str = "pos", engine=None):
+        self.engine = engine if engine else create_engine(db_url)
+        BufferBase.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.terminal_id = terminal_id
+
+    def _enqueue(self, kind: str, payload: dict, request_key: Optional[str] = None) -> Optional[str]:
+        request_key = request_key or f"{self.terminal_id}-{uuid.uuid4().hex}"
+        with self.Session() as session:
+            try:
+                session.add(BufferedWrite(request_key=request_key,
+                                          kind=kind,
+                                          payload=json.dumps(payload, default=_json_default)))
+                session.commit()
+                return request_key
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Failed to buffer {kind}: {e}")
+                return None
+
+    def enqueue_sale(self, request_key: Optional[str] = None, **kwargs) -> Optional[str]:
+        """
+        Buffers a sale (menu_id, quantity, discount, price, invoice_id or invoice_key, date, saler ...).
+        Returns the request key, pass it as invoice_key to add more to the same invoice.
+        """
+        kwargs.setdefault('date', datetime.now())
+        return self._enqueue('sale', kwargs, request_key)
+
+    def enqueue_payment(self, request_key: Optional[str] = None, **kwargs) -> Optional[str]:
+        """Buffers a payment (paid, payer, method, receiver, invoice_id or invoice_key ...)."""
+        kwargs.setdefault('date', datetime.now())
+        return self._enqueue('payment', kwargs, request_key)
+
+    def get_buffered(self, status: Optional[str] = 'pending', row_num: Optional[int] = None) -> list[BufferedWrite]:
+        with self.Session() as session:
+            query = session.query(BufferedWrite).order_by(BufferedWrite.id)
+            if status:
+                query = query.filter_by(status=status)
+            if row_num:
+                query = query.limit(row_num)
+            return query.all()
+
+    def sync(self, send_batch: Callable[[list[dict]], list[dict]], batch_size: int = 100) -> dict[str, int]:
+        """
+        Pushes pending writes in order, batch_size entries per call of send_batch.
+
+        send_batch posts the entries to the ingest endpoint and returns its results.
+        A transport error stops the sync and leaves the entries pending for the next try.
+        So does an entry that comes back as retry (or without result): it and every entry
+        after it stay pending, later entries may depend on it (a payment of the invoice a
+        sale opens) and are sent again after it.
+
+        Returns:
+            counts of synced, conflict and still pending entries
+        """
+        summary = {'synced': 0, 'conflict': 0, 'pending': 0}
+        while True:
+            batch = self.get_buffered(status='pending', row_num=batch_size)
+            if not batch:
+                break
+            entries = [{'request_key': item.request_key,
+                        'kind': item.kind,
+                        'payload': json.loads(item.payload)} for item in batch]
+            try:
+                results = send_batch(entries)
+            except Exception as e:
+                logging.error(f"Buffer sync failed, will retry later: {e}")
+                self._count_attempt([item.id for item in batch])
+                break
+
+            by_key = {result.get('request_key'): result for result in results or []}
+            if not self._apply_results(batch, by_key, summary):
+                break
+
+        summary['pending'] = len(self.get_buffered(status='pending'))
+        return summary
+
+    def _count_attempt(self, ids: list[int]):
+        with self.Session() as session:
+            session.query(BufferedWrite).filter(BufferedWrite.id.in_(ids)).update(
+                {BufferedWrite.attempts: BufferedWrite.attempts + 1}, synchronize_session=False)
+            session.commit()
+
+    def _apply_results(self, batch: list[BufferedWrite], by_key: dict[str, dict], summary: dict[str, int]) -> bool:
+        """Marks the entries up to the first unresolved one, True if the whole batch was resolved."""
+        resolved = True
+        with self.Session() as session:
+            for item in batch:
+                result = by_key.get(item.request_key) if resolved else None
+                stored = session.get(BufferedWrite, item.id)
+                stored.attempts = (stored.attempts or 0) + 1
+                if not resolved:
+                    continue
+                if result and result.get('status') in SYNCED_STATUSES:
+                    stored.status = 'synced'
+                    summary['synced'] += 1
+                elif result and result.get('status') in CONFLICT_STATUSES:
+                    stored.status = 'conflict'
+                    stored.error = str(result.get('error'))[:500]
+                    summary['conflict'] += 1
+                else:
+                    resolved = False
+            session.commit()
+        return resolved
+
+    def purge_synced(self) -> int:
+        """Removes entries the server already applied."""
+        with self.Session() as session:
+            removed = session.query(BufferedWrite).filter_by(status='synced').delete(synchronize_session=False)
+            session.commit()
+            return removed
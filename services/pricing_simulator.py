@@ -0,0 +1,117 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import product
+from typing import Optional
+
+from services.menu_pricing_service import MenuPriceService
+
+# grids with more menu x scenario prices than this are split over worker processes
+POOL_THRESHOLD = 200_000
+SCENARIO_FIELDS = ('profit_margin', 'sales_forecast', 'rent_factor', 'labor_factor')
+
+
+def _simulate_chunk(menu: dict, costs: dict[str, float], scenarios: list[dict]) -> list[list[Optional[float]]]:
+    """
+    Suggested prices of every menu item (columns of menu) for each scenario.
+    Runs in worker processes, so it only gets plain data.
+    """
+    direct, margins = menu['direct_cost'], menu['profit_margin']
+    fixed = costs['bills'] + costs['equipment']
+    results = []
+    for scenario in scenarios:
+        indirect = fixed + costs['rent'] * scenario['rent_factor'] + costs['labor'] * scenario['labor_factor']
+        forecast = scenario['sales_forecast']
+        margin = scenario['profit_margin']
+        results.append([MenuPriceService._calculate_suggested_price(
+                            direct_cost, indirect, forecast, margin if margin is not None else menu_margin)
+                         for direct_cost, menu_margin in zip(direct, margins)])
+    return results
+
+
+class PricingSimulator:
+    """
+    What-if pricing over grids of margins, forecasts, rent and labor costs.
+
+    Costs and the current estimate of every menu item are read once, then all
+    scenarios are computed in memory. Nothing is written to the database.
+    """
+
+    def __init__(self, pricing: MenuPriceService):
+        self.pricing = pricing
+        self.db = pricing.db
+
+    def _menu_columns(self, menu_ids: Optional[list[int]] = None) -> dict:
+        menu = {'id': [], 'name': [], 'current_price': [], 'estimated_price': [], 'direct_cost': [], 'profit_margin': []}
+        for menu_id, name, current_price, estimated_price, direct_cost, profit_margin in \
+                self.db.get_current_menu_estimates(menu_ids):
+            menu['id'].append(menu_id)
+            menu['name'].append(name)
+            menu['current_price'].append(current_price)
+            menu['estimated_price'].append(estimated_price)
+            menu['direct_cost'].append(direct_cost or 0)
+            menu['profit_margin'].append(profit_margin or 0)
+        return menu
+
+    def simulate(self,
+                 profit_margins: Optional[list[Optional[float]]] = None,
+                 sales_forecasts: Optional[list[int]] = None,
+                 rent_factors: Optional[list[float]] = None,
+                 labor_factors: Optional[list[float]] = None,
+                 menu_ids: Optional[list[int]] = None,
+                 year: int = datetime.today().year,
+                 workers: Optional[int] = None,
+                 pool_threshold: int = POOL_THRESHOLD) -> list[dict]:
+        """
+        Suggested prices for every combination of the given values.
+
+        Args:
+            profit_margins: margins applied to all items, None keeps each item's own margin
+            sales_forecasts: total sales forecasts, default the forecast of the year
+            rent_factors: multipliers of the rent cost (1.1 = rent up 10%)
+            labor_factors: multipliers of the labor cost
+            menu_ids: only these menu items
+            workers: max worker processes for large grids
+        Returns:
+            one row per scenario and menu item with the current and simulated prices
+        """
+        menu = self._menu_columns(menu_ids)
+        if not menu['id']:
+            return []
+        costs = self.pricing.indirect_cost_breakdown(year)
+        scenarios = [dict(zip(SCENARIO_FIELDS, values)) for values in product(
+            profit_margins or [None],
+            sales_forecasts or [self.pricing.total_sales_forecast(year)],
+            rent_factors or [1.0],
+            labor_factors or [1.0])]
+
+        if len(scenarios) * len(menu['id']) > pool_threshold and len(scenarios) > 1:
+            prices = self._simulate_in_pool(menu, costs, scenarios, workers)
+        else:
+            prices = _simulate_chunk(menu, costs, scenarios)
+
+        table = []
+        for number, (scenario, scenario_prices) in enumerate(zip(scenarios, prices)):
+            for index, price in enumerate(scenario_prices):
+                current = menu['current_price'][index]
+                table.append({'scenario': number,
+                              **scenario,
+                              'menu_id': menu['id'][index],
+                              'name': menu['name'][index],
+                              'current_price': current,
+                              'estimated_price': menu['estimated_price'][index],
+                              'simulated_price': price,
+                              'difference': price - current if price is not None and current is not None else None})
+        return table
+
+    @staticmethod
+    def _simulate_in_pool(menu: dict, costs: dict[str, float], scenarios: list[dict],
+                          workers: Optional[int]) -> list[list[Optional[float]]]:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            size = max(1, len(scenarios) // (workers * 4))
+            chunks = [scenarios[start:start + size] for start in range(0, len(scenarios), size)]
+            logging.info(f"Simulating {len(scenarios)} pricing scenarios in {len(chunks)} chunks")
+            futures = [pool.submit(_simulate_chunk, menu, costs, chunk) for chunk in chunks]
+            return [prices for future in futures for prices in future.result()]
@@ -0,0 +1,213 @@
+import logging
+import threading
+from array import array
+from typing import Optional
+
+from models.dbhandler import DBHandler, RECIPE_CACHE
+
+EPSILON = 1e-9
+
+
+class RecipeMatrix:
+    """
+    All recipes compiled into two sparse menu x inventory matrices, stored CSR style
+    (row offsets, column indexes and amounts in flat arrays).
+
+    direct:   what one menu item takes from stock as its recipe is written (prep items included)
+    exploded: prep items replaced by the raw inventory they are made of, for purchase planning
+    """
+
+    def __init__(self, menu_rows, prep_rows):
+        self.prep: dict[int, list[tuple[int, float]]] = {}
+        for prep_id, inventory_id, amount in prep_rows:
+            self.prep.setdefault(prep_id, []).append((inventory_id, amount))
+
+        by_menu: dict[int, list[tuple[int, float]]] = {}
+        for menu_id, inventory_id, amount in menu_rows:
+            by_menu.setdefault(menu_id, []).append((inventory_id, amount or 0))
+
+        used = {inventory_id for rows in by_menu.values() for inventory_id, _ in rows}
+        used |= set(self.prep) | {inventory_id for rows in self.prep.values() for inventory_id, _ in rows}
+        self.inventory_ids = sorted(used)
+        self.column = {inventory_id: index for index, inventory_id in enumerate(self.inventory_ids)}
+        self.menu_ids = sorted(by_menu)
+        self.row = {menu_id: index for index, menu_id in enumerate(self.menu_ids)}
+
+        self._raw: dict[int, dict[int, float]] = {}
+        self.prep_order = self._prep_order()
+        self.direct = self._compile([by_menu[menu_id] for menu_id in self.menu_ids])
+        self.exploded = self._compile([self._explode(by_menu[menu_id]) for menu_id in self.menu_ids])
+
+    def _compile(self, rows: list[list[tuple[int, float]]]) -> tuple[array, array, array]:
+        indptr, indices, data = array('l', [0]), array('l'), array('d')
+        for entries in rows:
+            merged: dict[int, float] = {}
+            for inventory_id, amount in entries:
+                merged[inventory_id] = merged.get(inventory_id, 0) + amount
+            for inventory_id in sorted(merged):
+                indices.append(self.column[inventory_id])
+                data.append(merged[inventory_id])
+            indptr.append(len(indices))
+        return indptr, indices, data
+
+    def _prep_order(self) -> list[int]:
+        """Prep items ordered so that a prep comes before the preps it is made of."""
+        order, state = [], {}
+
+        def visit(prep_id):
+            if state.get(prep_id) == 'done':
+                return
+            if state.get(prep_id) == 'open':
+                raise ValueError(f"Prep recipe of inventory {prep_id} uses itself")
+            state[prep_id] = 'open'
+            for inventory_id, _ in self.prep.get(prep_id, []):
+                if inventory_id in self.prep:
+                    visit(inventory_id)
+            state[prep_id] = 'done'
+            order.append(prep_id)
+
+        for prep_id in self.prep:
+            visit(prep_id)
+        return order[::-1]
+
+    def _raw_of(self, inventory_id: int) -> dict[int, float]:
+        """Raw inventory in one unit of the item (the item itself if it is not a prep)."""
+        if inventory_id not in self.prep:
+            return {inventory_id: 1}
+        if inventory_id not in self._raw:
+            raw: dict[int, float] = {}
+            for ingredient_id, amount in self.prep[inventory_id]:
+                for raw_id, raw_amount in self._raw_of(ingredient_id).items():
+                    raw[raw_id] = raw.get(raw_id, 0) + amount * raw_amount
+            self._raw[inventory_id] = raw
+        return self._raw[inventory_id]
+
+    def _explode(self, entries: list[tuple[int, float]]) -> list[tuple[int, float]]:
+        return [(raw_id, amount * raw_amount)
+                for inventory_id, amount in entries
+                for raw_id, raw_amount in self._raw_of(inventory_id).items()]
+
+    def needs(self, quantities: dict[int, float], exploded: bool = False) -> dict[int, float]:
+        """
+        Inventory needed for the given menu quantities (sparse row sum).
+
+        Args:
+            quantities: menu id -> number of items
+            exploded: in raw ingredients instead of prep items
+        Returns:
+            inventory id -> amount
+        """
+        indptr, indices, data = self.exploded if exploded else self.direct
+        totals = array('d', bytes(8 * len(self.inventory_ids)))
+        for menu_id, quantity in quantities.items():
+            row = self.row.get(menu_id)
+            if row is None or not quantity:
+                continue
+            for position in range(indptr[row], indptr[row + 1]):
+                totals[indices[position]] += data[position] * quantity
+        return {self.inventory_ids[index]: total for index, total in enumerate(totals) if total}
+
+    def takes(self, cart: dict[int, float], stock: dict[int, float]) -> dict[int, float]:
+        """
+        What the cart takes out of stock: the recipes, with the part of a prep item
+        short in stock made from its ingredients (recursively).
+
+        Returns:
+            inventory id -> amount
+        """
+        needs = self.needs(cart)
+        for prep_id in self.prep_order:
+            short = needs.get(prep_id, 0) - (stock.get(prep_id) or 0)
+            if short <= EPSILON:
+                continue
+            needs[prep_id] = stock.get(prep_id) or 0
+            for ingredient_id, amount in self.prep[prep_id]:
+                needs[ingredient_id] = needs.get(ingredient_id, 0) + short * amount
+        return {inventory_id: amount for inventory_id, amount in needs.items() if amount > EPSILON}
+
+    def check_cart(self, cart: dict[int, float], stock: dict[int, float]) -> tuple[bool, dict[int, float]]:
+        """
+        Can the cart be made from stock. Prep items short in stock are made from
+        their ingredients (recursively) before counting them as missing.
+
+        Returns:
+            (all available, inventory id -> missing amount)
+        """
+        needs = self.takes(cart, stock)
+        missing = {inventory_id: need - (stock.get(inventory_id) or 0)
+                   for inventory_id, need in needs.items()
+                   if need - (stock.get(inventory_id) or 0) > EPSILON}
+        return not missing, missing
+
+    def inventory_of(self, menu_ids: list[int]) -> set[int]:
+        """Inventory the menu items can take from stock: their recipes and what their prep items are made of."""
+        indptr, indices, _ = self.direct
+        found, stack = set(), []
+        for menu_id in menu_ids:
+            row = self.row.get(menu_id)
+            if row is not None:
+                stack.extend(self.inventory_ids[indices[position]] for position in range(indptr[row], indptr[row + 1]))
+        while stack:
+            inventory_id = stack.pop()
+            if inventory_id not in found:
+                found.add(inventory_id)
+                stack.extend(ingredient_id for ingredient_id, _ in self.prep.get(inventory_id, []))
+        return found
+
+    def max_producible(self, stock: dict[int, float], menu_ids: Optional[list[int]] = None) -> dict[int, int]:
+        """
+        How many of each menu item (or only of menu_ids) the stock allows on its own
+        (prep items from stock only).
+        """
+        indptr, indices, data = self.direct
+        result = {}
+        rows = enumerate(self.menu_ids) if menu_ids is None else \
+            [(self.row[menu_id], menu_id) for menu_id in menu_ids if menu_id in self.row]
+        for row, menu_id in rows:
+            counts = [int((stock.get(self.inventory_ids[indices[position]]) or 0) / data[position] + EPSILON)
+                      for position in range(indptr[row], indptr[row + 1]) if data[position] > 0]
+            result[menu_id] = max(min(counts), 0) if counts else 0
+        return result
+
+    def would_cycle(self, prep_id: int, inventory_id: int) -> bool:
+        """True if making prep_id from inventory_id would make a prep use itself."""
+        stack, seen = [inventory_id], set()
+        while stack:
+            current = stack.pop()
+            if current == prep_id:
+                return True
+            if current in seen:
+                continue
+            seen.add(current)
+            stack.extend(ingredient_id for ingredient_id, _ in self.prep.get(current, []))
+        return False
+
+
+class RecipeMatrixCache:
+    """
+    Keeps the compiled RecipeMatrix in memory. It is rebuilt when invalidate() is called
+    after a recipe change here, or when the recipe CacheVersion was bumped by a recipe
+    write of any worker (one primary key read per get).
+    """
+
+    def __init__(self, db_handler: DBHandler):
+        self.db = db_handler
+        self._matrix = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self) -> RecipeMatrix:
+        version = self.db.get_cache_version(RECIPE_CACHE)
+        with self._lock:
+            # an unreadable version (None) never matches, the matrix is compiled again
+            if self._matrix is None or version is None or version != self._version:
+                menu_rows, prep_rows = self.db.get_recipe_matrix_rows()
+                self._matrix = RecipeMatrix(menu_rows, prep_rows)
+                self._version = version
+                logging.info(f"Recipe matrix compiled: {len(self._matrix.menu_ids)} menus, "
+                             f"{len(self._matrix.inventory_ids)} inventory items")
+            return self._matrix
+
+    def invalidate(self):
+        with self._lock:
+            self._matrix = None
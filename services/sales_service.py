@@ -1,20 +1,43 @@
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import Optional, Callable
 
-from models.dbhandler import DBHandler
+from models.dbhandler import DBHandler, CONFLICT_RETRIES
 from models.cafe_managment_models import Sales, Invoice, InvoicePayment, Menu, SalesForecast
 
 
+# closed invoices older than this move to the per year archive files
+SALES_HOT_DAYS = 180
+
+
 class SalesService:
     def __init__(self, db_handler: DBHandler):
         self.db = db_handler
 
+    def archive_old_invoices(self, keep_days: int = SALES_HOT_DAYS, until: datetime = None) -> int:
+        """Periodic job: moves closed invoices (with sales and payments) older than keep_days to the archive."""
+        return self.db.archive_invoices(before=(until or datetime.now()) - timedelta(days=keep_days))
+
+    def _edit_invoice(self, invoice_id, apply_change: Callable[[Invoice], None]) -> bool:
+        """
+        Reads the invoice, applies the change and saves it. If another worker saved
+        the invoice in between (version mismatch) it is read again and the change re-applied.
+        """
+        for _ in range(CONFLICT_RETRIES):
+            found = self.db.get_invoice(id=invoice_id)
+            if not found:
+                return False
+            the_invoice = found[0]
+            apply_change(the_invoice)
+            if self.db.edit_invoice(the_invoice):
+                return True
+        return False
+
     def _update_invoice_price(self, invoice_id):
-        the_invoice = self.db.get_invoice(id=invoice_id)[0]
-        full_price = sum(sales.price for sales in the_invoice.sales)
-        full_discount = sum(sales.discount for sales in the_invoice.sales)
-        the_invoice.total_price = full_price - full_discount
-        return bool(self.db.edit_invoice(the_invoice))
+        def set_total(the_invoice: Invoice):
+            full_price = sum(sales.price for sales in the_invoice.sales)
+            full_discount = sum(sales.discount for sales in the_invoice.sales)
+            the_invoice.total_price = full_price - full_discount
+        return self._edit_invoice(invoice_id, set_total)
 
     def _calculate_invoice_remain(self, invoice_id):
         the_invoice = self.db.get_invoice(id=invoice_id)[0]
@@ -62,6 +85,33 @@ class SalesService:
 
 
 
+    def record_sale(self,
+                    menu_item: Menu,
+                    quantity,
+                    stock_changes: list[dict],
+                    discount=0,
+                    price=None,
+                    invoice_id=None,
+                    description=None,
+                    date=None,
+                    saler=None,
+                    request_key: Optional[str] = None,
+                    valuation_method: Optional[str] = "fifo") -> tuple[str, Optional[Sales]]:
+        """process_sale with its stock deduction and request key in one transaction (DBHandler.record_sale)"""
+        if price is None:
+            price = menu_item.current_price * quantity
+        return self.db.record_sale(menu_id=menu_item.id,
+                                   number=quantity,
+                                   price=price,
+                                   stock_changes=stock_changes,
+                                   discount=discount,
+                                   invoice_id=invoice_id,
+                                   saler=saler,
+                                   date=date,
+                                   description=description,
+                                   request_key=request_key,
+                                   valuation_method=valuation_method)
+
     #undo sale & restock
     def cancel_sale(self, menu_id, invoice_id, quantity=None, discount=None, price=None):
         sales = self.db.get_sales(menu_id=menu_id, invoice_id=invoice_id)
@@ -169,14 +219,9 @@ class SalesService:
             self.db.edit_invoicepayment(the_payment)
             remain = 0
 
-        if remain == 0:
-            the_invoice = self.db.get_invoice(id=invoice_id)[0]
-            the_invoice.closed = True
-            self.db.edit_invoice(the_invoice)
-        else:
-            the_invoice = self.db.get_invoice(id=invoice_id)[0]
-            the_invoice.closed = False
-            self.db.edit_invoice(the_invoice)
+        def set_closed(the_invoice: Invoice):
+            the_invoice.closed = remain == 0
+        self._edit_invoice(invoice_id, set_closed)
 
         return True
 
@@ -0,0 +1,179 @@
+import logging
+import math
+from datetime import datetime, timedelta
+from typing import Optional
+
+from models.dbhandler import DBHandler
+from models.interval_index import shift_interval
+from models.position_salary_index import PositionSalaryIndex
+
+# sold items one person of a position can handle in an hour, unless given per position
+DEFAULT_ITEMS_PER_HOUR = 20.0
+HISTORY_WEEKS = 8
+HOUR = timedelta(hours=1)
+
+
+def _overlap(start: datetime, end: datetime, from_date: datetime, to_date: datetime) -> float:
+    """Share of [start, end) that falls in [from_date, to_date)."""
+    if end <= start:
+        return 1.0 if from_date <= start < to_date else 0.0
+    inside = min(end, to_date) - max(start, from_date)
+    return max(inside / (end - start), 0.0)
+
+
+def cheapest_staffing(peak: float, positions: list[tuple[int, float, float]],
+                      min_staff: int = 1) -> dict[int, int]:
+    """
+    Greedy min-cost staff counts whose summed capacity covers peak.
+
+    Args:
+        peak: demand (items per hour) at the busiest hour of the shift
+        positions: (position_id, capacity per person, cost per person)
+        min_staff: people on the shift even without demand
+    Returns:
+        {position_id: number}
+    """
+    positions = [position for position in positions if position[1] > 0]
+    if not positions:
+        return {}
+    by_ratio = min(positions, key=lambda position: (position[2] / position[1], position[2]))
+    counts: dict[int, int] = {}
+    needed = peak
+    while needed > 1e-9:
+        # finish with one person when that is cheaper than filling up with the best ratio position
+        covering = [position for position in positions if position[1] >= needed]
+        cover = min(covering, key=lambda position: position[2]) if covering else None
+        if cover and cover[2] <= by_ratio[2] * math.ceil(needed / by_ratio[1]):
+            chosen = cover
+        else:
+            chosen = by_ratio
+        counts[chosen[0]] = counts.get(chosen[0], 0) + 1
+        needed -= chosen[1]
+
+    cheapest = min(positions, key=lambda position: position[2])
+    missing = min_staff - sum(counts.values())
+    if missing > 0:
+        counts[cheapest[0]] = counts.get(cheapest[0], 0) + missing
+    return counts
+
+
+class StaffingOptimizer:
+    """
+    Plans how many people of each position every shift needs.
+
+    Hourly demand is the average of sold items per weekday and hour over the past
+    weeks of invoices, scaled to the sales forecast of the window when there is one.
+    Each shift is staffed for its busiest hour at the lowest cost with a greedy
+    solver, and the result replaces the shift's EstimatedLabor rows in one write.
+    """
+
+    def __init__(self, db_handler: DBHandler):
+        self.db = db_handler
+
+    def hourly_demand(self, from_date: datetime, to_date: datetime,
+                      history_weeks: int = HISTORY_WEEKS) -> dict[tuple[int, int], float]:
+        """{(weekday, hour): expected sold items} for [from_date, to_date)."""
+        history_from = from_date - timedelta(weeks=history_weeks)
+        profile = {(weekday, hour): items / history_weeks
+                   for weekday, hour, items in self.db.get_hourly_sales(history_from, from_date)}
+
+        forecast = sum(number * _overlap(start, end, from_date, to_date)
+                       for start, end, number in self.db.get_forecast_rows(from_date, to_date) if start)
+        if not forecast:
+            return profile
+
+        expected = 0.0
+        day = datetime(from_date.year, from_date.month, from_date.day)
+        while day < to_date:
+            share = _overlap(day, day + timedelta(days=1), from_date, to_date)
+            expected += share * sum(items for (weekday, _), items in profile.items() if weekday == day.weekday())
+            day += timedelta(days=1)
+        if not expected:
+            return {}
+        factor = forecast / expected
+        return {key: items * factor for key, items in profile.items()}
+
+    @staticmethod
+    def _positions(salaries: PositionSalaryIndex, date: datetime,
+                   capacities: Optional[dict[str, float]]) -> list[tuple]:
+        """(position_id, position, capacity, hourly cost) of the salary terms in force on date."""
+        positions = []
+        for name, terms in salaries.in_force(date).items():
+            if not terms.monthly_hr:
+                continue
+            capacity = capacities.get(name, 0) if capacities is not None else DEFAULT_ITEMS_PER_HOUR
+            hourly = ((terms.monthly_payment or 0) + (terms.monthly_insurance or 0)) / terms.monthly_hr
+            positions.append((terms.id, name, capacity, hourly))
+        return positions
+
+    def plan(self,
+             from_date: datetime,
+             to_date: datetime,
+             capacities: Optional[dict[str, float]] = None,
+             min_staff: int = 1,
+             history_weeks: int = HISTORY_WEEKS,
+             write: bool = True) -> Optional[list[dict]]:
+        """
+        Args:
+            from_date: first shift date
+            to_date: end of the window (exclusive)
+            capacities: items per hour one person handles, by position name;
+                        positions left out are not planned. Default DEFAULT_ITEMS_PER_HOUR for all
+            min_staff: people on every shift even without demand
+            write: replace the EstimatedLabor rows of the planned shifts, routine occurrences
+                   of the window are stored as shifts first (materialize_routine_shift)
+        Returns:
+            one row per shift with its peak demand, staff and cost (shift_id None for a routine
+            occurrence when not writing), None if writing failed
+        """
+        if to_date <= from_date:
+            return []
+        if capacities is not None:
+            capacities = {name.lower().strip(): capacity for name, capacity in capacities.items()}
+        demand = self.hourly_demand(from_date, to_date, history_weeks)
+        salaries = self.db.get_position_salary_index()
+        shifts = [shift for shift in self.db.get_shift(from_date=from_date, to_date=to_date)
+                  if shift.date < to_date and shift.from_hr and shift.to_hr]
+        occurrences = [shift for shift in self.db.iter_routine_shifts(from_date, to_date - timedelta(microseconds=1))
+                       if from_date <= shift.date < to_date]
+        if write:
+            # EstimatedLabor needs a Shift row, routine occurrences of the window get stored
+            for occurrence in occurrences:
+                stored = self.db.materialize_routine_shift(occurrence.routine_id, occurrence.date)
+                if stored is None:
+                    return None
+                shifts.append(stored)
+        else:
+            shifts.extend(occurrences)
+
+        plan, rows = [], []
+        for shift in sorted(shifts, key=lambda shift: (shift.date, shift.from_hr)):
+            start, end = shift_interval(shift.date, shift.from_hr, shift.to_hr)
+            hours = (end - start) / HOUR
+            peak, hour = 0.0, start.replace(minute=0, second=0, microsecond=0)
+            while hour < end:
+                peak = max(peak, demand.get((hour.weekday(), hour.hour), 0.0))
+                hour += HOUR
+
+            positions = self._positions(salaries, shift.date, capacities)
+            names = {position_id: name for position_id, name, _, _ in positions}
+            hourly = {position_id: cost for position_id, _, _, cost in positions}
+            counts = cheapest_staffing(peak, [(position_id, capacity, cost * hours)
+                                              for position_id, _, capacity, cost in positions], min_staff)
+            rows.extend({'shift_id': shift.id, 'position_id': position_id, 'number': number, 'extra_hr': None}
+                        for position_id, number in counts.items())
+            plan.append({'shift_id': shift.id,
+                         'routine_id': shift.routine_id,
+                         'date': shift.date,
+                         'name': shift.name,
+                         'peak_demand': round(peak, 2),
+                         'staff': [{'position_id': position_id, 'position': names[position_id], 'number': number}
+                                   for position_id, number in counts.items()],
+                         'cost': round(sum(hourly[position_id] * hours * number
+                                           for position_id, number in counts.items()), 2)})
+
+        if write and shifts:
+            if self.db.replace_estimatedlabor([shift.id for shift in shifts], rows) < 0:
+                return None
+            logging.info(f"Staffing planned for {len(shifts)} shifts")
+        return plan
@@ -0,0 +1,146 @@
+import csv
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from models.dbhandler import DBHandler
+from models.interval_index import shift_interval
+
+BATCH_SIZE = 5000
+# a clock-in with no clock-out within this is dropped, the person forgot to punch out
+MAX_SHIFT_HOURS = 16
+MAX_REPORTED_ERRORS = 50
+
+
+def _parse_punch(row: dict) -> tuple[int, datetime, Optional[str]]:
+    """(personal_id, time, 'in'/'out'/None) of a csv row, ValueError if it is not a punch"""
+    # fields past the header come as a list under the None key, readers often add a trailing one
+    row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key is not None}
+    personal_id = int(row.get('personal_id', ''))
+    punched = datetime.fromisoformat(row.get('time') or row.get('timestamp', ''))
+    direction = row.get('direction', '').lower() or None
+    if direction not in (None, 'in', 'out'):
+        raise ValueError(f"direction should be in or out, not {direction}")
+    return personal_id, punched, direction
+
+
+class TimeClockImporter:
+    """
+    Imports badge reader exports (csv with personal_id, time and optional direction) as WorkShiftRecord rows.
+
+    The csv is read row by row. Each person's punches are paired in to out (alternating when there is
+    no direction column), records are matched to the person's assigned shift with the largest overlap
+    (stored in shift_id) for its lunch/service/extra payments, and written in batches. Every batch moves
+    a checkpoint per source, an import that stopped is resumed by running it again with the same source.
+    """
+
+    def __init__(self, db_handler: DBHandler):
+        self.db = db_handler
+
+    def ingest(self, source: str, lines: Iterable[str], batch_size: int = BATCH_SIZE) -> Optional[dict]:
+        """
+        Args:
+            source: name of the export, the checkpoint is kept per source
+            lines: csv text lines, a file or an upload stream
+        Returns:
+            summary of the import, None when a batch could not be written
+        """
+        checkpoint = self.db.get_timeclock_checkpoint(source)
+        summary = {'source': source, 'punches': 0, 'records': 0, 'skipped': 0, 'error_count': 0, 'errors': []}
+
+        def error(line: int, message: str):
+            summary['error_count'] += 1
+            if len(summary['errors']) < MAX_REPORTED_ERRORS:
+                summary['errors'].append(f"line {line}: {message}")
+
+        open_punches: dict[int, tuple[int, datetime]] = {}
+        last_punch: dict[int, datetime] = {}
+        pending: list[tuple[int, datetime, datetime]] = []
+        max_shift = timedelta(hours=MAX_SHIFT_HOURS)
+        line = checkpoint
+
+        reader = csv.DictReader(lines)
+        for row in reader:
+            line = reader.line_num
+            if line <= checkpoint:
+                continue
+            try:
+                personal_id, punched, direction = _parse_punch(row)
+            except (ValueError, TypeError) as e:
+                error(line, f"not a punch ({e})")
+                continue
+            summary['punches'] += 1
+
+            if personal_id in last_punch and punched < last_punch[personal_id]:
+                error(line, f"punch of {personal_id} is older than the previous one")
+                continue
+            last_punch[personal_id] = punched
+
+            opened = open_punches.pop(personal_id, None)
+            if opened and (direction == 'in' or punched - opened[1] > max_shift):
+                error(opened[0], f"clock-in of {personal_id} has no clock-out")
+                opened = None
+            if opened:
+                pending.append((personal_id, opened[1], punched))
+            elif direction == 'out':
+                error(line, f"clock-out of {personal_id} without clock-in")
+            else:
+                open_punches[personal_id] = (line, punched)
+
+            if len(pending) >= batch_size:
+                if not self._flush(source, pending, open_punches, line, summary):
+                    return None
+                pending = []
+
+        # a clock-in that long before the last punch of the file will not get its clock-out,
+        # left open it would hold the checkpoint there for good
+        latest = max(last_punch.values(), default=None)
+        for personal_id, (opened_line, opened_at) in list(open_punches.items()):
+            if latest - opened_at > max_shift:
+                error(opened_line, f"clock-in of {personal_id} has no clock-out")
+                del open_punches[personal_id]
+
+        if not self._flush(source, pending, open_punches, line, summary):
+            return None
+        summary['open'] = len(open_punches)
+        summary['checkpoint'] = self.db.get_timeclock_checkpoint(source)
+        return summary
+
+    def _flush(self, source: str, pending: list, open_punches: dict, line: int, summary: dict) -> bool:
+        # lines of punches still waiting for their clock-out are read again next time
+        done = min((opened_line for opened_line, _ in open_punches.values()), default=line + 1) - 1
+        written, skipped = self.db.write_timeclock_batch(source, self._records(pending), done)
+        if written < 0:
+            return False
+        summary['records'] += written
+        summary['skipped'] += skipped
+        return True
+
+    def _records(self, pending: list[tuple[int, datetime, datetime]]) -> list[dict]:
+        if not pending:
+            return []
+        slots: dict[int, list] = {}
+        for personal_id, shift_id, date, from_hr, to_hr, lunch, service, extra in self.db.get_assigned_shift_slots(
+                list({personal_id for personal_id, _, _ in pending}),
+                min(start for _, start, _ in pending) - timedelta(days=1),
+                max(end for _, _, end in pending)):
+            if from_hr and to_hr:
+                slots.setdefault(personal_id, []).append((*shift_interval(date, from_hr, to_hr),
+                                                          shift_id, lunch, service, extra))
+
+        records = []
+        for personal_id, start, end in pending:
+            best, best_overlap = None, timedelta(0)
+            for slot in slots.get(personal_id, []):
+                overlap = min(end, slot[1]) - max(start, slot[0])
+                if overlap > best_overlap:
+                    best, best_overlap = slot, overlap
+            records.append({'personal_id': personal_id,
+                            'from_date': start,
+                            'to_date': end,
+                            'worked_hr': round((end - start).total_seconds() / 3600, 2),
+                            'lunch_paid': (best[3] or 0) if best else 0,
+                            'service_paid': (best[4] or 0) if best else 0,
+                            'extra_paid': (best[5] or 0) if best else 0,
+                            'shift_id': best[2] if best else None,
+                            'description': f"time clock, shift {best[2]}" if best else "time clock, no assigned shift"})
+        return records
@@ -0,0 +1,40 @@
+from sqlalchemy import create_engine, inspect
+
+from models.cafe_managment_models import Base
+from models.dbhandler import DBHandler
+
+
+def test_old_database_gets_new_columns(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'old.db'}"
+    engine = create_engine(db_url)
+    # tables as they were before version / average_cost / labor_cost and the (scope, key) key
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE inventory (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL UNIQUE, unit VARCHAR(50), "
+            "current_stock FLOAT, current_price FLOAT, current_supplier INTEGER, daily_usage FLOAT, "
+            "safety_stock FLOAT, category VARCHAR(255), price_per_unit FLOAT, time_create DATETIME)")
+        connection.exec_driver_sql("INSERT INTO inventory (id, name, current_stock) VALUES (1, 'milk', 10)")
+        connection.exec_driver_sql(
+            "CREATE TABLE shift (id INTEGER PRIMARY KEY, date DATETIME, from_hr TIME, to_hr TIME, name VARCHAR(255))")
+        connection.exec_driver_sql(
+            "CREATE TABLE idempotency_key (key VARCHAR(100) PRIMARY KEY, scope VARCHAR(50), "
+            "status VARCHAR(20) NOT NULL, result_id INTEGER, expires_at DATETIME NOT NULL, time_create DATETIME)")
+    engine.dispose()
+
+    db = DBHandler(db_url=db_url)
+    existing = inspect(db.engine)
+    for table in Base.metadata.sorted_tables:
+        assert {column.name for column in table.columns} <= {column['name'] for column in existing.get_columns(table.name)}
+    assert existing.get_pk_constraint('idempotency_key')['constrained_columns'] == ['scope', 'key']
+    assert 'ix_shift_routine_id' in {index['name'] for index in existing.get_indexes('shift')}
+
+    milk = db.get_inventory(name='milk')[0]
+    assert milk.version == 1
+    milk.safety_stock = 2
+    assert db.edit_inventory(milk)
+    assert db.get_inventory(name='milk')[0].version == 2
+    assert db.add_idempotencykey(key='k', scope='sale') is not None
+    assert db.add_idempotencykey(key='k', scope='payment') is not None
+
+    # a second start finds nothing to change
+    assert DBHandler(db_url=db_url).get_inventory(name='milk')[0].current_stock == 10
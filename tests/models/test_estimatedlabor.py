@@ -151,4 +151,39 @@ def test_estimatedlabor_get_filters(in_memory_db):
     )
     assert len(specific_record) == 1
     assert specific_record[0].position_id == position1.id
-    assert specific_record[0].shift_id == shift1.id
\ No newline at end of file
+    assert specific_record[0].shift_id == shift1.id
+
+def test_shift_labor_cost_cache(in_memory_db):
+    position = in_memory_db.add_targetpositionandsalary(position="barista", from_date=datetime(2024, 1, 1),
+                                                        to_date=datetime(2024, 12, 31),
+                                                        monthly_hr=160, monthly_payment=3200)
+    shifts = [in_memory_db.add_shift(date=datetime(2024, 1, day), from_hr=time(9, 0), to_hr=time(17, 0))
+              for day in (15, 16)]
+    for shift in shifts:
+        in_memory_db.add_estimatedlabor(position_id=position.id, shift_id=shift.id, number=1)
+
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 1, 31)) == 320
+    assert [shift.labor_cost for shift in in_memory_db.get_shift()] == [160, 160]
+    # nothing stale, nothing recomputed
+    assert in_memory_db.refresh_shift_labor_costs() == 0
+
+    position = in_memory_db.get_targetpositionandsalary(id=position.id)[0]
+    position.monthly_payment = 1600
+    assert in_memory_db.edit_targetpositionandsalary(position)
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 1, 31)) == 160
+
+    shift = in_memory_db.get_shift(id=shifts[0].id)[0]
+    shift.to_hr = time(13, 0)
+    assert in_memory_db.edit_shift(shift)
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 1, 31)) == 120
+
+    assert in_memory_db.delete_estimatedlabor(in_memory_db.get_estimatedlabor(shift_id=shifts[1].id)[0])
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 1, 31)) == 40
+
+    # the extra payment of a shift counts once it is staffed, an unstaffed shift stays at zero
+    in_memory_db.add_shift(date=datetime(2024, 1, 17), from_hr=time(9, 0), to_hr=time(17, 0), extra_payment=15)
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 1, 31)) == 40
+    shift = in_memory_db.get_shift(id=shifts[0].id)[0]
+    shift.extra_payment = 15
+    assert in_memory_db.edit_shift(shift)
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 1, 31)) == 55
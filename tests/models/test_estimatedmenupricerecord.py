@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 
 from tests.utils import crud_cycle_test
-from models.cafe_managment_models import EstimatedMenuPriceRecord
+from models.cafe_managment_models import EstimatedMenuPriceRecord, Menu
 
 
 def test_estimatedmenupricerecord_crud_cycle(in_memory_db):
@@ -148,3 +148,24 @@ def test_estimatedmenupricerecord_profit_warning(in_memory_db):
         from_date=datetime.now()
     )
     assert record is None
+
+
+def test_current_menu_estimates_in_one_query(in_memory_db):
+    latte = in_memory_db.add_menu(name="latte", size="m", current_price=20)
+    tea = in_memory_db.add_menu(name="tea", size="m", current_price=10)
+    water = in_memory_db.add_menu(name="water", size="m", current_price=2)
+    in_memory_db.add_estimatedmenupricerecord(menu_id=latte.id, direct_cost=1, estimated_price=21,
+                                              from_date=datetime.now() - timedelta(days=2))
+    in_memory_db.add_estimatedmenupricerecord(menu_id=latte.id, direct_cost=2, estimated_price=22,
+                                              from_date=datetime.now())
+    in_memory_db.add_estimatedmenupricerecord(menu_id=tea.id, direct_cost=1, estimated_price=11)
+    # priced before the current_estimate_id pointer existed
+    with in_memory_db.Session() as session:
+        session.get(Menu, tea.id).current_estimate_id = None
+        session.commit()
+
+    rows = {row[0]: row for row in in_memory_db.get_current_menu_estimates()}
+    assert rows[latte.id][3:5] == (22, 2)
+    assert rows[tea.id][3] == 11
+    assert rows[water.id][3:] == (None, None, None)
+    assert [row[0] for row in in_memory_db.get_current_menu_estimates([tea.id])] == [tea.id]
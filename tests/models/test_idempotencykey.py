@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+from models.cafe_managment_models import IdempotencyKey
+from utils import crud_cycle_test
+
+
+def test_idempotencykey_crud_cycle(in_memory_db):
+    crud_cycle_test(
+        db_handler=in_memory_db,
+        model_class=IdempotencyKey,
+        create_kwargs={'key': 'pos-1-0001', 'scope': 'sale'},
+        update_kwargs={'status': 'done', 'result_id': 12},
+        lookup_fields=['key'],
+        lookup_values=['pos-1-0001'],
+    )
+
+
+def test_idempotencykey_claim_is_dedup(in_memory_db):
+    first = in_memory_db.add_idempotencykey(key='pos-1-0002', scope='Sale')
+    assert first is not None
+    assert first.scope == 'sale'
+    assert first.status == 'pending'
+
+    # same key again is a retry
+    assert in_memory_db.add_idempotencykey(key='pos-1-0002', scope='sale') is None
+    assert len(in_memory_db.get_idempotencykey()) == 1
+
+    # released key can be claimed again
+    assert in_memory_db.delete_idempotencykey(first) is True
+    assert in_memory_db.add_idempotencykey(key='pos-1-0002', scope='sale') is not None
+
+
+def test_idempotencykey_ttl(in_memory_db):
+    expired = in_memory_db.add_idempotencykey(key='old-key', scope='payment', ttl_hr=-1)
+    assert expired is not None
+
+    # expired keys are dropped on the next claim, so the old key is free again
+    fresh = in_memory_db.add_idempotencykey(key='new-key', scope='payment')
+    assert fresh is not None
+    assert [k.key for k in in_memory_db.get_idempotencykey()] == ['new-key']
+    assert in_memory_db.add_idempotencykey(key='old-key', scope='payment') is not None
+
+    assert in_memory_db.purge_idempotencykey(before=datetime.now() + timedelta(days=2)) == 2
+    assert in_memory_db.get_idempotencykey() == []
+
+
+def test_idempotencykey_invalid(in_memory_db):
+    assert in_memory_db.add_idempotencykey(key='', scope='sale') is None
+    assert in_memory_db.add_idempotencykey(key='k', scope=None) is None
+    assert in_memory_db.edit_idempotencykey(IdempotencyKey(key='missing', scope='sale')) is None
+    assert in_memory_db.delete_idempotencykey(IdempotencyKey(key='missing')) is False
@@ -10,4 +10,33 @@ def test_inventory_crud_cycle(in_memory_db):
         update_kwargs={"current_stock": 5.0, "unit": "kilogram", "safety_stock":0},
         lookup_fields=["name", 'id'],  # for Inventory, we often fetch by name
         lookup_values=["honey", 1]
-    )
\ No newline at end of file
+    )
+
+def test_inventory_stale_version_rejected(in_memory_db):
+    item = in_memory_db.add_inventory(name="Sugar", unit="kg", current_stock=10)
+    first = in_memory_db.get_inventory(id=item.id)[0]
+    second = in_memory_db.get_inventory(id=item.id)[0]
+
+    first.current_stock = 8
+    assert in_memory_db.edit_inventory(first)
+    assert first.version == 2
+
+    # second worker still holds version 1
+    second.current_stock = 7
+    assert in_memory_db.edit_inventory(second) is None
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 8
+
+
+def test_inventory_record_batch_stock_guard(in_memory_db):
+    item = in_memory_db.add_inventory(name="Beans", unit="gr", current_stock=5)
+
+    ids = in_memory_db.add_inventorystockrecord_batch(
+        [{"inventory_id": item.id, "change_amount": -3}], apply_to_stock=True)
+    assert len(ids) == 1
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 2
+
+    # not enough left, nothing is written
+    assert in_memory_db.add_inventorystockrecord_batch(
+        [{"inventory_id": item.id, "change_amount": -3}], apply_to_stock=True) == []
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 2
+    assert len(in_memory_db.get_inventorystockrecord(inventory_id=item.id)) == 1
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from models.cafe_managment_models import Invoice, Sales, InvoicePayment
+from models.dbhandler import DBHandler
 from utils import crud_cycle_test
 
 
@@ -265,4 +266,76 @@ def test_invoice_nonexistent_delete(in_memory_db):
         id = 9999
 
     result = in_memory_db.delete_invoice(MockInvoice())
-    assert result is False  # Should return False for non-existent invoice
\ No newline at end of file
+    assert result is False  # Should return False for non-existent invoice
+
+def test_invoice_archive_routing(in_memory_db, tmp_path):
+    in_memory_db.archive_dir = str(tmp_path)
+    menu = in_memory_db.add_menu(name="latte", size="m")
+    old_closed = in_memory_db.add_invoice(saler="ali", date=datetime(2023, 5, 1), closed=True)
+    old_open = in_memory_db.add_invoice(saler="ali", date=datetime(2023, 6, 1), closed=False)
+    recent = in_memory_db.add_invoice(saler="ali", date=datetime.now(), closed=True)
+    in_memory_db.add_sales(menu_id=menu.id, invoice_id=old_closed.id, number=1, price=10)
+    in_memory_db.add_invoicepayment(invoice_id=old_closed.id, paid=10)
+
+    assert in_memory_db.archive_invoices(before=datetime(2024, 1, 1)) == 1
+    assert (tmp_path / "sales_2023.db").exists()
+
+    # day to day queries only see the hot database
+    assert {invoice.id for invoice in in_memory_db.get_invoice()} == {old_open.id, recent.id}
+    assert [invoice.id for invoice in in_memory_db.get_invoice(from_date=datetime.now() - timedelta(days=1))] == [recent.id]
+
+    # history is routed to the archive by date range or missing id
+    year = in_memory_db.get_invoice(from_date=datetime(2023, 1, 1), to_date=datetime(2023, 12, 31))
+    assert [invoice.id for invoice in year] == [old_open.id, old_closed.id]
+    archived = in_memory_db.get_invoice(id=old_closed.id)
+    assert len(archived) == 1 and archived[0].payments[0].paid == 10
+    assert len(in_memory_db.get_sales(invoice_id=old_closed.id)) == 1
+    assert len(in_memory_db.get_sales(from_date=datetime(2023, 1, 1), to_date=datetime(2023, 12, 31))) == 1
+
+
+def test_invoice_archive_rechecks_and_keeps_ids(in_memory_db, tmp_path):
+    in_memory_db.archive_dir = str(tmp_path)
+    menu = in_memory_db.add_menu(name="latte", size="m")
+    first = in_memory_db.add_invoice(saler="ali", date=datetime(2023, 5, 1), closed=True)
+    reopened = in_memory_db.add_invoice(saler="ali", date=datetime(2023, 5, 2), closed=True)
+    live = in_memory_db.add_invoice(saler="ali", date=datetime(2023, 12, 30), closed=False)
+    in_memory_db.add_sales(menu_id=menu.id, invoice_id=first.id, number=1, price=10)
+    in_memory_db.add_sales(menu_id=menu.id, invoice_id=reopened.id, number=1, price=10)
+    in_memory_db.add_sales(menu_id=menu.id, invoice_id=live.id, number=1, price=10)
+
+    # the invoice is reopened between picking the invoices and moving them
+    archive = in_memory_db._archive
+
+    def reopen_first(year):
+        invoice = in_memory_db.get_invoice(id=reopened.id)[0]
+        invoice.closed = False
+        in_memory_db.edit_invoice(invoice)
+        return archive(year)
+
+    in_memory_db._archive = reopen_first
+    assert in_memory_db.archive_invoices(before=datetime(2024, 1, 1)) == 1
+    in_memory_db._archive = archive
+    assert [invoice.id for invoice in in_memory_db.get_invoice()] == [live.id, reopened.id]
+    assert len(in_memory_db.get_sales(invoice_id=reopened.id)) == 1
+
+    # merged sales come newest first, as from the hot database alone
+    sales = in_memory_db.get_sales(from_date=datetime(2023, 1, 1), to_date=datetime(2023, 12, 31))
+    assert [sale.invoice_id for sale in sales] == [live.id, reopened.id, first.id]
+
+
+def test_invoice_archive_keeps_newest_row_without_autoincrement(tmp_path):
+    db = DBHandler(db_url=f"sqlite:///{tmp_path / 'old.db'}", archive_dir=str(tmp_path / 'archive'))
+    with db.engine.begin() as connection:
+        # sales as made before it had AUTOINCREMENT
+        table_sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'sales'").scalar()
+        connection.exec_driver_sql("DROP TABLE sales")
+        connection.exec_driver_sql(table_sql.replace("AUTOINCREMENT", ""))
+    menu = db.add_menu(name="latte", size="m")
+    older = db.add_invoice(saler="ali", date=datetime(2023, 5, 1), closed=True)
+    newest = db.add_invoice(saler="ali", date=datetime(2023, 5, 2), closed=True)
+    db.add_sales(menu_id=menu.id, invoice_id=older.id, number=1, price=10)
+    db.add_sales(menu_id=menu.id, invoice_id=newest.id, number=1, price=10)
+
+    # the invoice of the newest sale stays, so the next sale can not get an archived id
+    assert db.archive_invoices(before=datetime(2024, 1, 1)) == 1
+    assert [invoice.id for invoice in db.get_invoice()] == [newest.id]
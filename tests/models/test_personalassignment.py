@@ -338,4 +338,31 @@ def test_personalassignment_relationships(in_memory_db):
         assert full_assignment is not None
         assert full_assignment.personal.first_name == "relationship"
         assert full_assignment.position.position == "tester"
-        assert full_assignment.shift is not None
\ No newline at end of file
+        assert full_assignment.shift is not None
+
+
+def test_personalassignment_double_booking(in_memory_db):
+    """An employee can not work two overlapping shifts, also over midnight"""
+    personal = in_memory_db.add_personal(first_name="night", last_name="owl")
+    other = in_memory_db.add_personal(first_name="early", last_name="bird")
+    late = in_memory_db.add_shift(date=datetime(2024, 1, 15), from_hr=time(18, 0), to_hr=time(2, 0), name="late")
+    early = in_memory_db.add_shift(date=datetime(2024, 1, 16), from_hr=time(1, 0), to_hr=time(9, 0), name="early")
+    day = in_memory_db.add_shift(date=datetime(2024, 1, 16), from_hr=time(9, 0), to_hr=time(17, 0), name="day")
+
+    assert in_memory_db.add_personalassignment(personal_id=personal.id, shift_id=late.id)
+    assert in_memory_db.add_personalassignment(personal_id=personal.id, shift_id=early.id) is None
+    assert in_memory_db.add_personalassignment(personal_id=other.id, shift_id=early.id)
+
+    # the whole batch is refused and every conflict is reported
+    batch = [{'personal_id': personal.id, 'shift_id': early.id},
+             {'personal_id': other.id, 'shift_id': late.id},
+             {'personal_id': personal.id, 'shift_id': day.id}]
+    conflicts = in_memory_db.find_assignment_conflicts([(a['personal_id'], a['shift_id']) for a in batch])
+    assert sorted((c['personal_id'], c['shift_id'], c['other_shift_id']) for c in conflicts) == sorted(
+        [(personal.id, early.id, late.id), (other.id, late.id, early.id)])
+    assert in_memory_db.add_personalassignments(batch) == []
+
+    added = in_memory_db.add_personalassignments([{'personal_id': personal.id, 'shift_id': day.id},
+                                                  {'personal_id': other.id, 'shift_id': day.id}])
+    assert len(added) == 2
+
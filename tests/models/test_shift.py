@@ -1,4 +1,4 @@
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 from models.cafe_managment_models import Shift
 from utils import crud_cycle_test
 
@@ -59,6 +59,18 @@ class TestShift:
         )
         assert shift3 is not None  # Should be accepted
 
+    def test_routine_shift_overlap(self, in_memory_db):
+        """Routine shifts must not overlap each other or existing shifts of the same name"""
+        in_memory_db.add_shift(date=datetime(2024, 2, 10), from_hr=time(22, 0), to_hr=time(6, 0), name='night')
+        routine = [(datetime(2024, 2, 1) + timedelta(days=day), time(22, 0), time(6, 0)) for day in range(30)]
+
+        conflicts = in_memory_db.find_shift_conflicts(routine + [(datetime(2024, 2, 20), time(5, 0), time(7, 0))],
+                                                      name='Night')
+        assert sorted((c['index'], c.get('shift_id'), c.get('other_index')) for c in conflicts) == [
+            (9, 1, None), (30, None, 18)]
+        # another shift name may run at the same time
+        assert in_memory_db.find_shift_conflicts(routine, name='bar') == []
+
     def test_shift_overlap_detection_edit(self, in_memory_db):
         """Test that overlapping shifts are detected during updates"""
         # Add two shifts
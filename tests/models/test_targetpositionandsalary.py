@@ -1,6 +1,7 @@
 from models.cafe_managment_models import *
+from models.position_salary_index import PositionSalaryIndex
 from tests.utils import crud_cycle_test
-from datetime import datetime
+from datetime import datetime, time
 
 
 def test_targetpositionandsalary_basic_crud(in_memory_db):
@@ -186,4 +187,43 @@ def test_targetpositionandsalary_filtering(in_memory_db):
         from_date=datetime(2024, 4, 1),
         to_date=datetime(2024, 6, 30)
     )
-    assert len(q2_positions) == 2
\ No newline at end of file
+    assert len(q2_positions) == 2
+
+def test_position_salary_index_uses_rate_in_force(in_memory_db):
+    first = in_memory_db.add_targetpositionandsalary(position="Barista", from_date=datetime(2024, 1, 1),
+                                                     to_date=datetime(2024, 6, 30), monthly_hr=160, monthly_payment=1600)
+    second = in_memory_db.add_targetpositionandsalary(position="barista", from_date=datetime(2024, 7, 1),
+                                                      to_date=datetime(2024, 12, 31), monthly_hr=160, monthly_payment=3200)
+    in_memory_db.add_targetpositionandsalary(position="cook", from_date=datetime(2024, 3, 1),
+                                             to_date=datetime(2024, 3, 31), monthly_hr=100, monthly_payment=100)
+
+    salaries = in_memory_db.get_position_salary_index()
+    assert len(salaries) == 3
+    assert salaries.resolve("BARISTA", datetime(2024, 2, 1)).id == first.id
+    assert salaries.resolve("barista", datetime(2024, 7, 1)).id == second.id
+    assert salaries.resolve("barista", datetime(2023, 12, 31)) is None
+    assert salaries.resolve("barista", datetime(2025, 1, 1)) is None
+    assert set(salaries.in_force(datetime(2024, 3, 15))) == {"barista", "cook"}
+    assert [terms.id for terms in salaries.history("barista")] == [first.id, second.id]
+
+    # both shifts were staffed with the first terms, the second runs on the raised rate
+    for day in (datetime(2024, 3, 1), datetime(2024, 9, 1)):
+        shift = in_memory_db.add_shift(date=day, from_hr=time(9, 0), to_hr=time(17, 0))
+        in_memory_db.add_estimatedlabor(position_id=first.id, shift_id=shift.id, number=1)
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 12, 31)) == 80 + 160
+
+    second = in_memory_db.get_targetpositionandsalary(id=second.id)[0]
+    second.monthly_payment = 4800
+    assert in_memory_db.edit_targetpositionandsalary(second)
+    assert in_memory_db.get_labor_cost_total(datetime(2024, 1, 1), datetime(2024, 12, 31)) == 80 + 240
+
+
+def test_position_salary_index_skips_ended_later_terms():
+    # an open yearly term and a back-dated one month term that started after it
+    salaries = PositionSalaryIndex([
+        (1, "barista", None, datetime(2024, 1, 1), None, 160, 1600, None, None),
+        (2, "barista", None, datetime(2024, 3, 1), datetime(2024, 3, 31), 160, 2000, None, None),
+    ])
+    assert salaries.resolve("barista", datetime(2024, 3, 15)).id == 2
+    assert salaries.resolve("barista", datetime(2024, 5, 1)).id == 1
+    assert salaries.resolve("barista", datetime(2023, 5, 1)) is None
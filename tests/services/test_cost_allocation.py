@@ -0,0 +1,44 @@
+from datetime import datetime
+
+import pytest
+
+from services.cost_allocation import CostAllocator
+
+
+def test_bill_spanning_two_years_is_split(in_memory_db):
+    # 365 days from Jul 1 2024, 184 of them in 2024
+    in_memory_db.add_estimatedbills(name='insurance', category='insurance', cost=365,
+                                    from_date=datetime(2024, 7, 1), to_date=datetime(2025, 7, 1))
+    allocator = CostAllocator(in_memory_db)
+
+    first = allocator.allocate(datetime(2024, 1, 1), datetime(2025, 1, 1), period='year')
+    second = allocator.allocate(datetime(2025, 1, 1), datetime(2026, 1, 1), period='year')
+
+    assert first.total('bills') == pytest.approx(184)
+    assert second.total('bills') == pytest.approx(181)
+
+
+def test_monthly_rows_rent_and_depreciation(in_memory_db):
+    in_memory_db.add_rent(name='shop', rent=3100, mortgage=1000, mortgage_percentage_to_rent=0.1,
+                          from_date=datetime(2025, 1, 1), to_date=datetime(2025, 2, 1))
+    in_memory_db.add_equipment(name='grinder', purchase_date=datetime(2025, 1, 16), monthly_depreciation=310,
+                               expire_date=datetime(2030, 1, 1))
+    allocation = CostAllocator(in_memory_db).allocate(datetime(2025, 1, 1), datetime(2025, 4, 1))
+
+    rows = allocation.rows()
+    assert [row['from_date'].month for row in rows] == [1, 2, 3]
+    assert [row['rent'] for row in rows] == pytest.approx([3200, 0, 0])
+    # half of January, then whole months
+    assert allocation.column('equipment') == pytest.approx([160, 310, 310])
+    assert allocation.total() == pytest.approx(3200 + 780)
+
+
+def test_daily_rows_and_invalid_window(in_memory_db):
+    in_memory_db.add_estimatedbills(name='water', category='water', cost=70,
+                                    from_date=datetime(2025, 3, 1), to_date=datetime(2025, 3, 8))
+    allocator = CostAllocator(in_memory_db)
+
+    allocation = allocator.allocate(datetime(2025, 3, 6), datetime(2025, 3, 10), period='day')
+    assert allocation.column('bills') == pytest.approx([10, 10, 0, 0])
+    assert allocator.allocate(datetime(2025, 3, 6), datetime(2025, 3, 6)) is None
+    assert allocator.allocate(datetime(2025, 3, 6), datetime(2025, 3, 9), period='hour') is None
@@ -5,6 +5,7 @@ from datetime import datetime, time, timedelta
 from decimal import Decimal
 from services.hr_service import HRService
 from models.cafe_managment_models import *
+from models.dbhandler import DBHandler, SHIFT_PLAN_CACHE
 
 
 class TestHRService:
@@ -814,7 +815,171 @@ class TestHRService:
         assert len(april_shifts) == 90
         assert end_time - start_time < 1.0  # Should be fast
 
+    def test_run_payroll(self, in_memory_db):
+        service = HRService(in_memory_db)
+        in_memory_db.add_targetpositionandsalary(position="barista", from_date=datetime(2026, 1, 1),
+                                                 to_date=datetime(2026, 12, 31), monthly_hr=100,
+                                                 monthly_payment=1000, monthly_insurance=50, extra_hr_payment=15)
+        barista = service.new_personal("a", "b", "1", "a@b.c", "1", "x", "barista", None, None)
+        manager = service.new_personal("c", "d", "2", "c@d.e", "2", "y", "manager", 160, 3200)
+        leaver = service.new_personal("e", "f", "3", "e@f.g", "3", "z", "barista", None, None)
+        service.deactivate_personal(leaver.id)
+
+        for day in range(1, 12):
+            service.add_work_record(barista.id, datetime(2026, 3, day, 8), datetime(2026, 3, day, 18),
+                                    lunch=2, service=1)
+        service.add_work_record(manager.id, datetime(2026, 3, 2, 8), datetime(2026, 3, 2, 16), extra_payment=30)
+        service.add_work_record(barista.id, datetime(2026, 4, 1, 8), datetime(2026, 4, 1, 18))
+
+        payments = {p['personal_id']: p for p in service.run_payroll(2026, 3)}
+        assert set(payments) == {barista.id, manager.id}
+        # 110 hours: 100 regular at 10 + 10 overtime at 15
+        assert payments[barista.id]['work_hr'] == 100
+        assert payments[barista.id]['extra_hr'] == 10
+        assert payments[barista.id]['payment'] == pytest.approx(1150)
+        assert payments[barista.id]['indirect_payment'] == 33
+        assert payments[barista.id]['insurance'] == 50
+        assert payments[manager.id]['payment'] == pytest.approx(160)
+        assert payments[manager.id]['extra_expenses'] == 30
+
+        # rerun replaces the month instead of adding to it
+        service.run_payroll(2026, 3)
+        records = in_memory_db.get_recordemployeepayment(from_date=datetime(2026, 3, 1), to_date=datetime(2026, 3, 31))
+        assert len(records) == 2
+
+        # someone already paid by hand for the month is left alone
+        service.record_payment(barista.id, datetime(2026, 4, 1), datetime(2026, 4, 30), 1000, 10, 100, 0)
+        april = service.run_payroll(2026, 4)
+        assert [p['personal_id'] for p in april] == [manager.id]
+
+    def test_routine_shifts_are_rules(self, in_memory_db):
+        service = HRService(in_memory_db)
+        slots = [(time(6, 0), time(14, 0)), (time(14, 0), time(22, 0)), (time(22, 0), time(6, 0))]
+        assert service.create_shift_routine(slots, continue_days=364, from_date=datetime(2025, 1, 1), name="bar")
+        assert in_memory_db.get_shift() == []
+        routines = in_memory_db.get_shiftroutine(name="bar")
+        assert len(routines) == 3
+
+        week = service.get_shifts(datetime(2025, 3, 3), datetime(2025, 3, 9))
+        assert len(week) == 21
+        assert [shift.from_hr for shift in week[:3]] == [time(6, 0), time(14, 0), time(22, 0)]
+        assert len(service.get_shifts(datetime(2025, 12, 30), datetime(2026, 1, 5))) == 6
+
+        night = routines[2]
+        barista = service.new_personal("a", "b", "1", "a@b.c", "1", "x", "barista", 100, 1000)
+        assert service.assign_routine_shift(barista.id, night.id, datetime(2025, 3, 4), None)
+        assert service.override_routine_shift(routines[0].id, datetime(2025, 3, 5), from_hr=time(7, 0))
+        assert service.cancel_routine_shift(routines[1].id, datetime(2025, 3, 6))
+        assert not service.cancel_routine_shift(night.id, datetime(2025, 3, 4))
+
+        week = service.get_shifts(datetime(2025, 3, 3), datetime(2025, 3, 9))
+        assert len(week) == 20
+        assert len([shift for shift in week if shift.id]) == 2
+        assert time(7, 0) in [shift.from_hr for shift in week if shift.date == datetime(2025, 3, 5)]
+        assert len(in_memory_db.get_shift()) == 2
+
+        # the same routine again would overlap itself, an overlapping single day too
+        assert service.create_shift_routine(slots, continue_days=6, from_date=datetime(2025, 6, 1), name="bar") is None
+        assert in_memory_db.find_shift_conflicts([(datetime(2025, 6, 1), time(13, 0), time(15, 0))], name="bar")
+        # weekend only routine of another name is fine
+        assert service.create_shift_routine([(time(10, 0), time(16, 0))], continue_days=13,
+                                            from_date=datetime(2025, 3, 3), name="brunch", weekdays="56")
+        assert len(service.get_shifts(datetime(2025, 3, 3), datetime(2025, 3, 16))) == 3 * 14 - 1 + 4
+
+    def test_routine_overlapping_a_stored_shift(self, in_memory_db):
+        service = HRService(in_memory_db)
+        in_memory_db.add_shift(date=datetime(2024, 2, 10), from_hr=time(22, 0), to_hr=time(6, 0), name='night')
+        nights = [(time(22, 0), time(6, 0))]
+        assert service.create_shift_routine(nights, continue_days=29, from_date=datetime(2024, 2, 1), name='Night') is None
+        assert in_memory_db.get_shiftroutine() == []
+        assert len(in_memory_db.get_shift()) == 1
+
+        # another shift name may run at the same time, only its rule is stored
+        assert service.create_shift_routine(nights, continue_days=29, from_date=datetime(2024, 2, 1), name='bar')
+        assert len(in_memory_db.get_shift()) == 1
+        assert len(list(in_memory_db.iter_routine_shifts(datetime(2024, 2, 1), datetime(2024, 3, 1)))) == 30
+
+    def test_employee_schedule_query(self, in_memory_db):
+        from sqlalchemy import inspect
+        service = HRService(in_memory_db)
+        anna = in_memory_db.add_personal(first_name="anna", last_name="a")
+        ben = in_memory_db.add_personal(first_name="ben", last_name="b")
+        for day in range(0, 730, 7):
+            shift = in_memory_db.add_shift(date=datetime(2024, 1, 1) + timedelta(days=day),
+                                           from_hr=time(8, 0), to_hr=time(16, 0), name=f"s{day}")
+            in_memory_db.add_personalassignment(personal_id=anna.id if day % 2 else ben.id, shift_id=shift.id)
+
+        march = service.get_shift_schedule(anna.id, datetime(2024, 3, 1), datetime(2024, 3, 31))
+        assert [shift.date.day for shift in march] == [18, 4]
+        assert len(service.get_employee_shifts(ben.id)) == 53
+        assert len(service.get_employee_shifts(ben.id, from_date=datetime(2025, 1, 1))) == 26
+        assert service.get_employee_shifts(anna.id, to_date=datetime(2023, 12, 31)) == []
+
+        indexes = inspect(in_memory_db.engine).get_indexes('shift')
+        assert ['date'] in [index['column_names'] for index in indexes]
+
+    def test_shift_plan_window_and_cache(self, in_memory_db):
+        service = HRService(in_memory_db)
+        barista = in_memory_db.add_targetpositionandsalary('barista', datetime(2025, 1, 1), datetime(2025, 12, 31),
+                                                           monthly_hr=100, monthly_payment=1000, monthly_insurance=300)
+        anna = in_memory_db.add_personal(first_name="anna", last_name="a")
+        shift = in_memory_db.add_shift(date=datetime(2025, 3, 4), from_hr=time(22, 0), to_hr=time(6, 0),
+                                       name="night", extra_payment=5)
+        in_memory_db.add_shift(date=datetime(2025, 3, 11), from_hr=time(8, 0), to_hr=time(16, 0), name="next week")
+        labor = in_memory_db.add_estimatedlabor(position_id=barista.id, shift_id=shift.id, number=2)
+        in_memory_db.add_personalassignment(personal_id=anna.id, shift_id=shift.id, position_id=barista.id)
+        service.create_shift_routine([(time(10, 0), time(12, 0))], continue_days=30,
+                                     from_date=datetime(2025, 3, 1), name="brunch", weekdays="5")
+
+        plan = service.get_shift_plan(datetime(2025, 3, 3), datetime(2025, 3, 10))
+        assert [entry['name'] for entry in plan] == ["night", "brunch"]
+        night = plan[0]
+        assert night['hours'] == 8
+        # 2 x (8h x 10 + 10 insurance) + 5 extra payment
+        assert night['labor_cost'] == 185
+        assert night['assignment'] == [{'personal_id': anna.id, 'name': 'anna', 'last_name': 'a',
+                                        'position': 'barista'}]
+        assert plan[1]['shift_id'] is None and plan[1]['routine_id']
+
+        # cached, but every caller gets its own copy
+        plan[0]['assignment'].clear()
+        again = service.get_shift_plan(datetime(2025, 3, 3), datetime(2025, 3, 10))
+        assert again is not plan and len(again[0]['assignment']) == 1
+        # a write through another handler (another worker) is seen too
+        other = DBHandler(engine=in_memory_db.engine, session_factory=in_memory_db.Session)
+        assert other.add_shift(date=datetime(2025, 3, 5), from_hr=time(8, 0), to_hr=time(9, 0), name="extra")
+        assert in_memory_db.get_cache_version(SHIFT_PLAN_CACHE) > 0
+        names = [entry['name'] for entry in service.get_shift_plan(datetime(2025, 3, 3), datetime(2025, 3, 10))]
+        assert names == ["night", "extra", "brunch"]
+        assert in_memory_db.replace_estimatedlabor([shift.id], [{'shift_id': shift.id, 'position_id': barista.id,
+                                                                 'number': 1}]) == 1
+        plan = service.get_shift_plan(datetime(2025, 3, 3), datetime(2025, 3, 10))
+        assert plan[0]['labor_cost'] == 95
+        assert in_memory_db.delete_estimatedlabor(labor)
+        # no labor left, the extra payment is not counted either
+        assert service.get_shift_plan(datetime(2025, 3, 3), datetime(2025, 3, 10))[0]['labor_cost'] == 0
+
+
+    def test_shift_plan_shows_terms_in_force(self, in_memory_db):
+        service = HRService(in_memory_db)
+        old = in_memory_db.add_targetpositionandsalary('barista', datetime(2025, 1, 1), datetime(2025, 2, 28),
+                                                       monthly_hr=100, monthly_payment=1000)
+        in_memory_db.add_targetpositionandsalary('barista', datetime(2025, 3, 1), datetime(2025, 12, 31),
+                                                 monthly_hr=100, monthly_payment=2000)
+        shift = in_memory_db.add_shift(date=datetime(2025, 3, 4), from_hr=time(8, 0), to_hr=time(16, 0), name="day")
+        in_memory_db.add_estimatedlabor(position_id=old.id, shift_id=shift.id, number=1)
+        # dated on the end of the window, not part of the plan and not refreshed with it
+        late = in_memory_db.add_shift(date=datetime(2025, 3, 10), from_hr=time(8, 0), to_hr=time(16, 0))
+        in_memory_db.add_estimatedlabor(position_id=old.id, shift_id=late.id, number=1)
+
+        plan = service.get_shift_plan(datetime(2025, 3, 3), datetime(2025, 3, 10))
+        assert [entry['shift_id'] for entry in plan] == [shift.id]
+        assert plan[0]['labor_cost'] == 160
+        assert plan[0]['labor_estimation'][0]['monthly_payment'] == 2000
+        assert plan[0]['labor_estimation'][0]['position_id'] == old.id
+        assert in_memory_db.get_shift(id=late.id)[0].labor_cost is None
+
 
 # Run the tests
 if __name__ == "__main__":
-    pytest.main([__file__, "-v"])
\ No newline at end of file
+    pytest.main([__file__, "-v"])
@@ -228,6 +228,279 @@ def test_inventory_alerts(in_memory_db, setup_menu_inventory):
 
 
 
+def test_reorder_report(in_memory_db, setup_menu_inventory):
+    service = InventoryService(in_memory_db)
+    # milk: stock 6, safety 2, usage 2/day, supplier lead 1hr -> 1 day
+    report = {row['name']: row for row in service.reorder_report(cycle_days=7)}
+    milk = report['milk']
+    assert milk['lead_time_days'] == 1
+    assert milk['reorder_point'] == 2 + 1 * 2
+    assert milk['suggested_order'] == 4 + 7 * 2 - 6
+
+    # straw: stock 10 is above 1 + 1 * 1, nothing to order yet
+    assert report['straw']['current_stock'] > report['straw']['reorder_point']
+
+    coffee = setup_menu_inventory['inv1']
+    alerts = service.low_stock_alerts(item_list=[coffee])
+    assert alerts == {'coffee': 100}
+    assert service.low_stock_alerts(item_list=[]) == {}
+
+
+def test_estimate_daily_usage(in_memory_db):
+    service = InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='sugar', unit='gr', current_stock=1000, daily_usage=999)
+    today = datetime(2025, 3, 10, 15, 0)
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-10, date=datetime(2025, 3, 7, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-20, date=datetime(2025, 3, 9, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-5, date=datetime(2025, 3, 9, 18, 0))
+    # restocks and todays (incomplete) deductions are not usage yet
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=500, date=datetime(2025, 3, 8, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-40, date=datetime(2025, 3, 10, 9, 0))
+
+    assert service.estimate_daily_usage(alpha=0.5, until=today) == 1
+    # 7th: 10, 8th: 10*0.5, 9th: 25*0.5 + 5*0.5
+    expected = 25 * 0.5 + 5 * 0.5
+    assert in_memory_db.get_inventory(id=item.id)[0].daily_usage == pytest.approx(expected)
+
+    # a late synced sale of the 9th, written after the row of the 10th
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-4, date=datetime(2025, 3, 9, 20, 0))
+    # the 10th is not finished, so the late row waits too
+    assert service.estimate_daily_usage(alpha=0.5, until=today) == 0
+
+    # next night picks up both
+    assert service.estimate_daily_usage(alpha=0.5, until=today + timedelta(days=1)) == 1
+    expected = 40 * 0.5 + (expected + 4 * 0.5) * 0.5
+    assert in_memory_db.get_inventory(id=item.id)[0].daily_usage == pytest.approx(expected)
+
+
+def test_forecast_all_inventory(in_memory_db, setup_menu_inventory):
+    service = InventoryService(in_memory_db)
+    start = datetime(2025, 1, 1, 8, 0)
+    coffee = setup_menu_inventory['inv1']
+    in_memory_db.add_inventory(name='sugar', unit='gr', current_stock=10, daily_usage=1)
+    # 10 lattes a day -> 110 gr coffee, more than the usual 50
+    in_memory_db.add_salesforecast(menu_item_id=setup_menu_inventory['menu'].id, sell_number=70,
+                                   from_date=datetime(2025, 1, 1), to_date=datetime(2025, 1, 7))
+    order = in_memory_db.add_order(supplier_id=setup_menu_inventory['sup1'].id, buyer='ali')
+    in_memory_db.add_orderdetail(inventory_id=coffee.id, order_id=order.id, boxes_ordered=5, box_amount=20,
+                                 expected_delivery_date=datetime(2025, 1, 2, 10, 0))
+
+    result = {row['name']: row for row in service.forecast_all_inventory(days=4, start=start)}
+
+    assert result['coffee']['stockout_date'] == datetime(2025, 1, 1).date()
+    assert result['coffee']['projected_stock'] == pytest.approx(100 + 100 - 4 * 110)
+    assert result['sugar']['stockout_date'] is None
+    assert result['sugar']['projected_stock'] == 6
+    assert result['sugar']['lowest_stock'] == 6
+
+
+def test_forecast_ending_on_the_first_day_counts(in_memory_db, setup_menu_inventory):
+    service = InventoryService(in_memory_db)
+    # the forecast's last day is jan 1 (stored as jan 1 00:00), the projection starts at 08:00
+    in_memory_db.add_salesforecast(menu_item_id=setup_menu_inventory['menu2'].id, sell_number=2,
+                                   from_date=datetime(2024, 12, 31), to_date=datetime(2025, 1, 1))
+    result = {row['name']: row for row in service.forecast_all_inventory(days=2, start=datetime(2025, 1, 1, 8, 0))}
+    # 1000 straws of the forecast on the first day, the usual 1 on the second
+    assert result['straw']['projected_stock'] == pytest.approx(10 - 1000 - 1)
+
+
+def test_stock_snapshots_and_as_of(in_memory_db):
+    service = InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='sugar', unit='gr')
+    other = in_memory_db.add_inventory(name='salt', unit='gr')
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, manual_report=100, date=datetime(2025, 1, 1, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-10, date=datetime(2025, 1, 1, 12, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-5, date=datetime(2025, 1, 3, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=20, date=datetime(2025, 1, 4, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=other.id, change_amount=7, date=datetime(2025, 1, 2, 9, 0))
+
+    assert service.build_stock_snapshots(until=datetime(2025, 1, 4, 10, 0)) == 3
+    assert service.build_stock_snapshots(until=datetime(2025, 1, 4, 10, 0)) == 0
+
+    assert service.stock_as_of(datetime(2025, 1, 2)) == {item.id: 90}
+    assert service.stock_as_of(datetime(2025, 1, 2), inventory_ids=[item.id]) == {item.id: 90}
+    assert service.stock_as_of(datetime(2025, 1, 3, 12, 0)) == {item.id: 85, other.id: 7}
+    assert service.stock_as_of(datetime(2025, 1, 5)) == {item.id: 105, other.id: 7}
+
+    # a late row for an already snapshotted day rebuilds from that day
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-1, date=datetime(2025, 1, 1, 15, 0))
+    assert service.build_stock_snapshots(until=datetime(2025, 1, 5, 10, 0)) == 4
+    assert service.stock_as_of(datetime(2025, 1, 2), inventory_ids=[item.id]) == {item.id: 89}
+    assert service.stock_as_of(datetime(2025, 1, 5), inventory_ids=[item.id]) == {item.id: 104}
+
+    service._calculate_inventory(item.id)
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 104
+
+
+def test_fifo_lot_valuation(in_memory_db):
+    service = InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='beans', unit='gr', current_price=9)
+    for quantity, unit_cost, day in ((100, 1.0, 1), (100, 2.0, 2)):
+        service.restock_by_inventory_item(item.id, quantity, category='Supplied', date=datetime(2025, 1, day))
+        service.receive_lot(item.id, quantity, unit_cost, date=datetime(2025, 1, day))
+
+    assert service.deduct_stock_by_inventory_item(item.id, 150, category='sale')
+    record = in_memory_db.get_inventorystockrecord(inventory_id=item.id, category='sale')[0]
+    assert record.cost == pytest.approx(100 * 1.0 + 50 * 2.0)
+
+    lots = in_memory_db.get_inventorylot(inventory_id=item.id)
+    assert lots[0].exhausted and lots[0].remaining == 0
+    assert lots[1].remaining == 50
+    assert len(in_memory_db.get_inventorylot(inventory_id=item.id, open_only=True)) == 1
+    assert service.inventory_valuation() == {item.id: pytest.approx(50 * 2.0)}
+    assert in_memory_db.get_inventory(id=item.id)[0].average_cost == pytest.approx(1.5)
+
+
+def test_average_lot_valuation(in_memory_db):
+    service = InventoryService(in_memory_db, valuation_method="average")
+    item = in_memory_db.add_inventory(name='beans', unit='gr')
+    service.restock_by_inventory_item(item.id, 100, category='Supplied')
+    service.receive_lot(item.id, 100, 1.0)
+    assert service.deduct_stock_by_inventory_item(item.id, 50, category='sale')
+    service.restock_by_inventory_item(item.id, 50, category='Supplied')
+    service.receive_lot(item.id, 50, 4.0)
+
+    # (50 * 1 + 50 * 4) / 100
+    assert in_memory_db.get_inventory(id=item.id)[0].average_cost == pytest.approx(2.5)
+    assert service.deduct_stock_by_inventory_item(item.id, 10, category='sale')
+    records = in_memory_db.get_inventorystockrecord(inventory_id=item.id, category='sale')
+    assert sorted(record.cost for record in records) == [pytest.approx(25), pytest.approx(50)]
+    assert service.inventory_valuation() == {item.id: pytest.approx(90 * 2.5)}
+
+
+def test_lot_returns_and_delivery_lot(in_memory_db):
+    service = InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='beans', unit='gr', current_price=9)
+    menu = in_memory_db.add_menu(name='espresso', size='S')
+    in_memory_db.add_recipe(inventory_id=item.id, menu_id=menu.id, inventory_item_amount_usage=10)
+    for quantity, unit_cost, day in ((100, 1.0, 1), (100, 2.0, 2)):
+        service.restock_by_inventory_item(item.id, quantity, category='Supplied', date=datetime(2025, 1, day))
+        service.receive_lot(item.id, quantity, unit_cost, date=datetime(2025, 1, day), order_detail_id=day)
+
+    # boxes taken back from a delivery come out of its own lot, not the oldest one
+    assert service.deduct_stock_by_inventory_item(item.id, 30, category='deduct', order_detail_id=2)
+    assert [lot.remaining for lot in in_memory_db.get_inventorylot(inventory_id=item.id)] == [100, 70]
+    assert in_memory_db.get_inventorystockrecord(inventory_id=item.id, category='deduct')[0].cost == pytest.approx(60)
+
+    assert service.deduct_stock_by_inventory_item(item.id, 20, category='sale')
+    assert [lot.remaining for lot in in_memory_db.get_inventorylot(inventory_id=item.id)] == [80, 70]
+
+    # a returned sale is credited back to the newest lot with room, at that lot's cost
+    menu_item = in_memory_db.get_menu(id=menu.id)[0]
+    assert service.restock_by_menu(menu_item, 2, category='return')
+    assert [lot.remaining for lot in in_memory_db.get_inventorylot(inventory_id=item.id)] == [80, 90]
+    assert in_memory_db.get_inventorystockrecord(inventory_id=item.id, category='return')[0].cost == pytest.approx(-40)
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 170
+
+
+def test_delivery_restock_adds_its_lot_in_one_transaction(in_memory_db):
+    service = InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='beans', unit='gr')
+    assert service.restock_by_inventory_item(item.id, 100, category='Supplied', unit_cost=2.0, order_detail_id=7)
+    lots = in_memory_db.get_inventorylot(inventory_id=item.id)
+    assert [(lot.quantity, lot.unit_cost, lot.order_detail_id) for lot in lots] == [(100, 2.0, 7)]
+    assert in_memory_db.get_inventory(id=item.id)[0].average_cost == pytest.approx(2.0)
+
+    # a lot that can not be written leaves the stock and the ledger untouched
+    assert not service.restock_by_inventory_item(item.id, 50, category='Supplied', unit_cost=-1)
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 100
+    assert len(in_memory_db.get_inventorystockrecord(inventory_id=item.id)) == 1
+    assert len(in_memory_db.get_inventorylot(inventory_id=item.id)) == 1
+
+
+def test_stocktake(in_memory_db, setup_menu_inventory):
+    service = InventoryService(in_memory_db)
+    coffee, milk = setup_menu_inventory['inv1'], setup_menu_inventory['inv2']
+    the_coffee = in_memory_db.get_inventory(id=coffee.id)[0]
+    the_coffee.current_price = 2
+    in_memory_db.edit_inventory(the_coffee)
+
+    report = service.stocktake({coffee.id: 90, milk.id: 6}, reporter='Sara')
+    by_id = {row['inventory_id']: row for row in report}
+    assert by_id[coffee.id]['expected'] == 100
+    assert by_id[coffee.id]['variance'] == -10
+    assert by_id[coffee.id]['variance_value'] == -20
+    assert by_id[milk.id]['variance'] == 0
+
+    assert in_memory_db.get_inventory(id=coffee.id)[0].current_stock == 90
+    # same result as the per item recalculation
+    assert service.deduct_stock_by_inventory_item(coffee.id, 5)
+    assert in_memory_db.get_inventory(id=coffee.id)[0].current_stock == 85
+    assert in_memory_db.recalculate_stock([coffee.id])
+    assert in_memory_db.get_inventory(id=coffee.id)[0].current_stock == 85
+
+    # one bad row rejects the whole sheet
+    assert service.stocktake({coffee.id: 1, 999999: 2}, reporter='sara') is None
+    assert in_memory_db.get_inventory(id=coffee.id)[0].current_stock == 85
+
+
+def test_interleaved_deductions_keep_stock_and_ledger_in_line(in_memory_db):
+    first, second = InventoryService(in_memory_db), InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='beans', unit='gr')
+    assert first.manual_report(item.id, 10, reporter='sara')
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 10
+
+    # another worker deducts after the first deduction committed, before anything reads the item again
+    add_batch, get_inventory = in_memory_db.add_inventorystockrecord_batch, in_memory_db.get_inventory
+
+    def other_worker_next(records, *args, **kwargs):
+        new_ids = add_batch(records, *args, **kwargs)
+        in_memory_db.add_inventorystockrecord_batch = add_batch
+        in_memory_db.get_inventory = other_worker_deducts
+        return new_ids
+
+    def other_worker_deducts(*args, **kwargs):
+        in_memory_db.get_inventory = get_inventory
+        assert second.deduct_stock_by_inventory_item(item.id, 4)
+        return get_inventory(*args, **kwargs)
+
+    in_memory_db.add_inventorystockrecord_batch = other_worker_next
+    assert first.deduct_stock_by_inventory_item(item.id, 3)
+
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 3
+    assert in_memory_db.recalculate_stock([item.id])
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 3
+
+    # restock without a prior report and a later count go through the same way
+    other = in_memory_db.add_inventory(name='cups', unit='unit')
+    assert first.restock_by_inventory_item(other.id, 5)
+    assert in_memory_db.get_inventory(id=other.id)[0].current_stock == 5
+    assert first.manual_report(other.id, 2, reporter='sara')
+    assert in_memory_db.get_inventory(id=other.id)[0].current_stock == 2
+
+
+def test_compact_ledger(in_memory_db, tmp_path):
+    service = InventoryService(in_memory_db)
+    item = in_memory_db.add_inventory(name='sugar', unit='gr')
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-5, date=datetime(2025, 1, 1, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, manual_report=100, date=datetime(2025, 1, 1, 12, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-10, date=datetime(2025, 1, 1, 13, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-3, date=datetime(2025, 1, 1, 14, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-1, date=datetime(2025, 1, 2, 9, 0))
+    in_memory_db.add_inventorystockrecord(inventory_id=item.id, change_amount=-2, date=datetime(2025, 6, 1, 9, 0))
+    service._calculate_inventory(item.id)
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 84
+
+    # an archive file that can not be opened fails the run, nothing is moved
+    missing = str(tmp_path / "missing" / "archive.db")
+    assert service.compact_ledger(keep_days=30, archive_path=missing, until=datetime(2025, 2, 5)) == -1
+    assert len(in_memory_db.get_inventorystockrecord(inventory_id=item.id)) == 6
+
+    archive = str(tmp_path / "archive.db")
+    assert service.compact_ledger(keep_days=30, archive_path=archive, until=datetime(2025, 2, 5)) == 4
+    assert service.compact_ledger(keep_days=30, archive_path=archive, until=datetime(2025, 2, 5)) == 0
+
+    hot = in_memory_db.get_inventorystockrecord(inventory_id=item.id)
+    # manual check, the stretch before it, the stretch after it, jan 2 and the recent row
+    assert len(hot) == 5
+    assert sorted(row.change_amount for row in hot if row.change_amount is not None) == [-13, -5, -2, -1]
+    assert len(in_memory_db.get_archived_inventorystockrecord(archive, inventory_id=item.id)) == 4
+
+    service._calculate_inventory(item.id)
+    assert in_memory_db.get_inventory(id=item.id)[0].current_stock == 84
+    assert service.stock_as_of(datetime(2025, 1, 2)) == {item.id: 87}
+
+
 def test_add_inventory_item(in_memory_db, setup_menu_inventory):
     service = InventoryService(in_memory_db)
 
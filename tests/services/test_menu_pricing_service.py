@@ -1435,5 +1435,55 @@ class TestRealWorldScenarios:
 
         print(f"✅ Performance test passed in {elapsed_time:.4f} seconds")
 
+    def test_current_estimate_pointer_and_dedup(self, in_memory_db):
+        service = MenuPriceService(in_memory_db)
+        latte = in_memory_db.add_menu(name="Latte", size="m", current_price=5.0)
+
+        service.calculate_manual_price_change(latte.id, new_manual_price=5.0, profit_margin=0.2)
+        service._add_new_estimated_record_update_menu_suggestion(only_menu_id=latte.id, direct_cost=1.5,
+                                                                  sales_forecast=100, indirect_cost=200)
+        current = service.get_latest_update_price(latte.id)
+        assert current.menu_id == latte.id
+        assert current.direct_cost == 1.5
+        assert current.manual_price == 5.0
+        assert current.profit_margin == 0.2
+
+        # same values again, no new record
+        count = len(in_memory_db.get_estimatedmenupricerecord(menu_id=latte.id))
+        service._add_new_estimated_record_update_menu_suggestion(only_menu_id=latte.id, indirect_cost=200)
+        assert len(in_memory_db.get_estimatedmenupricerecord(menu_id=latte.id)) == count
+
+        # values not passed carry over from the current estimate
+        service._add_new_estimated_record_update_menu_suggestion(only_menu_id=latte.id, indirect_cost=400)
+        current = service.get_latest_update_price(latte.id)
+        assert current.direct_cost == 1.5
+        assert current.estimated_indirect_costs == 400
+        assert in_memory_db.get_menu(id=latte.id)[0].suggested_price == pytest.approx((1.5 + 4) * 1.2)
+
+        # a back dated record does not move the pointer, editing the menu does not reset it
+        in_memory_db.add_estimatedmenupricerecord(menu_id=latte.id, direct_cost=9, from_date=datetime(2020, 1, 1))
+        menu = in_memory_db.get_menu(id=latte.id)[0]
+        menu.current_estimate_id = None
+        in_memory_db.edit_menu(menu)
+        assert service.get_latest_update_price(latte.id).id == current.id
+
+    def test_compact_price_history(self, in_memory_db):
+        service = MenuPriceService(in_memory_db)
+        latte = in_memory_db.add_menu(name="Latte", size="m", current_price=5.0)
+        for day in (1, 10, 20):
+            for month in (1, 2):
+                in_memory_db.add_estimatedmenupricerecord(menu_id=latte.id, direct_cost=day + month,
+                                                          from_date=datetime(2024, month, day))
+        recent = in_memory_db.add_estimatedmenupricerecord(menu_id=latte.id, direct_cost=1,
+                                                           from_date=datetime(2024, 6, 1))
+
+        assert service.compact_price_history(keep_days=30, now=datetime(2024, 6, 10)) == 4
+        kept = in_memory_db.get_estimatedmenupricerecord(menu_id=latte.id)
+        assert [r.from_date for r in kept] == [datetime(2024, 6, 1), datetime(2024, 2, 20), datetime(2024, 1, 20)]
+        assert service.get_latest_update_price(latte.id).id == recent.id
+
+        in_memory_db.delete_estimatedmenupricerecord(recent)
+        assert service.get_latest_update_price(latte.id).from_date == datetime(2024, 2, 20)
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
@@ -0,0 +1,134 @@
+from datetime import datetime
+
+import pytest
+
+from cafe_manager import CafeManager
+from services.pos_write_buffer import PosWriteBuffer
+
+
+@pytest.fixture
+def pos_setup(in_memory_db, tmp_path):
+    manager = CafeManager(in_memory_db)
+    menu = in_memory_db.add_menu(name="latte", size="m", current_price=100)
+    coffee = in_memory_db.add_inventory(name="coffee", unit="gr")
+    milk = in_memory_db.add_inventory(name="milk", unit="ml")
+    in_memory_db.add_recipe(coffee.id, menu.id, inventory_item_amount_usage=10)
+    in_memory_db.add_recipe(milk.id, menu.id, inventory_item_amount_usage=100)
+    manager.inventory.manual_report(coffee.id, 50, "tester")
+    manager.inventory.manual_report(milk.id, 1000, "tester")
+
+    buffer = PosWriteBuffer(db_url=f"sqlite:///{tmp_path / 'pos_buffer.db'}", terminal_id="pos1")
+    return {"manager": manager, "buffer": buffer, "menu": menu, "coffee": coffee, "milk": milk}
+
+
+def send_to(manager):
+    """stands in for the POST to sale/batch, payload dates arrive as strings"""
+    def send_batch(entries):
+        for entry in entries:
+            entry['payload']['date'] = datetime.fromisoformat(entry['payload']['date'])
+        return manager.ingest_pos_batch(entries)
+    return send_batch
+
+
+def test_buffer_sync_applies_in_order(in_memory_db, pos_setup):
+    buffer, manager, menu = pos_setup["buffer"], pos_setup["manager"], pos_setup["menu"]
+
+    first_sale = buffer.enqueue_sale(menu_id=menu.id, quantity=2, saler="tester")
+    buffer.enqueue_sale(menu_id=menu.id, quantity=1, invoice_key=first_sale)
+    buffer.enqueue_payment(paid=300, payer="guest", method="cash", receiver="tester", invoice_key=first_sale)
+    assert len(buffer.get_buffered()) == 3
+
+    summary = buffer.sync(send_to(manager), batch_size=2)
+    assert summary == {'synced': 3, 'conflict': 0, 'pending': 0}
+
+    invoices = in_memory_db.get_invoice()
+    assert len(invoices) == 1
+    assert len(invoices[0].sales) == 2
+    assert invoices[0].closed is True
+    assert in_memory_db.get_inventory(id=pos_setup["coffee"].id)[0].current_stock == 20
+    assert in_memory_db.get_inventory(id=pos_setup["milk"].id)[0].current_stock == 700
+
+
+def test_buffer_reports_stock_conflicts(in_memory_db, pos_setup):
+    buffer, manager, menu = pos_setup["buffer"], pos_setup["manager"], pos_setup["menu"]
+
+    buffer.enqueue_sale(menu_id=menu.id, quantity=4)
+    # running stock of the batch is 10 gr coffee now, this one does not fit
+    buffer.enqueue_sale(menu_id=menu.id, quantity=2)
+    buffer.enqueue_sale(menu_id=menu.id, quantity=1)
+
+    summary = buffer.sync(send_to(manager))
+    assert summary == {'synced': 2, 'conflict': 1, 'pending': 0}
+
+    conflicts = buffer.get_buffered(status='conflict')
+    assert len(conflicts) == 1
+    assert "stock" in conflicts[0].error.lower()
+    assert in_memory_db.get_inventory(id=pos_setup["coffee"].id)[0].current_stock == 0
+    assert len(in_memory_db.get_sales()) == 2
+
+
+def test_buffer_resend_after_timeout_is_deduplicated(in_memory_db, pos_setup):
+    buffer, manager, menu = pos_setup["buffer"], pos_setup["manager"], pos_setup["menu"]
+    buffer.enqueue_sale(menu_id=menu.id, quantity=1)
+
+    def applied_then_timed_out(entries):
+        send_to(manager)(entries)
+        raise TimeoutError("no answer from server")
+
+    summary = buffer.sync(applied_then_timed_out)
+    assert summary['pending'] == 1
+
+    summary = buffer.sync(send_to(manager))
+    assert summary == {'synced': 1, 'conflict': 0, 'pending': 0}
+    assert len(in_memory_db.get_sales()) == 1
+    assert in_memory_db.get_inventory(id=pos_setup["coffee"].id)[0].current_stock == 40
+
+    assert buffer.purge_synced() == 1
+    assert buffer.get_buffered(status=None) == []
+
+
+def test_buffer_retry_keeps_dependent_entries_pending(in_memory_db, pos_setup):
+    buffer, manager, menu = pos_setup["buffer"], pos_setup["manager"], pos_setup["menu"]
+    sale = buffer.enqueue_sale(menu_id=menu.id, quantity=1, saler="tester")
+    payment = buffer.enqueue_payment(paid=100, payer="guest", method="cash", receiver="tester", invoice_key=sale)
+
+    def busy_server(entries):
+        # the sale hit a locked database, so its payment found no invoice
+        return [{'request_key': sale, 'status': 'retry'},
+                {'request_key': payment, 'status': 'conflict', 'error': 'invoice not found'}]
+
+    assert buffer.sync(busy_server) == {'synced': 0, 'conflict': 0, 'pending': 2}
+    assert buffer.get_buffered(status='conflict') == []
+
+    assert buffer.sync(send_to(manager)) == {'synced': 2, 'conflict': 0, 'pending': 0}
+    assert in_memory_db.get_invoice()[0].closed is True
+
+
+def test_ingest_unknown_entries(in_memory_db, pos_setup):
+    manager = pos_setup["manager"]
+    results = manager.ingest_pos_batch([
+        {'request_key': 'a', 'kind': 'refund', 'payload': {}},
+        {'request_key': 'b', 'kind': 'sale', 'payload': {'menu_id': 999, 'quantity': 1}},
+        {'request_key': 'c', 'kind': 'payment', 'payload': {'invoice_key': 'missing', 'paid': 1}},
+    ])
+    assert [r['status'] for r in results] == ['error', 'conflict', 'conflict']
+    # rejected keys are released for a later retry
+    assert in_memory_db.get_idempotencykey() == []
+
+
+def test_ingest_stock_taken_meanwhile_leaves_nothing(in_memory_db, pos_setup, monkeypatch):
+    manager, menu, coffee = pos_setup["manager"], pos_setup["menu"], pos_setup["coffee"]
+    # the batch checks against stock read before another worker used up the coffee
+    stale_stock = in_memory_db.get_stock_levels()
+    manager.inventory.manual_report(coffee.id, 5, "tester")
+    monkeypatch.setattr(in_memory_db, "get_stock_levels", lambda: dict(stale_stock))
+
+    results = manager.ingest_pos_batch([
+        {'request_key': 'k1', 'kind': 'sale', 'payload': {'menu_id': menu.id, 'quantity': 1}},
+        {'request_key': 'k2', 'kind': 'payment', 'payload': {'invoice_key': 'k1', 'paid': 100, 'payer': 'guest',
+                                                             'method': 'cash', 'receiver': 'tester'}},
+    ])
+    assert [r['status'] for r in results] == ['conflict', 'conflict']
+    assert in_memory_db.get_sales() == [] and in_memory_db.get_invoice() == []
+    assert in_memory_db.get_idempotencykey() == []
+    assert in_memory_db.get_inventory(id=coffee.id)[0].current_stock == 5
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+
+from services.menu_pricing_service import MenuPriceService
+from services.pricing_simulator import PricingSimulator
+
+
+@pytest.fixture
+def simulator(in_memory_db):
+    latte = in_memory_db.add_menu(name='latte', size='m', current_price=20)
+    tea = in_memory_db.add_menu(name='tea', size='m', current_price=10)
+    in_memory_db.add_estimatedmenupricerecord(menu_id=latte.id, direct_cost=2, profit_margin=0.5, estimated_price=25)
+    in_memory_db.add_estimatedmenupricerecord(menu_id=tea.id, direct_cost=1, profit_margin=0.2)
+    in_memory_db.add_rent(name='shop', rent=1000, from_date=datetime(2025, 1, 1), to_date=datetime(2025, 12, 31))
+    in_memory_db.add_estimatedbills(name='power', category='power', cost=500,
+                                    from_date=datetime(2025, 1, 1), to_date=datetime(2025, 12, 31))
+    return PricingSimulator(MenuPriceService(in_memory_db)), latte, tea
+
+
+def test_simulate_grid_without_writes(simulator, in_memory_db):
+    simulator, latte, tea = simulator
+    records = len(in_memory_db.get_estimatedmenupricerecord())
+
+    rows = simulator.simulate(sales_forecasts=[100, 200], rent_factors=[1, 2], year=2025)
+
+    assert len(rows) == 8
+    assert len(in_memory_db.get_estimatedmenupricerecord()) == records
+    by_key = {(row['sales_forecast'], row['rent_factor'], row['menu_id']): row for row in rows}
+    # (1500 / 100 + 2) * 1.5
+    assert by_key[(100, 1, latte.id)]['simulated_price'] == pytest.approx(25.5)
+    assert by_key[(100, 1, latte.id)]['difference'] == pytest.approx(5.5)
+    assert by_key[(100, 1, latte.id)]['estimated_price'] == 25
+    # (2500 / 200 + 1) * 1.2
+    assert by_key[(200, 2, tea.id)]['simulated_price'] == pytest.approx(16.2)
+
+
+def test_simulate_margin_override_and_pool(simulator):
+    simulator, latte, tea = simulator
+    grid = dict(profit_margins=[None, 0, 1], sales_forecasts=[100, 1000], labor_factors=[1, 1.5], year=2025)
+
+    local = simulator.simulate(**grid)
+    pooled = simulator.simulate(workers=2, pool_threshold=0, **grid)
+
+    assert [row['simulated_price'] for row in pooled] == [row['simulated_price'] for row in local]
+    zero_margin = [row for row in local if row['profit_margin'] == 0 and row['sales_forecast'] == 100]
+    assert {row['menu_id']: row['simulated_price'] for row in zero_margin} == {latte.id: 17, tea.id: 16}
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+import pytest
+
+from models.dbhandler import DBHandler
+from services.inventory_service import InventoryService
+
+
+@pytest.fixture
+def cafe(in_memory_db):
+    coffee = in_memory_db.add_inventory(name='coffee', unit='gr', current_stock=100)
+    milk = in_memory_db.add_inventory(name='milk', unit='L', current_stock=1)
+    sugar = in_memory_db.add_inventory(name='sugar', unit='gr', current_stock=10)
+    water = in_memory_db.add_inventory(name='water', unit='L', current_stock=100)
+    syrup = in_memory_db.add_inventory(name='syrup', unit='L', current_stock=0.1)
+    latte = in_memory_db.add_menu(name='latte', size='L')
+    sweet = in_memory_db.add_menu(name='sweet latte', size='L')
+    in_memory_db.add_recipe(coffee.id, latte.id, inventory_item_amount_usage=10)
+    in_memory_db.add_recipe(milk.id, latte.id, inventory_item_amount_usage=0.2)
+    in_memory_db.add_recipe(coffee.id, sweet.id, inventory_item_amount_usage=10)
+    in_memory_db.add_recipe(syrup.id, sweet.id, inventory_item_amount_usage=0.1)
+
+    service = InventoryService(in_memory_db)
+    # 1 L syrup = 500 gr sugar + 1 L water
+    assert service.add_prep_recipe(syrup.id, sugar.id, 500)
+    assert service.add_prep_recipe(syrup.id, water.id, 1)
+    return service, {'coffee': coffee, 'milk': milk, 'sugar': sugar, 'water': water, 'syrup': syrup,
+                     'latte': latte, 'sweet': sweet}
+
+
+def test_max_producible(cafe):
+    service, items = cafe
+    producible = service.max_producible()
+    assert producible[items['latte'].id] == 5
+    assert producible[items['sweet'].id] == 1
+
+
+def test_check_cart_makes_missing_prep(cafe):
+    service, items = cafe
+    ok, missing = service.check_stock_for_cart({items['sweet'].id: 1, items['latte'].id: 2})
+    assert ok and missing == {}
+
+    # 0.1 L syrup in stock, 0.1 L more made from 50 gr sugar (only 10 gr there)
+    ok, missing = service.check_stock_for_cart({items['sweet'].id: 2})
+    assert not ok
+    assert missing == {items['sugar'].id: pytest.approx(40)}
+
+
+def test_forecast_needs_are_exploded(cafe, in_memory_db):
+    service, items = cafe
+    in_memory_db.add_salesforecast(menu_item_id=items['sweet'].id, sell_number=20,
+                                   from_date=datetime(2025, 1, 1), to_date=datetime(2025, 1, 10))
+    needs = service.forecast_ingredient_needs(datetime(2025, 1, 1), datetime(2025, 1, 5))
+    # half of the forecast: 10 sweet lattes
+    assert needs == {items['coffee'].id: pytest.approx(100),
+                     items['sugar'].id: pytest.approx(500),
+                     items['water'].id: pytest.approx(1)}
+
+
+def test_prep_cycle_rejected_and_cache_rebuilt(cafe, in_memory_db):
+    service, items = cafe
+    assert service.add_prep_recipe(items['sugar'].id, items['syrup'].id, 1) is None
+
+    before = service.recipes.get()
+    # unchanged recipes are not read again
+    rows = in_memory_db.get_recipe_matrix_rows
+    in_memory_db.get_recipe_matrix_rows = None
+    assert service.recipes.get() is before
+    in_memory_db.get_recipe_matrix_rows = rows
+    # changed behind the cache (another worker), the recipe version notices
+    other = DBHandler(engine=in_memory_db.engine, session_factory=in_memory_db.Session)
+    recipe = other.get_recipe(menu_id=items['latte'].id, inventory_id=items['milk'].id)[0]
+    recipe.inventory_item_amount_usage = 0.5
+    other.edit_recipe(recipe)
+    assert service.recipes.get() is not before
+    assert service.max_producible()[items['latte'].id] == 2
+
+
+def test_menu_check_reads_only_its_stock(cafe):
+    service, items = cafe
+    sweet = items['sweet']
+    assert service.recipes.get().inventory_of([sweet.id]) == {items['coffee'].id, items['syrup'].id,
+                                                             items['sugar'].id, items['water'].id}
+    stock = service.stock_for_menu(sweet)
+    assert set(stock) == service.recipes.get().inventory_of([sweet.id])
+    ok, missing, max_available = service.check_stock_for_menu(sweet, 1, stock=stock)
+    assert ok and not missing and max_available == 1
+    assert service.recipes.get().max_producible(stock, [sweet.id]) == {sweet.id: 1}
+
+
+def test_sale_path_makes_missing_prep(cafe, in_memory_db):
+    service, items = cafe
+    sweet = in_memory_db.get_menu(id=items['sweet'].id, with_recipe=True)[0]
+    # 0.11 L syrup: 0.1 L from stock, 0.01 L made from 5 gr sugar and 0.01 L water
+    ok, missing, _ = service.check_stock_for_menu(sweet, 1.1)
+    assert ok and missing == {}
+    changes = {change['inventory_id']: change['change_amount'] for change in service.stock_changes_for_menu(sweet, 1.1)}
+    assert changes == {items['coffee'].id: pytest.approx(-11),
+                       items['syrup'].id: pytest.approx(-0.1),
+                       items['sugar'].id: pytest.approx(-5),
+                       items['water'].id: pytest.approx(-0.01)}
+
+    ok, missing, _ = service.check_stock_for_menu(sweet, 2)
+    assert not ok and missing == {'sugar': pytest.approx(40)}
@@ -173,4 +173,16 @@ def test_cancel_no_sales(in_memory_db, menus):
     else:
         # No invoice exists, cancel should return False
         result = service.cancel_sale(menu_id=menu2.id, invoice_id=999)
-        assert result == False
\ No newline at end of file
+        assert result == False
+
+def test_invoice_edit_retries_on_stale_version(in_memory_db):
+    service = SalesService(in_memory_db)
+    invoice = in_memory_db.add_invoice()
+    stale = in_memory_db.get_invoice(id=invoice.id)[0]
+    assert service._edit_invoice(invoice.id, lambda the_invoice: setattr(the_invoice, 'total_price', 10))
+
+    stale.closed = True
+    assert in_memory_db.edit_invoice(stale) is None
+    assert service._edit_invoice(invoice.id, lambda the_invoice: setattr(the_invoice, 'closed', True))
+    saved = in_memory_db.get_invoice(id=invoice.id)[0]
+    assert saved.closed is True and saved.total_price == 10
@@ -0,0 +1,70 @@
+from datetime import datetime, time
+
+import pytest
+
+from services.staffing_optimizer import StaffingOptimizer, cheapest_staffing
+
+
+@pytest.fixture
+def staffing(in_memory_db):
+    menu = in_memory_db.add_menu(name='latte', size='m', current_price=10)
+    # 80 items on a monday 10:00, one monday in the 8 history weeks -> 10 items per hour
+    invoice = in_memory_db.add_invoice(date=datetime(2025, 5, 26, 10, 15))
+    in_memory_db.add_sales(menu_id=menu.id, invoice_id=invoice.id, number=80)
+    barista = in_memory_db.add_targetpositionandsalary('barista', datetime(2025, 1, 1), datetime(2025, 12, 31),
+                                                       monthly_hr=100, monthly_payment=1000)
+    senior = in_memory_db.add_targetpositionandsalary('senior', datetime(2025, 1, 1), datetime(2025, 12, 31),
+                                                      monthly_hr=100, monthly_payment=1500)
+    monday = in_memory_db.add_shift(date=datetime(2025, 6, 2), from_hr=time(8), to_hr=time(12), name='morning')
+    tuesday = in_memory_db.add_shift(date=datetime(2025, 6, 3), from_hr=time(8), to_hr=time(12), name='morning')
+    return StaffingOptimizer(in_memory_db), menu, barista, senior, monday, tuesday
+
+
+def test_cheapest_staffing():
+    positions = [(1, 4, 10), (2, 8, 15)]
+    assert cheapest_staffing(10, positions) == {2: 1, 1: 1}
+    assert cheapest_staffing(16, positions) == {2: 2}
+    assert cheapest_staffing(0, positions, min_staff=2) == {1: 2}
+    assert cheapest_staffing(5, [(1, 0, 10)]) == {}
+
+
+def test_plan_writes_estimated_labor(staffing, in_memory_db):
+    optimizer, menu, barista, senior, monday, tuesday = staffing
+    capacities = {'Barista': 4, 'senior': 8}
+
+    plan = optimizer.plan(datetime(2025, 6, 2), datetime(2025, 6, 9), capacities=capacities)
+
+    by_shift = {row['shift_id']: row for row in plan}
+    assert by_shift[monday.id]['peak_demand'] == 10
+    assert {s['position_id']: s['number'] for s in by_shift[monday.id]['staff']} == {senior.id: 1, barista.id: 1}
+    assert by_shift[monday.id]['cost'] == 100
+    assert {s['position_id']: s['number'] for s in by_shift[tuesday.id]['staff']} == {barista.id: 1}
+    assert {(labor.position_id, labor.number) for labor in in_memory_db.get_estimatedlabor(shift_id=monday.id)} \
+        == {(senior.id, 1), (barista.id, 1)}
+
+    # the forecast doubles the history, a new run replaces the rows
+    in_memory_db.add_salesforecast(menu.id, 20, datetime(2025, 6, 2), datetime(2025, 6, 9))
+    plan = optimizer.plan(datetime(2025, 6, 2), datetime(2025, 6, 9), capacities=capacities)
+
+    assert {s['position_id']: s['number'] for s in plan[0]['staff']} == {senior.id: 2, barista.id: 1}
+    assert len(in_memory_db.get_estimatedlabor(shift_id=monday.id)) == 2
+    assert len(in_memory_db.get_estimatedlabor()) == 3
+
+
+def test_plan_covers_routine_shifts(staffing, in_memory_db):
+    optimizer, menu, barista, senior, monday, tuesday = staffing
+    routine = in_memory_db.add_shiftroutine(from_date=datetime(2025, 6, 1), to_date=datetime(2025, 6, 30),
+                                            from_hr=time(9), to_hr=time(11), name='brunch', weekdays="0")
+
+    preview = optimizer.plan(datetime(2025, 6, 2), datetime(2025, 6, 9), write=False)
+    brunch = [row for row in preview if row['routine_id'] == routine.id]
+    assert [(row['shift_id'], row['date']) for row in brunch] == [(None, datetime(2025, 6, 2))]
+    assert in_memory_db.get_estimatedlabor() == []
+
+    plan = optimizer.plan(datetime(2025, 6, 2), datetime(2025, 6, 9))
+    stored = [row['shift_id'] for row in plan if row['routine_id'] == routine.id]
+    assert len(stored) == 1 and stored[0] is not None
+    assert in_memory_db.get_estimatedlabor(shift_id=stored[0])
+    # the next run plans the stored occurrence, it is not stored twice
+    plan = optimizer.plan(datetime(2025, 6, 2), datetime(2025, 6, 9))
+    assert [row['shift_id'] for row in plan if row['routine_id'] == routine.id] == stored
@@ -0,0 +1,71 @@
+from datetime import datetime, time
+
+import pytest
+
+from services.time_clock import TimeClockImporter
+
+
+@pytest.fixture
+def staff(in_memory_db):
+    anna = in_memory_db.add_personal(first_name="anna", last_name="a")
+    ben = in_memory_db.add_personal(first_name="ben", last_name="b")
+    night = in_memory_db.add_shift(date=datetime(2025, 3, 3), from_hr=time(22, 0), to_hr=time(6, 0),
+                                   name="night", lunch_payment=5, extra_payment=10)
+    in_memory_db.add_personalassignment(personal_id=anna.id, shift_id=night.id)
+    return anna, ben, night
+
+
+def test_ingest_pairs_punches_and_matches_shifts(staff, in_memory_db):
+    anna, ben, night = staff
+    csv_lines = ["personal_id,time,direction",
+                 f"{anna.id},2025-03-03 21:55,in",
+                 f"{ben.id},2025-03-04 08:00,",
+                 f"{anna.id},2025-03-04 06:05,out",
+                 f"{ben.id},2025-03-04 12:30,",
+                 f"{ben.id},2025-03-04 13:00,out",
+                 "999,2025-03-04 08:00,in",
+                 "999,2025-03-04 09:00,out",
+                 f"{ben.id},not a time,in",
+                 f"{anna.id},2025-03-05 08:00,in"]
+
+    summary = TimeClockImporter(in_memory_db).ingest("reader-1", csv_lines, batch_size=2)
+
+    assert summary['records'] == 2 and summary['skipped'] == 1
+    assert summary['error_count'] == 2 and summary['open'] == 1
+    # anna's last clock-in waits for its clock-out
+    assert summary['checkpoint'] == 9
+    anna_record = in_memory_db.get_workshiftrecord(personal_id=anna.id)[0]
+    assert anna_record.worked_hr == pytest.approx(8.17, 0.01)
+    assert (anna_record.lunch_paid, anna_record.extra_paid) == (5, 10)
+    assert anna_record.description == f"time clock, shift {night.id}" and anna_record.shift_id == night.id
+    ben_record = in_memory_db.get_workshiftrecord(personal_id=ben.id)[0]
+    assert ben_record.worked_hr == 4.5 and ben_record.description == "time clock, no assigned shift"
+
+    # the export grew, the rerun continues at the open clock-in without writing twice
+    csv_lines.append(f"{anna.id},2025-03-05 16:00,out")
+    summary = TimeClockImporter(in_memory_db).ingest("reader-1", csv_lines)
+    assert summary['records'] == 1 and summary['punches'] == 2
+    assert summary['checkpoint'] == 11
+    assert len(in_memory_db.get_workshiftrecord()) == 3
+
+    # a crashed import read from the start again only skips what is there
+    summary = TimeClockImporter(in_memory_db).ingest("reader-2", csv_lines)
+    assert summary['records'] == 0 and len(in_memory_db.get_workshiftrecord()) == 3
+
+
+def test_ingest_extra_fields_and_stale_clock_in(staff, in_memory_db):
+    anna, ben, _ = staff
+    csv_lines = ["personal_id,time,direction",
+                 f"{ben.id},2025-03-01 08:00,in",
+                 f"{anna.id},2025-03-03 21:55,in,reader 2",
+                 f"{anna.id},2025-03-04 06:05,out,",
+                 "1,2025-01-01T16:00,extra,fields"]
+
+    summary = TimeClockImporter(in_memory_db).ingest("reader-1", csv_lines)
+    assert summary['records'] == 1
+    # ben's clock-in is days older than the last punch, it is reported and no longer holds the checkpoint
+    assert summary['open'] == 0 and summary['checkpoint'] == 5
+    assert f"line 2: clock-in of {ben.id} has no clock-out" in summary['errors']
+    # the trailing field of line 3 and 4 is ignored, line 5 fails on its direction not on the extra field
+    assert [error for error in summary['errors'] if error.startswith("line 5:")] == [
+        "line 5: not a punch (direction should be in or out, not extra)"]
@@ -1,4 +1,7 @@
+import pytest
+
 from cafe_manager import CafeManager
+from datetime import datetime, time, timedelta
 
 
 
@@ -26,3 +29,116 @@ def test_add_menu_item(in_memory_db):
 
     assert test2
 
+
+
+def test_add_new_sale_retry_with_request_key(in_memory_db):
+    cafe_manager = CafeManager(in_memory_db)
+    menu = in_memory_db.add_menu(name="latte", size="m", current_price=100)
+    coffee = in_memory_db.add_inventory(name="coffee", unit="gr")
+    in_memory_db.add_recipe(coffee.id, menu.id, inventory_item_amount_usage=10)
+    assert cafe_manager.inventory.manual_report(coffee.id, 100, "tester")
+
+    first = cafe_manager.add_new_sale(request_key="pos-1-0001", menu_id=menu.id, quantity=2, date=datetime.now())
+    retry = cafe_manager.add_new_sale(request_key="pos-1-0001", menu_id=menu.id, quantity=2, date=datetime.now())
+
+    assert first is True
+    assert retry is True
+    assert len(in_memory_db.get_sales()) == 1
+    assert in_memory_db.get_inventory(id=coffee.id)[0].current_stock == 80
+
+    # a failed request releases its key so the client can retry it
+    too_many = cafe_manager.add_new_sale(request_key="pos-1-0002", menu_id=menu.id, quantity=20, date=datetime.now())
+    assert too_many is False
+    assert in_memory_db.get_idempotencykey(key="pos-1-0002") == []
+
+
+def test_add_new_sale_is_one_transaction(in_memory_db):
+    cafe_manager = CafeManager(in_memory_db)
+    menu = in_memory_db.add_menu(name="latte", size="m", current_price=100)
+    coffee = in_memory_db.add_inventory(name="coffee", unit="gr")
+    in_memory_db.add_recipe(coffee.id, menu.id, inventory_item_amount_usage=10)
+    assert cafe_manager.inventory.manual_report(coffee.id, 100, "tester")
+
+    # stock taken by another worker after the check: nothing of the sale is written, the key is free again
+    status, sale = in_memory_db.record_sale(menu.id, 20, 2000, [{'inventory_id': coffee.id, 'change_amount': -200}],
+                                            request_key="pos-1-0001")
+    assert (status, sale) == ('conflict', None)
+    assert in_memory_db.get_invoice() == [] and in_memory_db.get_sales() == []
+    assert in_memory_db.get_idempotencykey() == []
+
+    assert cafe_manager.add_new_sale(request_key="pos-1-0001", menu_id=menu.id, quantity=1, date=datetime.now())
+    key = in_memory_db.get_idempotencykey(key="pos-1-0001")[0]
+    assert key.status == 'done' and key.result_id == in_memory_db.get_sales()[0].id
+    assert in_memory_db.get_invoice()[0].total_price == 100
+
+    # keys are per scope, a payment may reuse the key of its sale
+    invoice_id = in_memory_db.get_sales()[0].invoice_id
+    assert cafe_manager.add_new_invoice_pay(request_key="pos-1-0001", paid=100, payer="guest", method="cash",
+                                            receiver="tester", invoice_id=invoice_id) is True
+    assert len(in_memory_db.get_invoicepayment(invoice_id=invoice_id)) == 1
+    assert {k.scope for k in in_memory_db.get_idempotencykey(key="pos-1-0001")} == {"sale", "payment"}
+
+
+def test_add_new_invoice_pay_retry_with_request_key(in_memory_db):
+    cafe_manager = CafeManager(in_memory_db)
+    invoice = in_memory_db.add_invoice(saler="tester", total_price=100, closed=False)
+
+    kwargs = dict(paid=100, payer="guest", method="cash", receiver="tester", invoice_id=invoice.id)
+    assert cafe_manager.add_new_invoice_pay(request_key="pay-1", **kwargs) is True
+    assert cafe_manager.add_new_invoice_pay(request_key="pay-1", **kwargs) is True
+
+    assert len(in_memory_db.get_invoicepayment(invoice_id=invoice.id)) == 1
+    assert in_memory_db.get_invoice(id=invoice.id)[0].closed is True
+
+
+def test_import_stocktake_by_name(in_memory_db):
+    cafe_manager = CafeManager(in_memory_db)
+    coffee = in_memory_db.add_inventory(name="coffee", unit="gr", current_stock=0)
+    milk = in_memory_db.add_inventory(name="milk", unit="L", current_stock=0)
+
+    report = cafe_manager.import_stocktake([{"name": "Coffee", "amount": "12.5"},
+                                            {"inventory_id": str(milk.id), "amount": 3}], reporter="sara")
+    assert {row["inventory_id"]: row["counted"] for row in report} == {coffee.id: 12.5, milk.id: 3}
+
+    with pytest.raises(ValueError):
+        cafe_manager.import_stocktake([{"name": "tea", "amount": 1}], reporter="sara")
+
+
+def test_serialization_personal_pages_and_history(in_memory_db):
+    cafe_manager = CafeManager(in_memory_db)
+    now = datetime.now()
+    month_start = datetime(now.year, now.month, 1)
+    people = [in_memory_db.add_personal(first_name=f"p{i}", last_name="x", active=True) for i in range(3)]
+    in_memory_db.add_personal(first_name="gone", last_name="x", active=False)
+    worker = people[0]
+    in_memory_db.add_workshiftrecord(worker.id, from_date=month_start, to_date=month_start, worked_hr=6)
+    in_memory_db.add_workshiftrecord(worker.id, from_date=month_start, to_date=month_start, worked_hr=2)
+    in_memory_db.add_recordemployeepayment(worker.id, from_date=month_start - timedelta(days=30),
+                                           to_date=month_start, payment=900)
+    shift = in_memory_db.add_shift(date=now + timedelta(days=2), from_hr=time(8), to_hr=time(16), name="morning")
+    in_memory_db.add_personalassignment(worker.id, shift.id)
+    # dated at midnight, still upcoming later today
+    today = in_memory_db.add_shift(date=datetime(now.year, now.month, now.day), from_hr=time(23),
+                                   to_hr=time(23, 30), name="late")
+    in_memory_db.add_personalassignment(worker.id, today.id)
+
+    first = cafe_manager.serialization_personal(page=1, page_size=2)
+    second = cafe_manager.serialization_personal(page=2, page_size=2)
+    assert len(first) == 2 and len(second) == 1
+    assert {p['personal_id'] for p in first + second} == {p.id for p in people}
+    assert len(cafe_manager.serialization_personal(f="all")) == 4
+
+    summary = next(p for p in first + second if p['personal_id'] == worker.id)
+    assert summary['hours_this_month'] == 8
+    assert summary['last_payment']['payment'] == 900
+    assert summary['upcoming_shifts'] == 2
+    assert summary['next_shift'] == datetime(now.year, now.month, now.day)
+
+    history = cafe_manager.serialization_personal_history(worker.id, 'work_records', page=1, page_size=1)
+    assert len(history['items']) == 1 and history['has_more']
+    history = cafe_manager.serialization_personal_history(worker.id, 'work_records', page=2, page_size=1)
+    assert len(history['items']) == 1 and not history['has_more']
+    assert {item['shift_id'] for item in cafe_manager.serialization_personal_history(worker.id, 'shifts')['items']} \
+           == {shift.id, today.id}
+    assert cafe_manager.serialization_personal_history(worker.id, 'payments')['items'][0]['payment'] == 900
+    assert cafe_manager.serialization_personal_history(worker.id, 'unknown') is None